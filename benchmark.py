@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+性能基准测试脚本 - 只使用本机回环地址和临时文件，不修改系统设置
+使用方法:
+    python benchmark.py dns [--queries 20000] [--concurrency 64] [--upstream-delay 20]
+    python benchmark.py hosts [--sizes 1000,10000,100000,1000000]
+    python benchmark.py lookup [--sizes 10000,100000,500000] [--names-per-line 9]
+    python benchmark.py helper [--calls 200]
+"""
+
+import os
+import sys
+import time
+import struct
+import random
+import asyncio
+import argparse
+import tempfile
+
+from kill_domains_mac_simple import LOCALHOST_IP, MARKER_START, MARKER_END
+from kill_domains_mac_simple import DnsSinkhole, DomainMatcher, HostsDocument
+from kill_domains_mac_simple import PrivilegedBatch, PrivilegedHelperClient
+import kill_domains_mac_simple
+
+
+def percentile(values, pct):
+    """返回已排序列表的百分位数"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(len(values) * pct / 100))
+    return values[index]
+
+
+def build_query(name, qtype=1):
+    """构造一条标准 DNS 查询报文"""
+    header = struct.pack('!HHHHHH', random.randrange(0x10000), 0x0100, 1, 0, 0, 0)
+    question = b''.join(bytes([len(label)]) + label.encode() for label in name.split('.')) + b'\x00'
+    return header + question + struct.pack('!HH', qtype, 1)
+
+
+class FakeUpstream(asyncio.DatagramProtocol):
+    """假的上游 DNS：所有 A 查询返回 192.0.2.1（TTL 300），可模拟网络延迟"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.transport = None
+        self.queries = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.queries += 1
+        _, _, _, question_end = DnsSinkhole.parse_question(data)
+        answer = struct.pack('!HHHIH', 0xC00C, 1, 1, 300, 4) + bytes([192, 0, 2, 1])
+        response = data[:2] + b'\x81\x80' + struct.pack('!HHHH', 1, 1, 0, 0) + data[12:question_end] + answer
+        if self.delay:
+            asyncio.get_running_loop().call_later(self.delay, self.transport.sendto, response, addr)
+        else:
+            self.transport.sendto(response, addr)
+
+
+class QueryClient(asyncio.DatagramProtocol):
+    """基准测试客户端：一个 UDP socket 上同时发出多条查询，按 ID 匹配应答"""
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        future = self.pending.pop(data[:2], None)
+        if future and not future.done():
+            future.set_result(data)
+
+    async def query(self, name, timeout=5):
+        packet = build_query(name)
+        while packet[:2] in self.pending:
+            packet = build_query(name)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[packet[:2]] = future
+        self.transport.sendto(packet)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(packet[:2], None)
+
+
+async def run_queries(address, names, concurrency):
+    """并发发送查询，返回 (总耗时, 已排序的延迟列表, 失败数)"""
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(QueryClient, remote_addr=address)
+    latencies = []
+    failures = 0
+    queue = list(reversed(names))
+
+    async def worker():
+        nonlocal failures
+        while queue:
+            name = queue.pop()
+            started = time.perf_counter()
+            try:
+                await client.query(name)
+                latencies.append(time.perf_counter() - started)
+            except asyncio.TimeoutError:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    transport.close()
+    latencies.sort()
+    return elapsed, latencies, failures
+
+
+def report(title, count, elapsed, latencies, failures):
+    print(f"{title:<28} {count / elapsed:>10.0f} q/s   "
+          f"p50 {percentile(latencies, 50) * 1000:>7.2f} ms   "
+          f"p99 {percentile(latencies, 99) * 1000:>7.2f} ms   失败 {failures}")
+
+
+async def benchmark_dns(args):
+    loop = asyncio.get_running_loop()
+    upstream_transport, upstream = await loop.create_datagram_endpoint(
+        lambda: FakeUpstream(args.upstream_delay / 1000), local_addr=('127.0.0.1', 0))
+    upstream_address = upstream_transport.get_extra_info('sockname')[:2]
+
+    sinkhole = DnsSinkhole(('127.0.0.1', 0), [upstream_address], cache_size=args.queries * 2)
+    sinkhole.start()
+    sinkhole.update(DomainMatcher(['blocked.test']))
+    try:
+        print(f"假上游 {upstream_address[0]}:{upstream_address[1]}（延迟 {args.upstream_delay} ms），"
+              f"屏蔽服务器 {sinkhole.address[0]}:{sinkhole.address[1]}，并发 {args.concurrency}")
+
+        # 基线：直接查询假上游
+        names = [f"direct{i}.example.com" for i in range(args.queries)]
+        report("直接查询上游", len(names), *await run_queries(upstream_address, names, args.concurrency))
+
+        # 冷缓存：每个名称都需要转发
+        names = [f"host{i}.example.com" for i in range(args.queries)]
+        report("屏蔽服务器（未命中缓存）", len(names), *await run_queries(sinkhole.address, names, args.concurrency))
+
+        # 热缓存：重复查询已缓存的名称
+        random.shuffle(names)
+        report("屏蔽服务器（命中缓存）", len(names), *await run_queries(sinkhole.address, names, args.concurrency))
+
+        # 并发合并：大量并发查询同一个未缓存的名称
+        before = upstream.queries
+        names = ["coalesce.example.com"] * args.concurrency
+        report("屏蔽服务器（并发合并）", len(names), *await run_queries(sinkhole.address, names, args.concurrency))
+        print(f"{'':<28} 上游实际收到 {upstream.queries - before} 次查询")
+
+        # 被屏蔽的域名：本地直接应答
+        names = [f"cdn{i}.blocked.test" for i in range(args.queries)]
+        report("屏蔽服务器（被屏蔽域名）", len(names), *await run_queries(sinkhole.address, names, args.concurrency))
+        print(f"统计: {sinkhole.stats}")
+    finally:
+        sinkhole.stop()
+        upstream_transport.close()
+
+
+SAMPLE_HOSTS = "##\n# Host Database\n##\n127.0.0.1\tlocalhost\n255.255.255.255\tbroadcasthost\n::1             localhost\n"
+
+
+def render_with_concatenation(hosts_content, domains):
+    """旧实现：每次同步重新排序，逐行 += 拼接整个字符串"""
+    content = hosts_content.rstrip()
+    content += f"\n\n{MARKER_START}\n"
+    for domain in sorted(domains):
+        content += f"{LOCALHOST_IP} {domain}\n"
+    content += f"{MARKER_END}\n"
+    return content
+
+
+def time_once(func):
+    started = time.perf_counter()
+    func()
+    return time.perf_counter() - started
+
+
+def benchmark_hosts(args):
+    document = HostsDocument.parse(SAMPLE_HOSTS)
+    print(f"{'条目数':>10} {'旧实现(+= 拼接)':>22} {'分块写入(首次排序)':>22} {'分块写入(排序已缓存)':>22}")
+    with tempfile.TemporaryDirectory() as directory:
+        path = f"{directory}/hosts"
+        for size in args.sizes:
+            domains = {f"site{random.randrange(1 << 40):x}-{i}.example.com" for i in range(size)}
+            
+            def write_concatenated():
+                with open(path, 'w', encoding='utf-8', newline='\n') as f:
+                    f.write(render_with_concatenation(SAMPLE_HOSTS, domains))
+            
+            def write_streamed():
+                with open(path, 'wb') as f:
+                    document.write_to(f, domains)
+            
+            concatenated = time_once(write_concatenated)
+            HostsDocument._sort_cache = (frozenset(), [])
+            streamed_cold = time_once(write_streamed)
+            streamed_warm = time_once(write_streamed)
+            
+            # 两种实现写出的文件必须完全一致
+            with open(path, encoding='utf-8') as f:
+                assert f.read() == render_with_concatenation(SAMPLE_HOSTS, domains)
+            
+            cells = [f"{elapsed * 1000:>9.1f} ms {elapsed / size * 1e9:>6.0f} ns/条"
+                     for elapsed in (concatenated, streamed_cold, streamed_warm)]
+            print(f"{size:>10} " + ' '.join(f"{cell:>22}" for cell in cells))
+
+
+def scan_hosts(path, name):
+    """模拟系统解析器查找 hosts 文件：逐行读取，去掉注释后拆分字段，比较每个域名"""
+    with open(path, 'rb') as f:
+        for line in f:
+            fields = line.split(b'#', 1)[0].split()
+            if len(fields) >= 2 and name in fields[1:]:
+                return fields[0]
+    return None
+
+
+def benchmark_lookup(args):
+    document = HostsDocument.parse(SAMPLE_HOSTS)
+    layouts = [("每行 1 个", 1), (f"紧凑(每行 {args.names_per_line} 个)", args.names_per_line)]
+    print(f"{'条目数':>10} {'格式':<16} {'行数':>9} {'文件大小':>10} {'未命中查找':>12} {'命中查找(中间)':>14}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            domains = sorted(f"site{i}.example.com" for i in range(size))
+            middle = domains[size // 2].encode()
+            for title, names_per_line in layouts:
+                path = f"{directory}/hosts-{size}-{names_per_line}"
+                with open(path, 'wb') as f:
+                    document.write_to(f, domains, names_per_line)
+                with HostsDocument.from_file(path) as written:
+                    assert written.entries == set(domains)
+                with open(path, 'rb') as f:
+                    line_count = sum(1 for _ in f)
+                
+                # 多次查找取中位数，文件已在系统缓存中，只比较解析本身的耗时
+                miss = sorted(time_once(lambda: scan_hosts(path, b"missing.example.org")) for _ in range(5))[2]
+                hit = sorted(time_once(lambda: scan_hosts(path, middle)) for _ in range(5))[2]
+                file_size = os.path.getsize(path) / 1024 / 1024
+                print(f"{size:>10} {title:<16} {line_count:>9} {file_size:>8.1f} MB "
+                      f"{miss * 1000:>9.1f} ms {hit * 1000:>11.1f} ms")
+
+
+def benchmark_helper(args):
+    """不经过 sudo 启动特权辅助进程（假后端：只写临时 hosts 文件，不执行系统命令），验证协议并比较每次操作的耗时"""
+    command = [sys.executable, os.path.abspath(kill_domains_mac_simple.__file__)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = f"{directory}/hosts"
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(SAMPLE_HOSTS)
+        
+        started = time.perf_counter()
+        client = PrivilegedHelperClient.launch(command=command, options=['--fake-backend', path])
+        print(f"辅助进程启动 {(time.perf_counter() - started) * 1000:.1f} ms")
+        try:
+            # 协议和各操作的结果
+            assert client.call('ping')['pid'] == client.process.pid
+            client.call('write_hosts_block', entries=['b.example.com', 'a.example.com'])
+            with HostsDocument.from_file(path) as written:
+                assert written.entries == {'a.example.com', 'b.example.com'}
+            assert client.call('replace_pf_table', ips=['192.0.2.1', '192.0.2.2']) == {'count': 2}
+            assert client.call('update_pf_table', add=['192.0.2.3'], delete=['192.0.2.1']) == {'added': 1, 'deleted': 1}
+            assert client.call('replace_pf_table', ips=[]) == {'count': 0}
+            assert client.call('flush_resolver', reset_network_dns=False) == {'failed': []}
+            token, client.token = client.token, 'wrong'
+            try:
+                client.call('ping')
+                raise AssertionError("错误的令牌被接受")
+            except RuntimeError:
+                pass
+            finally:
+                client.token = token
+            client.call('write_hosts_block', entries=[])
+            with HostsDocument.from_file(path) as written:
+                assert not written.has_block
+            with open(path, encoding='utf-8') as f:
+                assert f.read().rstrip() == SAMPLE_HOSTS.rstrip()
+            print("协议验证通过: ping / write_hosts_block / replace_pf_table / update_pf_table / flush_resolver / 令牌校验")
+            
+            latencies = sorted(time_once(lambda: client.call('ping')) for _ in range(args.calls))
+        finally:
+            client.close()
+    
+    # 对比：没有辅助进程时每次操作都要启动一个批处理进程（真实环境中还要加上一次 sudo）
+    batch = PrivilegedBatch()
+    batch.add(['true'])
+    spawned = sorted(time_once(lambda: batch.run(command=command)) for _ in range(max(1, args.calls // 20)))
+    print(f"{'辅助进程（每次请求）':<24} p50 {percentile(latencies, 50) * 1000:>8.2f} ms   "
+          f"p99 {percentile(latencies, 99) * 1000:>8.2f} ms")
+    print(f"{'批处理进程（每次启动）':<24} p50 {percentile(spawned, 50) * 1000:>8.2f} ms   "
+          f"p99 {percentile(spawned, 99) * 1000:>8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DomainKiller 性能基准测试")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    dns_parser = subparsers.add_parser('dns', help="本地 DNS 屏蔽服务器的吞吐量和延迟")
+    dns_parser.add_argument('--queries', type=int, default=20000, help="每轮查询次数")
+    dns_parser.add_argument('--concurrency', type=int, default=64, help="并发查询数")
+    dns_parser.add_argument('--upstream-delay', type=float, default=20, help="假上游的应答延迟（毫秒）")
+
+    hosts_parser = subparsers.add_parser('hosts', help="生成并写入 hosts 屏蔽区块的耗时随条目数的变化")
+    hosts_parser.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')],
+                              default=[1000, 10000, 100000, 1000000], help="逗号分隔的条目数列表")
+    
+    lookup_parser = subparsers.add_parser('lookup', help="逐行格式与紧凑格式的 hosts 文件大小和查找耗时")
+    lookup_parser.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')],
+                               default=[10000, 100000, 500000], help="逗号分隔的条目数列表")
+    lookup_parser.add_argument('--names-per-line', type=int, default=9, help="紧凑格式每行的域名数")
+    
+    helper_parser = subparsers.add_parser('helper', help="用假后端验证特权辅助进程的协议，并比较请求与启动进程的耗时")
+    helper_parser.add_argument('--calls', type=int, default=200, help="测量的请求次数")
+    
+    args = parser.parse_args()
+    if args.command == 'dns':
+        asyncio.run(benchmark_dns(args))
+    elif args.command == 'hosts':
+        benchmark_hosts(args)
+    elif args.command == 'lookup':
+        benchmark_lookup(args)
+    elif args.command == 'helper':
+        benchmark_helper(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,8 +10,14 @@ import os
 import sys
 import json
 import time
+import mmap
+import hashlib
+import shutil
+import tempfile
+import random
 import threading
 import requests
+from requests.adapters import HTTPAdapter
 from pathlib import Path
 
 # 尝试导入 pystray（系统托盘功能，可选）
@@ -30,17 +36,350 @@ import plistlib
 
 # 配置常量
 API_URL = "https://app.walkingcode.com/API/kill-domains.php"
+API_CONNECT_TIMEOUT = 5  # 连接 API 的超时（秒）
+API_READ_TIMEOUT = 10  # 等待 API 响应的超时（秒）
+API_POOL_SIZE = 4  # API 会话最多保持的连接数（同步和密码验证共用）
 DOMAINS_FILE = "domains.txt"
 HOSTS_PATH = "/etc/hosts"
 LOCALHOST_IP = "127.0.0.1"
 CHECK_INTERVAL = 60  # 检查间隔（秒）
+SYNC_MAX_INTERVAL = 300  # 域名列表连续未变化时同步间隔逐次加倍，最长不超过（秒）
+SYNC_RETRY_INTERVAL = 10  # 同步失败后第一次重试的间隔，之后每次失败加倍（秒）
+SYNC_BACKOFF_MAX = 300  # 失败重试间隔的上限（秒）
+SYNC_BREAKER_THRESHOLD = 5  # 连续失败多少次后熔断，暂停请求 API
+SYNC_BREAKER_COOLDOWN = 900  # 熔断后每隔多久试探一次 API（秒）；手动同步不受限制
+SYNC_JITTER = 0.2  # 每次等待时间随机浮动的比例，避免大量客户端同时请求 API
+SYNC_STARTUP_JITTER = 15  # 启动后第一次定时同步前随机等待的最长时间（秒）
 MARKER_START = "# === Kill Domains Start ==="
 MARKER_END = "# === Kill Domains End ==="
+API_CACHE_FILE = "api_cache.json"  # 上次 API 返回的域名列表和 ETag/Last-Modified，用于条件请求和网络故障时回退
+HOSTS_COMPACT = False  # 紧凑格式：每行写入多个域名，hosts 文件更小，系统解析更快
+HOSTS_NAMES_PER_LINE = 16  # 紧凑格式下每行最多写入的域名数（控制单行长度）
 LAUNCH_AGENT_NAME = "com.domainkiller.plist"
 LAUNCH_AGENT_DIR = Path.home() / "Library" / "LaunchAgents"
 LAUNCH_AGENT_PATH = LAUNCH_AGENT_DIR / LAUNCH_AGENT_NAME
 
 
+class HostsDocument:
+    """hosts 文件的结构化表示 - 一次扫描得到同步所需的全部信息，各步骤共用，不再重复解析
+    
+    按字节处理：只查找起止标记的位置并解码屏蔽区块，屏蔽区块之外的原有内容不解码，写回时按字节原样复制，
+    读取几十 MB 的 hosts 文件时内存占用也只与屏蔽区块的大小有关。
+    
+    source         原文（bytes 或只读 mmap）
+    foreign_spans  屏蔽区块之外的内容在原文中的字节范围列表 [(start, end), ...]
+    block_span     第一个屏蔽区块（含起止标记行）在原文中的字节范围 (start, end)，没有屏蔽区块时为 None
+    block_text     屏蔽区块的原文（有多个屏蔽区块时依次拼接）
+    entries        屏蔽区块中被屏蔽的域名集合
+    encoding       屏蔽区块使用的编码，写回时沿用
+    newline        原文使用的换行符（\\n 或 \\r\\n），写回时沿用
+    """
+    
+    __slots__ = ('source', 'foreign_spans', 'block_span', 'block_text', 'entries', 'encoding', 'newline')
+    
+    CHUNK_LINES = 4096  # 生成屏蔽区块时每块包含的行数
+    CHUNK_BYTES = 1024 * 1024  # 复制原有内容时每块的字节数
+    TRAILING_WHITESPACE = b' \t\r\n\x0b\x0c'
+    _sort_cache = (frozenset(), [])  # (上次排序的条目, 排序结果)，各次同步之间复用
+    
+    def __init__(self, source=b'', foreign_spans=(), block_span=None, block_text='', entries=(),
+                 encoding='utf-8', newline='\n'):
+        self.source = source
+        self.foreign_spans = list(foreign_spans)
+        self.block_span = block_span
+        self.block_text = block_text
+        self.entries = set(entries)
+        self.encoding = encoding
+        self.newline = newline
+    
+    @classmethod
+    def from_file(cls, path, encodings=('utf-8',)):
+        """以只读内存映射方式打开并解析 hosts 文件（不把整个文件读入内存）"""
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls.parse_bytes(b'', encodings)
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.parse_bytes(data, encodings)
+    
+    @classmethod
+    def parse(cls, content, encoding='utf-8'):
+        """解析已经读成字符串的 hosts 文件内容"""
+        return cls.parse_bytes(content.encode(encoding), (encoding,))
+    
+    @classmethod
+    def parse_bytes(cls, data, encodings=('utf-8',)):
+        """解析 hosts 文件的原始字节
+        包含标记的整行都算标记行；没有结束标记时，开始标记之后的内容都属于屏蔽区块；
+        屏蔽区块的内容依次尝试 encodings 中的编码解码
+        """
+        start_marker = MARKER_START.encode('ascii')
+        end_marker = MARKER_END.encode('ascii')
+        size = len(data)
+        first_newline = data.find(b'\n')
+        newline = '\r\n' if first_newline > 0 and data[first_newline - 1] == 0x0D else '\n'
+        foreign_spans = []
+        block_parts = []
+        block_span = None
+        position = 0
+        
+        while True:
+            start = data.find(start_marker, position)
+            stray = data.find(end_marker, position, size if start == -1 else start)
+            if stray != -1:
+                # 屏蔽区块之外残留的结束标记行也一并移除
+                line_start, line_end = cls.line_bounds(data, stray, position)
+                foreign_spans.append((position, line_start))
+                position = line_end
+                continue
+            if start == -1:
+                foreign_spans.append((position, size))
+                break
+            
+            line_start, line_end = cls.line_bounds(data, start, position)
+            end = data.find(end_marker, start)
+            if end == -1:
+                line_end = size
+            else:
+                line_end = cls.line_bounds(data, end, position)[1]
+            foreign_spans.append((position, line_start))
+            block_parts.append(data[line_start:line_end])
+            if block_span is None:
+                block_span = (line_start, line_end)
+            position = line_end
+        
+        block = b''.join(block_parts)
+        encoding = encodings[0]
+        for candidate in encodings:
+            try:
+                block_text = block.decode(candidate)
+                encoding = candidate
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            block_text = block.decode(encoding, errors='replace')
+        
+        # 解析格式: 127.0.0.1 domain.com（紧凑格式一行有多个域名: 127.0.0.1 a.com b.com ...）
+        entries = set()
+        for line in block_text.split('\n'):
+            parts = line.split()
+            if len(parts) >= 2 and parts[0] == LOCALHOST_IP:
+                for name in parts[1:]:
+                    if name.startswith('#'):
+                        break
+                    entries.add(name)
+        
+        foreign_spans = [(start, end) for start, end in foreign_spans if end > start]
+        return cls(data, foreign_spans, block_span, block_text, entries, encoding, newline)
+    
+    @staticmethod
+    def line_bounds(data, index, lower):
+        """返回 index 所在行的字节范围 (行首, 下一行行首)，行首不小于 lower"""
+        line_start = data.rfind(b'\n', lower, index) + 1 or lower
+        line_end = data.find(b'\n', index)
+        return line_start, len(data) if line_end == -1 else line_end + 1
+    
+    @property
+    def has_block(self):
+        return self.block_span is not None
+    
+    def close(self):
+        """释放原文（关闭内存映射）；Windows 上映射存在期间不能截断 hosts 文件"""
+        source, self.source = self.source, b''
+        if isinstance(source, mmap.mmap):
+            source.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    @classmethod
+    def sorted_entries(cls, entries):
+        """返回排序后的屏蔽条目；与上次同步的条目相同时直接复用上次的排序结果"""
+        entries = frozenset(entries)
+        cached_entries, cached_order = cls._sort_cache
+        if entries != cached_entries:
+            cached_order = sorted(entries)
+            cls._sort_cache = (entries, cached_order)
+        return cached_order
+    
+    def iter_foreign(self):
+        """逐块返回屏蔽区块之外的原有内容（原样字节，去掉末尾的空白）"""
+        spans = list(self.foreign_spans)
+        while spans:
+            start, end = spans[-1]
+            while end > start and self.source[end - 1] in self.TRAILING_WHITESPACE:
+                end -= 1
+            if end > start:
+                spans[-1] = (start, end)
+                break
+            spans.pop()
+        
+        for start, end in spans:
+            for offset in range(start, end, self.CHUNK_BYTES):
+                yield self.source[offset:min(end, offset + self.CHUNK_BYTES)]
+    
+    def iter_block(self, entries, names_per_line=1):
+        """逐块生成屏蔽区块（含起止标记行，字节）
+        names_per_line 大于 1 时为紧凑格式，每行写入多个域名；每块最多 CHUNK_LINES 行，总耗时与条目数成线性关系
+        """
+        newline = self.newline
+        encoding = self.encoding
+        yield f"{MARKER_START}{newline}".encode(encoding)
+        ordered = self.sorted_entries(entries)
+        prefix = f"{LOCALHOST_IP} "
+        if names_per_line <= 1:
+            separator = newline + prefix
+            for index in range(0, len(ordered), self.CHUNK_LINES):
+                yield (prefix + separator.join(ordered[index:index + self.CHUNK_LINES]) + newline).encode(encoding)
+        else:
+            chunk_names = self.CHUNK_LINES * names_per_line
+            for index in range(0, len(ordered), chunk_names):
+                stop = min(len(ordered), index + chunk_names)
+                lines = [prefix + ' '.join(ordered[start:start + names_per_line])
+                         for start in range(index, stop, names_per_line)]
+                yield (newline.join(lines) + newline).encode(encoding)
+        yield f"{MARKER_END}{newline}".encode(encoding)
+    
+    def iter_chunks(self, entries=None, names_per_line=1):
+        """逐块生成完整的 hosts 内容（字节）：原有内容 + 新的屏蔽区块（entries 为空时只保留原有内容）
+        写文件时不需要先拼出整个内容
+        """
+        yield from self.iter_foreign()
+        if entries:
+            yield (self.newline * 2).encode(self.encoding)
+            yield from self.iter_block(entries, names_per_line)
+    
+    def render_block(self, entries, names_per_line=1):
+        """生成屏蔽区块字符串，可与 block_text 直接比较"""
+        return b''.join(self.iter_block(entries, names_per_line)).decode(self.encoding)
+    
+    def render(self, entries=None, names_per_line=1):
+        """生成完整的 hosts 内容字符串"""
+        return b''.join(self.iter_chunks(entries, names_per_line)).decode(self.encoding, errors='replace')
+    
+    def write_to(self, file, entries=None, names_per_line=1):
+        """把完整的 hosts 内容分块写入以二进制方式打开的文件，返回写入的字节数"""
+        written = 0
+        for chunk in self.iter_chunks(entries, names_per_line):
+            file.write(chunk)
+            written += len(chunk)
+        return written
+
+
+class ApiClient:
+    """API 客户端 - 同步和密码验证共用一个带连接池的会话
+    
+    连接保持 keep-alive，之后的请求不再重新进行 TCP 和 TLS 握手；响应使用 gzip 压缩传输。
+    多个线程同时发出相同的请求时只有第一个真正发送，其余线程等待并共用它的响应（single-flight）。
+    """
+    
+    def __init__(self, url=API_URL, timeout=(API_CONNECT_TIMEOUT, API_READ_TIMEOUT)):
+        self.url = url
+        self.timeout = timeout  # (连接超时, 读取超时)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+        self.lock = threading.Lock()
+        self.in_flight = {}  # 请求键 -> [完成事件, 响应, 异常]
+    
+    def get(self, params=None, headers=None):
+        """发送 GET 请求；相同参数和请求头的请求正在进行时等待并返回它的响应（或抛出它的异常）"""
+        key = (tuple(sorted((params or {}).items())), tuple(sorted((headers or {}).items())))
+        with self.lock:
+            call = self.in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self.in_flight[key] = [threading.Event(), None, None]
+        
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        
+        try:
+            response = self.session.get(self.url, params=params, headers=headers, timeout=self.timeout)
+            response.content  # 读完响应体，连接立即归还连接池，等待的线程也可以直接使用
+            call[1] = response
+            return response
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            call[0].set()
+    
+    def close(self):
+        self.session.close()
+
+
+class SyncScheduler:
+    """同步调度器 - 根据上次同步的结果决定下次同步前等待多久
+    
+    updated       列表有变化：恢复为基础间隔 CHECK_INTERVAL
+    not_modified  列表未变化：间隔逐次加倍，最长 SYNC_MAX_INTERVAL
+    failed        请求失败：从 SYNC_RETRY_INTERVAL 开始指数退避，最长 SYNC_BACKOFF_MAX；
+                  连续失败 SYNC_BREAKER_THRESHOLD 次后熔断，之后每 SYNC_BREAKER_COOLDOWN 秒才试探一次
+    每次等待时间随机浮动 SYNC_JITTER，启动后的首次等待在 0 到 SYNC_STARTUP_JITTER 秒之间随机，
+    避免大量客户端开机后同时请求 API。wake() 立即结束等待（手动同步，熔断时也会请求）。
+    """
+    
+    def __init__(self):
+        self.failures = 0  # 连续失败次数
+        self.unchanged = 0  # 连续未变化次数
+        self.delay = random.uniform(0, SYNC_STARTUP_JITTER)  # 下次同步前等待的秒数
+        self.wake_event = threading.Event()
+    
+    @property
+    def breaker_open(self):
+        return self.failures >= SYNC_BREAKER_THRESHOLD
+    
+    def record(self, outcome):
+        """记录一次同步的结果，返回下次同步前等待的秒数"""
+        if outcome in ('updated', 'not_modified'):
+            if self.breaker_open:
+                print("✅ API 已恢复，恢复定时同步")
+            self.failures = 0
+            if outcome == 'updated':
+                self.unchanged = 0
+                delay = CHECK_INTERVAL
+            else:
+                self.unchanged += 1
+                delay = min(SYNC_MAX_INTERVAL, CHECK_INTERVAL * 2 ** min(self.unchanged - 1, 16))
+        else:
+            self.failures += 1
+            self.unchanged = 0  # 恢复后先按基础间隔同步，尽快拿到故障期间的变化
+            if self.breaker_open:
+                if self.failures == SYNC_BREAKER_THRESHOLD:
+                    print(f"⚠️ API 连续 {self.failures} 次请求失败，暂停请求 {SYNC_BREAKER_COOLDOWN} 秒")
+                delay = SYNC_BREAKER_COOLDOWN
+            else:
+                delay = min(SYNC_BACKOFF_MAX, SYNC_RETRY_INTERVAL * 2 ** (self.failures - 1))
+        self.delay = delay * random.uniform(1 - SYNC_JITTER, 1 + SYNC_JITTER)
+        return self.delay
+    
+    def wait(self, running):
+        """等待到下次同步的时间；running() 返回 False 或被 wake() 唤醒时提前返回"""
+        deadline = time.monotonic() + self.delay
+        while running():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if self.wake_event.wait(min(1, remaining)):
+                self.wake_event.clear()
+                return
+    
+    def wake(self):
+        """立即开始下一次同步"""
+        self.wake_event.set()
+
+
 class DomainKiller:
     def __init__(self):
         self.running = False
@@ -48,9 +387,15 @@ class DomainKiller:
         self.current_domains = set()
         self.script_dir = Path(os.path.dirname(os.path.abspath(__file__)))
         self.domains_file = self.script_dir / DOMAINS_FILE
+        self.api_cache_file = self.script_dir / API_CACHE_FILE
+        self.hosts_names_per_line = HOSTS_NAMES_PER_LINE if HOSTS_COMPACT else 1  # 屏蔽区块每行写入的域名数
         self.window = None
         self.window_thread = None
         self.password = None  # 保存从 API 获取的密码
+        self.sync_scheduler = SyncScheduler()  # 定时同步的调度器
+        self.api_client = ApiClient()  # 同步和密码验证共用的 API 会话
+        self.api_cache = self.load_api_cache()  # 上次 API 响应的缓存（不含密码）
+        self.api_fetch_status = None  # 最近一次获取域名列表的结果：updated / not_modified / cached
         
         # 获取当前可执行文件路径（用于开机启动）
         if getattr(sys, 'frozen', False):
@@ -62,30 +407,94 @@ class DomainKiller:
     
     def fetch_domains_from_api(self):
         """从 API 获取域名列表和密码
+        带上次响应的 ETag/Last-Modified 发送条件请求，返回 304 或内容哈希与上次相同时直接使用缓存的域名列表；
+        网络错误时回退到缓存的域名列表。结果来源记录在 self.api_fetch_status 中
         返回: 成功返回 (domains, password) 元组，失败返回 None
         """
+        cache = self.api_cache
+        headers = self.conditional_headers()
+        conditional = headers is not None
         try:
-            response = requests.get(API_URL, timeout=10)
+            response = self.api_client.get(headers=headers)
+            if conditional and response.status_code == 304:
+                self.api_fetch_status = 'not_modified'
+                return (list(cache['domains']), self.password)
             response.raise_for_status()
+            
+            # 服务器不支持条件请求时按内容哈希判断是否变化
+            content_hash = hashlib.sha256(response.content).hexdigest()
+            if conditional and content_hash == cache.get('content_hash'):
+                self.api_fetch_status = 'not_modified'
+                return (list(cache['domains']), self.password)
+            
             data = response.json()
             
             if data.get("code") == 200 and "data" in data:
                 domains = data["data"].get("domains", [])
                 password = data.get("password", None)  # 获取密码
+                self.save_api_cache(response, content_hash, domains, password)
+                self.api_fetch_status = 'updated'
                 return (domains, password)  # 返回元组
             else:
                 # API 返回了数据，但格式不正确
                 print(f"API 返回格式错误: {data}")
                 return None  # 返回 None 表示失败
         except requests.exceptions.RequestException as e:
-            # 网络错误
+            # 网络错误，回退到上次缓存的域名列表
             print(f"获取域名列表失败（网络错误）: {e}")
+            if 'domains' in cache:
+                print(f"使用上次缓存的域名列表（{len(cache['domains'])} 个域名）")
+                self.api_fetch_status = 'cached'
+                return (list(cache['domains']), self.password)
             return None  # 返回 None 表示失败
         except Exception as e:
             # 其他错误
             print(f"获取域名列表失败: {e}")
             return None  # 返回 None 表示失败
     
+    def conditional_headers(self):
+        """根据上次 API 响应的缓存生成条件请求头（If-None-Match / If-Modified-Since），不能发送条件请求时返回 None"""
+        cache = self.api_cache
+        # 缓存中不保存密码：本进程还没拿到过密码时必须完整请求一次
+        if 'domains' not in cache or (self.password is None and cache.get('has_password')):
+            return None
+        headers = {}
+        if cache.get('etag'):
+            headers['If-None-Match'] = cache['etag']
+        if cache.get('last_modified'):
+            headers['If-Modified-Since'] = cache['last_modified']
+        return headers
+    
+    def load_api_cache(self):
+        """读取上次 API 响应的缓存，文件不存在或损坏时返回空字典"""
+        try:
+            with open(self.api_cache_file, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            if isinstance(cache, dict) and isinstance(cache.get('domains'), list):
+                return cache
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"读取 API 缓存失败: {e}")
+        return {}
+    
+    def save_api_cache(self, response, content_hash, domains, password):
+        """保存 API 响应的验证头、内容哈希和域名列表（不保存密码）"""
+        self.api_cache = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'content_hash': content_hash,
+            'domains': domains,
+            'has_password': bool(password),
+        }
+        try:
+            temp_file = self.api_cache_file.with_name(self.api_cache_file.name + '.tmp')
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.api_cache, f)
+            os.replace(temp_file, self.api_cache_file)
+        except Exception as e:
+            print(f"保存 API 缓存失败: {e}")
+    
     def update_domains_file(self, domains):
         """更新 domains.txt 文件"""
         try:
@@ -148,34 +557,44 @@ class DomainKiller:
             return None
     
     def read_hosts_file(self):
-        """读取 hosts 文件内容（需要 sudo 权限）"""
+        """读取并解析 hosts 文件，返回 HostsDocument，无法读取时返回 None"""
         try:
             # 先尝试直接读取（如果已经有权限）
             try:
-                with open(HOSTS_PATH, 'r', encoding='utf-8') as f:
-                    return f.read()
+                # 以内存映射方式读取，原有内容不解码
+                return HostsDocument.from_file(HOSTS_PATH)
             except PermissionError:
                 pass
             
             # 需要 sudo，使用密码（在后台线程中获取，避免阻塞）
-            # 注意：这里简化处理，如果无法读取，返回空字符串
+            # 注意：这里简化处理，如果无法读取，返回 None（调用方不会写入，避免覆盖原有内容）
             # 实际使用时，应该在需要时才提示密码
             print("提示: 需要管理员权限读取 hosts 文件")
             print("请在需要时手动输入密码")
             
             # 暂时返回空，避免阻塞启动
-            return ""
+            return None
         except Exception as e:
             print(f"读取 hosts 文件失败: {e}")
-            return ""
+            return None
     
-    def write_hosts_file(self, content):
-        """写入 hosts 文件（需要 sudo 权限）"""
+    def write_hosts_file(self, document, domains=None):
+        """写入 hosts 文件（需要 sudo 权限）
+        保留 document 中的原有内容，屏蔽区块替换为 domains（为空时移除屏蔽区块），内容分块写入
+        """
+        staged = None
         try:
+            # 先把完整内容写入临时文件（原有内容按字节从映射中复制），再覆盖 hosts 文件，
+            # 避免截断 hosts 文件后再从它的映射中读取
+            staged = tempfile.TemporaryFile()
+            document.write_to(staged, domains, self.hosts_names_per_line)
+            document.close()
+            
             # 先尝试直接写入（如果已经有权限）
             try:
-                with open(HOSTS_PATH, 'w', encoding='utf-8', newline='\n') as f:
-                    f.write(content)
+                with open(HOSTS_PATH, 'wb') as f:
+                    staged.seek(0)
+                    shutil.copyfileobj(staged, f, HostsDocument.CHUNK_BYTES)
                 return True
             except PermissionError:
                 pass
@@ -189,22 +608,23 @@ class DomainKiller:
                     self.show_error_in_window(error_msg)
                 return False
             
-            # 使用 sudo -S tee 写入 hosts 文件
+            # 使用 sudo -S tee 写入 hosts 文件（tee 的回显直接丢弃，避免大文件时管道写满卡住）
             process = subprocess.Popen(
                 ['sudo', '-S', 'tee', HOSTS_PATH],
                 stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE
             )
-            # 先发送密码，然后发送内容
-            input_data = password + '\n' + content
-            stdout, stderr = process.communicate(input=input_data, timeout=10)
+            # 先发送密码，然后分块发送内容
+            process.stdin.write((password + '\n').encode('utf-8'))
+            staged.seek(0)
+            shutil.copyfileobj(staged, process.stdin, HostsDocument.CHUNK_BYTES)
+            stdout, stderr = process.communicate(timeout=10)
             
             if process.returncode == 0:
                 return True
             else:
-                error_msg = f"写入 hosts 文件失败: {stderr}"
+                error_msg = f"写入 hosts 文件失败: {stderr.decode('utf-8', errors='replace')}"
                 print(error_msg)
                 if self.window:
                     self.show_error_in_window(error_msg)
@@ -221,38 +641,9 @@ class DomainKiller:
             if self.window:
                 self.show_error_in_window(error_msg)
             return False
-    
-    def remove_old_rules(self, hosts_content):
-        """移除旧的屏蔽规则"""
-        lines = hosts_content.split('\n')
-        new_lines = []
-        in_block = False
-        
-        for line in lines:
-            if MARKER_START in line:
-                in_block = True
-                continue
-            if MARKER_END in line:
-                in_block = False
-                continue
-            if not in_block:
-                new_lines.append(line)
-        
-        return '\n'.join(new_lines).rstrip()
-    
-    def add_block_rules(self, hosts_content, domains):
-        """添加屏蔽规则到 hosts 文件"""
-        # 移除旧规则
-        content = self.remove_old_rules(hosts_content)
-        
-        # 添加新规则
-        if domains:
-            content += f"\n\n{MARKER_START}\n"
-            for domain in sorted(domains):
-                content += f"{LOCALHOST_IP} {domain}\n"
-            content += f"{MARKER_END}\n"
-        
-        return content
+        finally:
+            if staged is not None:
+                staged.close()
     
     def block_domains(self, domains):
         """屏蔽域名"""
@@ -262,13 +653,18 @@ class DomainKiller:
         
         try:
             # 读取当前 hosts 文件
-            hosts_content = self.read_hosts_file()
-            
-            # 添加屏蔽规则（会自动移除旧规则）
-            new_content = self.add_block_rules(hosts_content, domains)
+            document = self.read_hosts_file()
+            if document is None:
+                return False
             
-            # 写入 hosts 文件
-            result = self.write_hosts_file(new_content)
+            with document:
+                # 写入 hosts 文件（屏蔽规则没有变化时跳过写入）
+                expected_block = document.render_block(domains, self.hosts_names_per_line)
+                if document.has_block and document.block_text == expected_block:
+                    result = True
+                else:
+                    # 保留原有内容，替换屏蔽区块
+                    result = self.write_hosts_file(document, domains)
             
             if result:
                 # 更新当前域名列表（确保同步）
@@ -290,9 +686,14 @@ class DomainKiller:
     def restore_hosts(self):
         """恢复 hosts 文件，移除所有屏蔽规则"""
         try:
-            hosts_content = self.read_hosts_file()
-            new_content = self.remove_old_rules(hosts_content)
-            return self.write_hosts_file(new_content)
+            document = self.read_hosts_file()
+            if document is None:
+                return False
+            with document:
+                if not document.has_block:
+                    # 没有屏蔽规则，无需重写
+                    return True
+                return self.write_hosts_file(document)
         except Exception as e:
             print(f"恢复 hosts 文件失败: {e}")
             return False
@@ -328,28 +729,9 @@ class DomainKiller:
             if self.window:
                 self.update_status_in_window(f"启动错误: {e}", error=True)
     
-    def extract_domains_from_hosts(self, hosts_content):
-        """从 hosts 文件内容中提取被屏蔽的域名"""
-        domains = set()
-        lines = hosts_content.split('\n')
-        in_block = False
-        
-        for line in lines:
-            if MARKER_START in line:
-                in_block = True
-                continue
-            if MARKER_END in line:
-                in_block = False
-                continue
-            if in_block:
-                # 解析格式: 127.0.0.1 domain.com
-                parts = line.strip().split()
-                if len(parts) >= 2 and parts[0] == LOCALHOST_IP:
-                    domain = parts[1].strip()
-                    if domain:
-                        domains.add(domain)
-        
-        return domains
+    def extract_domains_from_hosts(self, document):
+        """从已解析的 hosts 文件中提取被屏蔽的域名"""
+        return set(document.entries)
     
     def sync_and_block(self):
         """同步域名并屏蔽（从 API 获取最新域名）"""
@@ -366,8 +748,9 @@ class DomainKiller:
             # 保存密码
             if api_password:
                 self.password = api_password
-            # 更新 domains.txt（即使为空也要更新，保持同步）
-            self.update_domains_file(api_domains)
+            # 更新 domains.txt（即使为空也要更新，保持同步）；列表未变化时文件已是最新，不再重写
+            if self.api_fetch_status == 'updated':
+                self.update_domains_file(api_domains)
             self.current_domains = set(api_domains)
         else:
             # API 调用失败（网络错误等），从文件读取
@@ -410,19 +793,25 @@ class DomainKiller:
                 if self.window:
                     self.update_status_in_window(msg, error=True)
     
+    def run_sync(self):
+        """执行一次同步，返回同步结果（updated / not_modified / failed），供调度器决定下次同步的时间"""
+        self.api_fetch_status = None
+        try:
+            self.sync_and_block()
+        except Exception as e:
+            print(f"检查更新失败: {e}")
+            return 'failed'
+        # 网络故障时使用缓存（cached）也算失败，按失败退避
+        status = self.api_fetch_status
+        return status if status in ('updated', 'not_modified') else 'failed'
+    
     def check_and_update(self):
-        """定时检查并更新"""
+        """定时检查并更新（同步间隔由调度器根据上次同步的结果调整，手动同步时立即唤醒）"""
         while self.running:
-            try:
-                self.sync_and_block()
-            except Exception as e:
-                print(f"检查更新失败: {e}")
-            
-            # 等待指定时间
-            for _ in range(CHECK_INTERVAL):
-                if not self.running:
-                    break
-                time.sleep(1)
+            self.sync_scheduler.wait(lambda: self.running)
+            if not self.running:
+                break
+            self.sync_scheduler.record(self.run_sync())
     
     def create_tray_icon(self):
         """创建系统托盘图标"""
@@ -462,8 +851,8 @@ class DomainKiller:
                 self.create_window()
     
     def on_sync(self, icon, item):
-        """立即同步菜单项"""
-        threading.Thread(target=self.sync_and_block, daemon=True).start()
+        """立即同步菜单项（唤醒定时检查线程立即同步）"""
+        self.sync_scheduler.wake()
     
     def on_restore_from_window(self):
         """从主窗口恢复访问（需要密码验证）"""
@@ -550,7 +939,13 @@ class DomainKiller:
         返回: (success, message) 元组，success为True表示密码正确
         """
         try:
-            response = requests.get(API_URL, timeout=10)
+            # 条件请求：域名列表和密码都没有变化时服务器返回 304，不再下载整个列表
+            headers = self.conditional_headers()
+            response = self.api_client.get(headers=headers)
+            if headers is not None and response.status_code == 304:
+                if self.password and input_password == self.password:
+                    return (True, "密码验证成功")
+                return (False, "密码错误")
             response.raise_for_status()
             data = response.json()
             
@@ -714,7 +1109,7 @@ class DomainKiller:
             ttk.Button(
                 button_frame,
                 text="立即同步",
-                command=lambda: threading.Thread(target=self.sync_and_block, daemon=True).start()
+                command=self.sync_scheduler.wake
             ).pack(side=tk.LEFT, padx=5)
             
             ttk.Button(
@@ -1014,16 +1409,7 @@ class DomainKiller:
             
             threading.Thread(target=startup_in_background, daemon=True).start()
             
-            # 首次同步（在后台尝试从 API 获取最新域名）
-            def sync_in_background():
-                try:
-                    self.sync_and_block()
-                except Exception as e:
-                    print(f"同步失败: {e}")
-            
-            threading.Thread(target=sync_in_background, daemon=True).start()
-            
-            # 启动定时检查线程
+            # 启动定时检查线程（首次同步在随机等待几秒后进行，避免开机时所有客户端同时请求 API）
             def check_in_background():
                 try:
                     self.check_and_update()
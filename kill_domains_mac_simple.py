@@ -9,33 +9,248 @@ macOS 网站访问控制程序 - 实时拦截版
 
 import os
 import sys
+import json
 import time
+import mmap
+import hashlib
+import secrets
+import shutil
 import threading
+import asyncio
+import random
+import struct
+import ipaddress
 import requests
+from requests.adapters import HTTPAdapter
 from pathlib import Path
+from collections import OrderedDict
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
 import subprocess
+import select
+import tempfile
 import socket
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import http.client
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse
 
 # 配置常量
 API_URL = "https://app.walkingcode.com/API/kill-domains.php"
+API_CONNECT_TIMEOUT = 5  # 连接 API 的超时（秒）
+API_READ_TIMEOUT = 15  # 等待 API 响应的超时（秒）
+API_POOL_SIZE = 4  # API 会话最多保持的连接数（同步和密码验证共用）
 DOMAINS_FILE = "domains.txt"
 HOSTS_PATH = "/etc/hosts"
 LOCALHOST_IP = "127.0.0.1"
 CHECK_INTERVAL = 60
+SYNC_MAX_INTERVAL = 300  # 域名列表连续未变化时同步间隔逐次加倍，最长不超过（秒）
+SYNC_RETRY_INTERVAL = 10  # 同步失败后第一次重试的间隔，之后每次失败加倍（秒）
+SYNC_BACKOFF_MAX = 300  # 失败重试间隔的上限（秒）
+SYNC_BREAKER_THRESHOLD = 5  # 连续失败多少次后熔断，暂停请求 API
+SYNC_BREAKER_COOLDOWN = 900  # 熔断后每隔多久试探一次 API（秒）；手动同步不受限制
+SYNC_JITTER = 0.2  # 每次等待时间随机浮动的比例，避免大量客户端同时请求 API
+SYNC_STARTUP_JITTER = 15  # 启动后第一次定时同步前随机等待的最长时间（秒）
 MARKER_START = "# === Kill Domains Start ==="
 MARKER_END = "# === Kill Domains End ==="
-PFCTL_RULES_FILE = "/tmp/domainkiller_pfctl_rules.conf"
+HOSTS_COMPACT = False  # 紧凑格式：每行写入多个域名，hosts 文件更小，系统解析更快
+HOSTS_NAMES_PER_LINE = 16  # 紧凑格式下每行最多写入的域名数（控制单行长度）
+HOSTS_WATCH_ENABLED = True  # 监视 hosts 文件，被修改后立即用缓存的屏蔽列表重新应用（不等定时同步）
+HOSTS_WATCH_DEBOUNCE = 0.2  # 一连串修改事件合并为一次处理的静默时间（秒）
+HOSTS_WATCH_POLL_INTERVAL = 2  # 系统不支持文件事件时检查文件状态的间隔（秒）
+PRIVILEGED_HELPER_ENABLED = True  # 启动一次以 root 运行的辅助进程执行特权操作，不再为每个操作单独运行 sudo
+PRIVILEGED_HELPER_START_TIMEOUT = 15  # 等待辅助进程启动完成的最长时间（秒）
+PRIVILEGED_HELPER_CALL_TIMEOUT = 60  # 单个特权操作的最长等待时间（秒）
+SUDO_TRUST_INTERVAL = 300  # sudo 密码确认有效后的信任时间，期间直接使用不再运行 sudo -v 验证（与 sudo 默认的 5 分钟时间戳一致）
+PFCTL_TABLE = "domainkiller"  # 辅助进程使用的 pf 地址表名，屏蔽列表变化时只替换表中的地址
+STATE_FILE = "domainkiller_state.json"  # 记录上次应用的屏蔽列表哈希和 hosts 屏蔽区块哈希，内容不变时跳过整个应用流程
+API_CACHE_FILE = "domainkiller_api_cache.json"  # 上次 API 返回的域名列表和 ETag/Last-Modified，用于条件请求和网络故障时回退
+DNS_BACKUP_FILE = "domainkiller_dns_backup.json"  # 系统 DNS 切换到本地屏蔽服务器前各网络服务原有的 DNS 设置，异常退出后仍能恢复
+RESOLVE_CACHE_FILE = "domainkiller_resolve_cache.json"  # pfctl 使用的域名解析结果（IP、过期时间、首次/最近出现时间），重启后不必全部重新解析
 PROXY_PORT = 8888  # 本地代理服务器端口
+PROXY_MODE = "pac"  # pac: 通过自动代理脚本只让被屏蔽的域名经过代理; global: 所有 HTTP/HTTPS 流量都经过代理
+PAC_PATH = "/proxy.pac"  # 代理服务器提供 PAC 脚本的路径
+# 逐跳头部：只对单个连接有效，代理转发时不能透传
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-connection', 'proxy-authenticate',
+    'proxy-authorization', 'te', 'trailer', 'transfer-encoding', 'upgrade', 'expect',
+])
+PROXY_MAX_CONNECTIONS = 256  # 代理服务器最大并发连接数
+PROXY_MAX_TUNNELS = 1024  # 最大同时存在的 HTTPS 隧道数
+PROXY_BUFFER_SIZE = 64 * 1024  # HTTP 响应转发缓冲区大小，即单个连接转发时的内存上限（字节）
+PROXY_KEEPALIVE_TIMEOUT = 30  # 客户端 keep-alive 连接空闲超时（秒）
+PROXY_POOL_MAX_PER_HOST = 6  # 每个上游 (host, port) 最多保留的空闲连接数
+PROXY_POOL_IDLE_TIMEOUT = 30  # 上游空闲连接保留时间（秒）
+TUNNEL_BUFFER_SIZE = 16 * 1024  # 每个隧道每个方向的转发缓冲区大小（字节）
+TUNNEL_IDLE_TIMEOUT = 300  # 隧道双向都没有数据时自动关闭的超时时间（秒）
+ENFORCEMENT_BACKEND = "hosts"  # hosts: 改写 hosts 文件屏蔽; dns: 使用本地 DNS 屏蔽服务器（不改写 hosts，不重启 DNS 服务）
+DNS_LISTEN_ADDRESS = "127.0.0.1"  # 本地 DNS 屏蔽服务器监听地址
+DNS_LISTEN_PORT = 53  # 本地 DNS 屏蔽服务器端口（UDP 和 TCP）
+DNS_UPSTREAM_SERVERS = [("223.5.5.5", 53), ("119.29.29.29", 53)]  # 未屏蔽域名转发到的上游 DNS（按顺序尝试）；读不到系统 DNS 配置时解析 pfctl 的 IP 也使用它
+DNS_UPSTREAM_TIMEOUT = 3  # 单个上游服务器的查询超时（秒）
+DNS_CACHE_SIZE = 10000  # 转发结果 LRU 缓存的最大条目数
+DNS_NEGATIVE_TTL = 30  # 不存在的域名/空应答最多缓存的秒数
+DNS_MAX_CLIENT_TTL = 10  # 返回给系统的 TTL 上限，保证屏蔽列表变化后系统缓存很快失效
+RESOLV_CONF_PATH = "/etc/resolv.conf"  # 系统解析器配置（macOS 按当前网络自动生成），解析 pfctl 需要拦截的 IP 时使用其中的 DNS 服务器
+RESOLVE_CONCURRENCY = 32  # 解析 pfctl 需要拦截的 IP 时同时进行的 DNS 查询数
+RESOLVE_DEADLINE = 20  # 一次解析全部域名的总时限（秒），未完成的域名在下次同步时重新解析
+RESOLVE_MIN_TTL = 60  # 解析结果至少缓存的秒数（记录的 TTL 更短时按此计算）
+RESOLVE_MAX_TTL = 86400  # 解析结果最多缓存的秒数
+RESOLVE_GRACE_PERIOD = 3600  # 域名不再解析到某个 IP 后，该 IP 继续保留在拦截列表中的时间（秒），应对 CDN 轮换
+DNS_BLOCK_RESPONSE = "null"  # null: 被屏蔽的域名解析到 0.0.0.0 / ::; nxdomain: 返回域名不存在
+
+
+class DomainMatcher:
+    """域名匹配器 - 按域名后缀哈希查找，单次匹配只与域名的标签数有关，与规则数量无关
+    
+    规则格式:
+        example.com      屏蔽 example.com 及其所有子域名
+        *.example.com    只屏蔽 example.com 的子域名
+    以 www. 开头的规则同时屏蔽去掉 www. 后的主域名（及其子域名）。
+    匹配器创建后不再修改：屏蔽列表变化时用 updated() 按新增和移除的域名生成新的匹配器，
+    由调用方一次替换引用，代理线程和 DNS 屏蔽服务器不会看到只更新了一半的规则。
+    """
+    
+    __slots__ = ('suffixes', 'wildcards', 'counts')
+    
+    def __init__(self, domains=()):
+        self.suffixes = frozenset()  # 匹配自身及所有子域名
+        self.wildcards = frozenset()  # 只匹配子域名
+        self.counts = {}  # (规则, 类型) -> 对应该规则的域名数（www.a.com 和 a.com 对应同一条规则）
+        if domains:
+            self.counts, self.suffixes, self.wildcards, _ = self.compute(domains, ())
+    
+    @staticmethod
+    def parse_rule(domain):
+        """把域名规范化为 (规则, 类型)，类型 1 匹配自身及子域名，2 只匹配子域名；无效时返回 None"""
+        rule = domain.strip().lower().rstrip('.')
+        if rule.startswith('*.'):
+            rule = rule[2:]
+            return (rule, 2) if rule else None
+        if rule.startswith('www.') and '.' in rule[4:]:
+            rule = rule[4:]
+        return (rule, 1) if rule else None
+    
+    def compute(self, added, removed):
+        """计算应用新增和移除的域名后的 (counts, suffixes, wildcards, 规则发生变化的名称)，不修改当前匹配器"""
+        counts = dict(self.counts)
+        gone = (set(), set())  # 类型 1 / 2 中不再有域名对应的规则
+        new = (set(), set())  # 类型 1 / 2 中新出现的规则
+        for domain in removed:
+            key = self.parse_rule(domain)
+            if key not in counts:
+                continue
+            counts[key] -= 1
+            if not counts[key]:
+                del counts[key]
+                gone[key[1] - 1].add(key[0])
+        for domain in added:
+            key = self.parse_rule(domain)
+            if key is None:
+                continue
+            if key in counts:
+                counts[key] += 1
+                continue
+            counts[key] = 1
+            new[key[1] - 1].add(key[0])
+        suffixes = (self.suffixes - gone[0]) | new[0]
+        wildcards = (self.wildcards - gone[1]) | new[1]
+        return counts, suffixes, wildcards, gone[0] | gone[1] | new[0] | new[1]
+    
+    def updated(self, added=(), removed=()):
+        """返回 (应用新增和移除的域名后的新匹配器, 规则发生变化的名称集合)，变化的名称用于增量更新 PAC 脚本"""
+        matcher = DomainMatcher()
+        matcher.counts, matcher.suffixes, matcher.wildcards, changed = self.compute(added, removed)
+        return matcher, changed
+    
+    def __len__(self):
+        return len(self.suffixes) + len(self.wildcards)
+    
+    def match(self, host):
+        """检查主机名是否命中规则"""
+        if not host:
+            return False
+        host = host.lower().rstrip('.')
+        suffixes = self.suffixes
+        wildcards = self.wildcards
+        if host in suffixes:
+            return True
+        # 依次检查每一级父域名: a.b.example.com -> b.example.com -> example.com -> com
+        dot = host.find('.')
+        while dot >= 0:
+            parent = host[dot + 1:]
+            if parent in suffixes or parent in wildcards:
+                return True
+            dot = host.find('.', dot + 1)
+        return False
+
+
+class PacGenerator:
+    """PAC 脚本生成器 - 只把被屏蔽的域名交给本地代理，其余流量直连
+    
+    生成的脚本与 DomainMatcher 使用相同的后缀匹配规则，浏览器端每次判断只与
+    域名的标签数有关。每条规则的 JS 片段会被缓存，更新时只为新增规则生成片段。
+    """
+    
+    SCRIPT_HEAD = (
+        "// DomainKiller PAC - Auto Generated\n"
+        "// 1: 域名及其子域名走代理; 2: 只有子域名走代理\n"
+    )
+    SCRIPT_TAIL = (
+        "\n};\n"
+        "function FindProxyForURL(url, host) {\n"
+        "    host = host.toLowerCase();\n"
+        "    if (host.charAt(host.length - 1) == \".\") host = host.substring(0, host.length - 1);\n"
+        "    if (RULES[host] === 1) return PROXY;\n"
+        "    var dot = host.indexOf(\".\");\n"
+        "    while (dot >= 0) {\n"
+        "        var rule = RULES[host.substring(dot + 1)];\n"
+        "        if (rule === 1 || rule === 2) return PROXY;\n"
+        "        dot = host.indexOf(\".\", dot + 1);\n"
+        "    }\n"
+        "    return \"DIRECT\";\n"
+        "}\n"
+    )
+    
+    def __init__(self, proxy_address):
+        self.proxy_line = f'var PROXY = "PROXY {proxy_address}";\n'
+        self.version = 0
+        self._kinds = {}  # 域名 -> 1/2
+        self._fragments = {}  # 域名 -> 缓存的 JS 片段
+        self.script = self._render()
+    
+    def patch(self, matcher, names):
+        """只重新生成 names（DomainMatcher.updated 返回的变化名称）的片段，返回脚本是否发生变化"""
+        changed = False
+        for name in names:
+            kind = 1 if name in matcher.suffixes else 2 if name in matcher.wildcards else None
+            if kind == self._kinds.get(name):
+                continue
+            changed = True
+            if kind is None:
+                del self._kinds[name]
+                del self._fragments[name]
+            else:
+                self._kinds[name] = kind
+                self._fragments[name] = f"{json.dumps(name)}:{kind}"
+        if changed:
+            self.version += 1
+            self.script = self._render()
+        return changed
+    
+    def _render(self):
+        return (self.SCRIPT_HEAD + self.proxy_line + "var RULES = {\n"
+                + ",\n".join(self._fragments.values()) + self.SCRIPT_TAIL).encode('utf-8')
 
 
 class BlockingProxyHandler(BaseHTTPRequestHandler):
     """HTTP 代理服务器处理器 - 拦截被屏蔽的域名"""
     
-    blocked_domains = set()  # 被屏蔽的域名集合
+    protocol_version = "HTTP/1.1"  # 支持客户端 keep-alive
+    timeout = PROXY_KEEPALIVE_TIMEOUT  # 客户端空闲连接超时
+    matcher = DomainMatcher()  # 被屏蔽域名的匹配器（与 DNS 屏蔽服务器共用，屏蔽列表变化时整体替换引用）
+    pac_generator = PacGenerator(f"127.0.0.1:{PROXY_PORT}")  # PAC 脚本（屏蔽列表变化时增量更新）
+    upstream_pool = None  # 上游连接池（所有连接共享）
+    relay_buffer = None  # 当前连接的转发缓冲区（首次转发时分配）
     
     def do_GET(self):
         """处理 GET 请求"""
@@ -52,6 +267,11 @@ class BlockingProxyHandler(BaseHTTPRequestHandler):
     def handle_request(self):
         """处理 HTTP 请求"""
         try:
+            # 直接访问代理本身的 PAC 地址（非代理请求）
+            if self.path.split('?', 1)[0] == PAC_PATH:
+                self.send_pac_script()
+                return
+            
             # 解析请求 URL
             url = self.path
             if url.startswith('http://'):
@@ -93,34 +313,41 @@ class BlockingProxyHandler(BaseHTTPRequestHandler):
             self.send_error(500, str(e))
     
     def is_blocked(self, host):
-        """检查域名是否被屏蔽"""
-        if not host:
+        """检查域名是否被屏蔽（包括子域名）"""
+        return self.matcher.match(host)
+    
+    def has_request_body(self):
+        """请求是否带有请求体（Content-Length 不为 0 或分块传输）"""
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            return True
+        length = self.headers.get('Content-Length')
+        if length is None:
             return False
-        
-        # 检查完整域名
-        if host in self.blocked_domains:
+        try:
+            return int(length) != 0
+        except ValueError:
             return True
-        
-        # 检查域名变体（如 www.domain.com 和 domain.com）
-        parts = host.split('.')
-        if len(parts) >= 2:
-            # 检查去掉 www 后的域名
-            if parts[0] == 'www' and len(parts) > 2:
-                base_domain = '.'.join(parts[1:])
-                if base_domain in self.blocked_domains:
-                    return True
-            # 检查添加 www 后的域名
-            www_domain = 'www.' + host
-            if www_domain in self.blocked_domains:
-                return True
-        
-        return False
+    
+    def close_if_request_body(self):
+        """不读取请求体直接响应时关闭连接，否则 keep-alive 连接上的请求体会被当作下一个请求解析"""
+        if self.has_request_body():
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+    
+    def send_pac_script(self):
+        """返回自动代理配置（PAC）脚本"""
+        body = self.pac_generator.script
+        self.send_response(200)
+        self.close_if_request_body()
+        self.send_header('Content-Type', 'application/x-ns-proxy-autoconfig')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
     
     def send_blocked_response(self):
         """发送屏蔽响应"""
-        self.send_response(403)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.end_headers()
         blocked_html = """
         <!DOCTYPE html>
         <html>
@@ -138,10 +365,16 @@ class BlockingProxyHandler(BaseHTTPRequestHandler):
         </body>
         </html>
         """
-        self.wfile.write(blocked_html.encode('utf-8'))
+        body = blocked_html.encode('utf-8')
+        self.send_response(403)
+        self.close_if_request_body()
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
     
     def forward_request(self):
-        """转发 HTTP 请求到目标服务器"""
+        """转发 HTTP 请求到目标服务器（复用上游 keep-alive 连接，流式转发请求体和响应体）"""
         try:
             # 解析目标 URL
             url = self.path
@@ -150,116 +383,185 @@ class BlockingProxyHandler(BaseHTTPRequestHandler):
             
             parsed = urlparse(url)
             host = parsed.netloc or parsed.path.split('/')[0]
+            host_header = host
             port = 80
             if ':' in host:
                 host, port_str = host.split(':')
                 port = int(port_str)
             
-            # 连接到目标服务器
+            # 保留查询字符串
+            path = parsed.path or '/'
+            if parsed.query:
+                path += '?' + parsed.query
+            
+            if self.relay_buffer is None:
+                self.relay_buffer = bytearray(PROXY_BUFFER_SIZE)
+            
+            relayed = False  # 是否已经向客户端发送过响应数据
+            conn, reused = self.upstream_pool.acquire(host, port)
             try:
-                target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                target_socket.settimeout(10)
-                target_socket.connect((host, port))
-                
-                # 构建请求
-                request_line = f"{self.command} {parsed.path or '/'} HTTP/1.1\r\n"
-                headers = f"Host: {host}\r\n"
-                headers += "Connection: close\r\n"
-                
-                # 转发原始请求头（除了 Host）
-                for header, value in self.headers.items():
-                    if header.lower() != 'host' and header.lower() != 'connection':
-                        headers += f"{header}: {value}\r\n"
-                
-                request = request_line + headers + "\r\n"
-                
-                # 发送请求
-                target_socket.sendall(request.encode())
-                
-                # 接收响应并转发
-                response_data = b''
-                while True:
-                    chunk = target_socket.recv(4096)
-                    if not chunk:
-                        break
-                    response_data += chunk
+                has_body = self.has_request_body()
+                try:
+                    self.send_upstream_request(conn, path, host_header)
+                    response = conn.getresponse()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    # 池中的空闲连接可能已被服务器关闭，无请求体时换新连接重试一次
+                    if not reused or has_body:
+                        raise
+                    conn.close()
+                    conn = http.client.HTTPConnection(host, port, timeout=10)
+                    self.send_upstream_request(conn, path, host_header)
+                    response = conn.getresponse()
                 
-                target_socket.close()
+                relayed = True
+                self.relay_response(response)
                 
-                # 发送响应给客户端
-                self.wfile.write(response_data)
+                if response.will_close:
+                    conn.close()
+                else:
+                    self.upstream_pool.release(host, port, conn)
             except Exception as e:
+                conn.close()
                 print(f"转发请求失败: {e}")
-                self.send_error(502, f"Proxy error: {str(e)}")
+                # 响应已部分发出时无法再发送错误页，直接断开连接
+                if relayed:
+                    self.close_connection = True
+                else:
+                    self.send_error(502, f"Proxy error: {str(e)}")
         except Exception as e:
             print(f"转发请求异常: {e}")
             self.send_error(502, f"Proxy error: {str(e)}")
     
+    def send_upstream_request(self, conn, path, host_header):
+        """向上游发送请求头，并流式转发客户端的请求体"""
+        chunked = 'chunked' in self.headers.get('Transfer-Encoding', '').lower()
+        conn.putrequest(self.command, path, skip_host=True, skip_accept_encoding=True)
+        conn.putheader('Host', host_header)
+        for header, value in self.headers.items():
+            name = header.lower()
+            if name == 'host' or name in HOP_BY_HOP_HEADERS:
+                continue
+            if chunked and name == 'content-length':
+                continue
+            conn.putheader(header, value)
+        if chunked:
+            conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+        
+        view = memoryview(self.relay_buffer)
+        if chunked:
+            # 分块请求体按原样转发，直到结束块和尾部头
+            while True:
+                size_line = self.rfile.readline(65537)
+                conn.send(size_line)
+                size = int(size_line.split(b';', 1)[0].strip() or b'0', 16)
+                if size == 0:
+                    while True:
+                        trailer = self.rfile.readline(65537)
+                        conn.send(trailer)
+                        if trailer in (b'\r\n', b'\n', b''):
+                            return
+                remaining = size + 2  # 块数据及其后的 CRLF
+                while remaining > 0:
+                    n = self.rfile.readinto(view[:min(remaining, len(view))])
+                    if not n:
+                        raise ConnectionError("客户端请求体不完整")
+                    conn.send(view[:n])
+                    remaining -= n
+        else:
+            remaining = int(self.headers.get('Content-Length', 0) or 0)
+            while remaining > 0:
+                n = self.rfile.readinto(view[:min(remaining, len(view))])
+                if not n:
+                    raise ConnectionError("客户端请求体不完整")
+                conn.send(view[:n])
+                remaining -= n
+    
+    def relay_response(self, response):
+        """把上游响应流式转发给客户端（复用同一个缓冲区，按客户端协议重新分帧）"""
+        no_body = (self.command == 'HEAD' or response.status in (204, 304)
+                   or 100 <= response.status < 200)
+        chunked = False
+        
+        self.send_response_only(response.status, response.reason)
+        for header, value in response.getheaders():
+            name = header.lower()
+            if name in HOP_BY_HOP_HEADERS:
+                continue
+            if name == 'content-length' and response.chunked:
+                continue
+            self.send_header(header, value)
+        if not no_body and response.length is None:
+            # 上游没有给出长度：HTTP/1.1 客户端改用分块编码，否则以关闭连接表示结束
+            if self.request_version == 'HTTP/1.1':
+                chunked = True
+                self.send_header('Transfer-Encoding', 'chunked')
+            else:
+                self.close_connection = True
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        
+        view = memoryview(self.relay_buffer)
+        while True:
+            n = response.readinto(self.relay_buffer)
+            if not n:
+                break
+            if chunked:
+                self.wfile.write(f"{n:x}\r\n".encode())
+                self.wfile.write(view[:n])
+                self.wfile.write(b"\r\n")
+            else:
+                self.wfile.write(view[:n])
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+    
     def forward_https_request(self, host_port):
-        """转发 HTTPS CONNECT 请求"""
+        """转发 HTTPS CONNECT 请求（隧道建立后交给 TunnelSplicer 转发，不占用处理线程）"""
+        # 隧道接管连接后不能再在该连接上处理后续请求
+        self.close_connection = True
         try:
             # 解析目标地址
             if ':' in host_port:
-                host, port_str = host_port.split(':')
+                host, port_str = host_port.rsplit(':', 1)
                 port = int(port_str)
             else:
                 host = host_port
                 port = 443
             
-            # 连接到目标服务器
+            splicer = self.server.tunnel_splicer
+            if not splicer.try_acquire():
+                print(f"⚠️ HTTPS 隧道数已达上限 {splicer.max_tunnels}，拒绝 {host_port}")
+                self.send_error(503, "Too many tunnels")
+                return
+            
+            spliced = False
             try:
-                target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                target_socket.settimeout(10)
-                target_socket.connect((host, port))
-                
-                # 发送 200 Connection Established 响应
-                self.send_response(200, 'Connection Established')
-                self.end_headers()
-                
-                # 建立双向隧道（使用线程）
-                import threading
-                client_socket = self.connection
-                tunnel_active = threading.Event()
-                tunnel_active.set()
-                
-                def forward_to_target():
-                    try:
-                        while tunnel_active.is_set():
-                            data = client_socket.recv(4096)
-                            if not data:
-                                break
-                            target_socket.sendall(data)
-                    except:
-                        pass
-                    finally:
-                        tunnel_active.clear()
-                
-                def forward_to_client():
-                    try:
-                        while tunnel_active.is_set():
-                            data = target_socket.recv(4096)
-                            if not data:
-                                break
-                            client_socket.sendall(data)
-                    except:
-                        pass
-                    finally:
-                        tunnel_active.clear()
+                # 连接到目标服务器
+                try:
+                    target_socket = socket.create_connection((host, port), timeout=10)
+                except Exception as e:
+                    print(f"转发 HTTPS 请求失败: {e}")
+                    self.send_error(502, f"HTTPS Proxy error: {str(e)}")
+                    return
                 
-                # 启动转发线程
-                t1 = threading.Thread(target=forward_to_target, daemon=True)
-                t2 = threading.Thread(target=forward_to_client, daemon=True)
-                t1.start()
-                t2.start()
+                try:
+                    # 发送 200 Connection Established 响应
+                    self.send_response(200, 'Connection Established')
+                    self.end_headers()
+                except Exception:
+                    target_socket.close()
+                    raise
                 
-                # 等待线程结束
-                t1.join(timeout=300)  # 5分钟超时
-                t2.join(timeout=300)
-                tunnel_active.clear()
-                target_socket.close()
-            except Exception as e:
-                print(f"转发 HTTPS 请求失败: {e}")
-                self.send_error(502, f"HTTPS Proxy error: {str(e)}")
+                # 交给隧道引擎双向转发，由引擎负责关闭两端 socket 并归还名额
+                spliced = splicer.splice(self.connection, target_socket)
+                if spliced:
+                    self.server.detach_request(self.connection)
+                else:
+                    target_socket.close()
+            finally:
+                if not spliced:
+                    splicer.release()
         except Exception as e:
             print(f"转发 HTTPS 请求异常: {e}")
             self.send_error(502, f"HTTPS Proxy error: {str(e)}")
@@ -269,119 +571,2174 @@ class BlockingProxyHandler(BaseHTTPRequestHandler):
         pass
 
 
-class DomainKiller:
-    def __init__(self):
-        self.running = False
-        self.current_domains = set()
+class UpstreamConnectionPool:
+    """上游 HTTP 连接池 - 按 (host, port) 复用 keep-alive 连接"""
+    
+    def __init__(self, max_per_host=PROXY_POOL_MAX_PER_HOST, idle_timeout=PROXY_POOL_IDLE_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._idle = {}  # (host, port) -> [(连接, 放回时间), ...]，末尾是最近放回的
+        self._lock = threading.Lock()
+    
+    def acquire(self, host, port):
+        """取出一个空闲连接，没有则新建，返回 (连接, 是否复用)"""
+        key = (host, port)
+        now = time.monotonic()
+        expired = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                candidate, released_at = idle.pop()
+                if now - released_at < self.idle_timeout:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+            if idle is not None and not idle:
+                del self._idle[key]
+        for candidate in expired:
+            candidate.close()
+        if conn is not None:
+            return conn, True
+        return http.client.HTTPConnection(host, port, timeout=10), False
+    
+    def release(self, host, port, conn):
+        """归还连接，超过每个主机的空闲上限时直接关闭"""
+        key = (host, port)
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            # 顺便清理队头已超时的连接
+            while idle and now - idle[0][1] >= self.idle_timeout:
+                expired.append(idle.pop(0)[0])
+            if len(idle) < self.max_per_host:
+                idle.append((conn, now))
+                conn = None
+        for candidate in expired:
+            candidate.close()
+        if conn is not None:
+            conn.close()
+    
+    def close_all(self):
+        """关闭所有空闲连接"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
+
+
+class TunnelSplicer:
+    """HTTPS 隧道转发引擎 - 在单个事件循环线程中转发所有 CONNECT 隧道
+    
+    每个隧道每个方向只占用一个固定大小的缓冲区，线程数和内存不随隧道数量增长。
+    一端关闭发送（EOF）时向另一端发送半关闭，另一方向继续转发直到结束。
+    """
+    
+    def __init__(self, max_tunnels=PROXY_MAX_TUNNELS, buffer_size=TUNNEL_BUFFER_SIZE,
+                 idle_timeout=TUNNEL_IDLE_TIMEOUT):
+        self.max_tunnels = max_tunnels
+        self.buffer_size = buffer_size
+        self.idle_timeout = idle_timeout
+        self.active_tunnels = 0
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+    
+    def start(self):
+        """启动事件循环线程"""
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._run_loop, args=(self._loop,), daemon=True)
+            self._thread.start()
+    
+    def stop(self):
+        """停止事件循环并关闭所有隧道"""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = None
+            self._thread = None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), loop)
+        thread.join(timeout=5)
+    
+    def try_acquire(self):
+        """预留一个隧道名额（检查和计数在同一次加锁中完成），返回 False 表示引擎未运行或隧道数已满
+        预留成功后必须调用 splice 把名额交给隧道，或者调用 release 归还
+        """
+        with self._lock:
+            if self._loop is None or self.active_tunnels >= self.max_tunnels:
+                return False
+            self.active_tunnels += 1
+            return True
+    
+    def release(self):
+        """归还一个隧道名额"""
+        with self._lock:
+            self.active_tunnels -= 1
+    
+    def splice(self, client_socket, target_socket):
+        """用 try_acquire 预留的名额开始转发一对已连接的 socket，返回 False 表示引擎已停止（名额仍由调用方归还）"""
+        with self._lock:
+            loop = self._loop
+        if loop is None:
+            return False
+        client_socket.setblocking(False)
+        target_socket.setblocking(False)
+        asyncio.run_coroutine_threadsafe(self._run_tunnel(client_socket, target_socket), loop)
+        return True
+    
+    def _run_loop(self, loop):
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+    
+    async def _shutdown(self):
+        current = asyncio.current_task()
+        tasks = [task for task in asyncio.all_tasks() if task is not current]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        asyncio.get_running_loop().stop()
+    
+    async def _run_tunnel(self, client_socket, target_socket):
+        loop = asyncio.get_running_loop()
+        last_active = [loop.time()]  # 两个方向共享的最近活动时间
+        tasks = [
+            loop.create_task(self._pipe(client_socket, target_socket, last_active)),
+            loop.create_task(self._pipe(target_socket, client_socket, last_active)),
+        ]
+        try:
+            # 任一方向出错（连接重置、空闲超时）立即结束整个隧道
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for sock in (client_socket, target_socket):
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+            self.release()
+    
+    async def _pipe(self, source, dest, last_active):
+        loop = asyncio.get_running_loop()
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        while True:
+            try:
+                n = await asyncio.wait_for(loop.sock_recv_into(source, buffer), self.idle_timeout)
+            except asyncio.TimeoutError:
+                # 另一方向仍有数据时不算空闲
+                if loop.time() - last_active[0] >= self.idle_timeout:
+                    raise
+                continue
+            if not n:
+                break
+            last_active[0] = loop.time()
+            await loop.sock_sendall(dest, view[:n])
+        # 半关闭：源端不会再发送数据，通知目的端
+        try:
+            dest.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+class ConcurrentProxyServer(ThreadingHTTPServer):
+    """多线程代理服务器 - 每个连接一个线程，并限制最大并发连接数"""
+    
+    daemon_threads = True
+    allow_reuse_address = True
+    block_on_close = False
+    SATURATED_RESPONSE = (b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n"
+                          b"Retry-After: 1\r\nConnection: close\r\n\r\n")
+    
+    def __init__(self, server_address, handler_class, max_connections=PROXY_MAX_CONNECTIONS):
+        super().__init__(server_address, handler_class)
+        self.max_connections = max_connections
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+        self.detached_requests = set()  # 已交给隧道引擎、不应由服务器关闭的连接
+        self.detached_lock = threading.Lock()
+        self.tunnel_splicer = TunnelSplicer()
+        self.tunnel_splicer.start()
+        if handler_class.upstream_pool is None:
+            handler_class.upstream_pool = UpstreamConnectionPool()
+    
+    def process_request(self, request, client_address):
+        """为新连接分配线程；达到上限时立即返回 503 并关闭连接
+        不在接受连接的线程中等待槽位：keep-alive 空闲连接会一直占用槽位，等待会让所有新连接卡住
+        """
+        if not self.connection_slots.acquire(blocking=False):
+            print(f"⚠️ 代理连接数已达上限 {self.max_connections}，拒绝来自 {client_address} 的连接")
+            try:
+                request.settimeout(1)
+                request.sendall(self.SATURATED_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self.connection_slots.release()
+            raise
+    
+    def process_request_thread(self, request, client_address):
+        """处理完连接后释放槽位"""
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.connection_slots.release()
+    
+    def detach_request(self, request):
+        """标记连接已被接管，处理线程结束时不关闭该连接"""
+        with self.detached_lock:
+            self.detached_requests.add(request)
+    
+    def shutdown_request(self, request):
+        with self.detached_lock:
+            if request in self.detached_requests:
+                self.detached_requests.discard(request)
+                return
+        super().shutdown_request(request)
+    
+    def server_close(self):
+        super().server_close()
+        self.tunnel_splicer.stop()
+        if self.RequestHandlerClass.upstream_pool is not None:
+            self.RequestHandlerClass.upstream_pool.close_all()
+
+
+class DnsSinkhole:
+    """本地 DNS 屏蔽服务器 - 被屏蔽的域名（含子域名）直接返回 0.0.0.0 或 NXDOMAIN，其余转发到上游
+    
+    转发结果按 TTL 缓存在 LRU 中，同一名称的并发查询只向上游发送一次。
+    所有查询在单个事件循环线程中处理；屏蔽列表通过整体替换 DomainMatcher 即时生效。
+    """
+    
+    QTYPE_A = 1
+    QTYPE_AAAA = 28
+    QTYPE_OPT = 41
+    RCODE_SERVFAIL = 2
+    RCODE_NXDOMAIN = 3
+    RCODE_NOTIMP = 4
+    
+    def __init__(self, listen_address=(DNS_LISTEN_ADDRESS, DNS_LISTEN_PORT),
+                 upstream_servers=DNS_UPSTREAM_SERVERS, cache_size=DNS_CACHE_SIZE):
+        self.listen_address = listen_address
+        self.upstream_servers = list(upstream_servers)
+        self.cache_size = cache_size
+        self.matcher = DomainMatcher()
+        self.stats = {'queries': 0, 'blocked': 0, 'cache_hits': 0, 'forwarded': 0, 'coalesced': 0, 'failed': 0}
+        self.address = None  # 实际监听的地址（端口为 0 时由系统分配）
+        self._cache = OrderedDict()  # (名称, 类型, 类) -> (应答, [(TTL 偏移, 原始 TTL)], 缓存时间, 过期时间)
+        self._inflight = {}  # 正在向上游查询的键 -> Future
+        self._pending = {}  # 上游查询 ID -> Future
+        self._tasks = set()
+        self._loop = None
+        self._thread = None
+        self._udp_transport = None
+        self._upstream_transport = None
+        self._tcp_server = None
+    
+    def update(self, matcher):
+        """替换屏蔽规则（原子替换引用，立即生效）"""
+        self.matcher = matcher
+    
+    def start(self):
+        """在后台线程中启动 UDP/TCP 服务，监听失败时抛出异常"""
+        if self._loop is not None:
+            return
+        loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=loop.run_forever, daemon=True)
+        self._thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(self._start_servers(), loop).result(timeout=5)
+        except Exception:
+            loop.call_soon_threadsafe(loop.stop)
+            self._thread.join(timeout=2)
+            loop.close()
+            self._thread = None
+            raise
+        self._loop = loop
+    
+    def stop(self):
+        """停止服务"""
+        loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._stop_servers(), loop).result(timeout=5)
+        except Exception:
+            pass
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join(timeout=2)
+        loop.close()
+        self._thread = None
+    
+    async def _start_servers(self):
+        loop = asyncio.get_running_loop()
+        host, port = self.listen_address
+        self._udp_transport, _ = await loop.create_datagram_endpoint(
+            lambda: DnsDatagramProtocol(self._on_client_datagram), local_addr=(host, port))
+        self.address = self._udp_transport.get_extra_info('sockname')[:2]
+        # TCP 与 UDP 使用同一端口（应答被截断时客户端会改用 TCP 重试）
+        self._tcp_server = await asyncio.start_server(self._handle_tcp_client, host, self.address[1])
+        self._upstream_transport, _ = await loop.create_datagram_endpoint(
+            lambda: DnsDatagramProtocol(self._on_upstream_datagram), local_addr=('0.0.0.0', 0))
+    
+    async def _stop_servers(self):
+        self._tcp_server.close()
+        self._udp_transport.close()
+        self._upstream_transport.close()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._tcp_server.wait_closed()
+    
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    def _on_client_datagram(self, data, addr):
+        self._spawn(self._handle_udp_query(data, addr))
+    
+    async def _handle_udp_query(self, data, addr):
+        response = await self.answer(data, tcp=False)
+        if response is not None and self._udp_transport is not None:
+            self._udp_transport.sendto(response, addr)
+    
+    async def _handle_tcp_client(self, reader, writer):
+        # 登记连接任务，停止服务时一并取消
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        try:
+            while True:
+                length = int.from_bytes(await reader.readexactly(2), 'big')
+                query = await reader.readexactly(length)
+                response = await self.answer(query, tcp=True)
+                if response is None:
+                    break
+                writer.write(len(response).to_bytes(2, 'big') + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # 停止服务时取消的连接正常结束，避免 asyncio 报告未处理的取消
+            pass
+        finally:
+            writer.close()
+    
+    async def answer(self, query, tcp=False):
+        """处理一条查询报文，返回应答报文（无法解析的报文返回 None）"""
+        try:
+            name, qtype, qclass, question_end = self.parse_question(query)
+        except (ValueError, IndexError, struct.error):
+            return None
+        self.stats['queries'] += 1
         
-        # 确定文件目录：打包后使用 .app 所在目录，开发模式使用脚本目录
-        if getattr(sys, 'frozen', False):
-            # 打包后的应用：使用 .app 所在目录
-            # sys.executable 指向 .app/Contents/MacOS/DomainKiller
-            # 所以 .app 目录是 parent.parent.parent
-            app_path = Path(sys.executable)
-            if '.app' in str(app_path):
-                # .app/Contents/MacOS/DomainKiller -> .app 目录
-                app_dir = app_path.parent.parent.parent
-                # 使用 .app 目录（与 .app 文件同级）
-                self.script_dir = app_dir
-            else:
-                # 如果不是 .app，使用可执行文件所在目录
-                self.script_dir = app_path.parent
-        else:
-            # 开发模式：使用脚本所在目录
-            if '__file__' in globals():
-                self.script_dir = Path(os.path.dirname(os.path.abspath(__file__)))
-            else:
-                self.script_dir = Path.cwd()
+        if query[2] & 0x78:
+            # 只支持标准查询（opcode 0）
+            return self.build_response(query, question_end, self.RCODE_NOTIMP)
         
-        self.domains_file = self.script_dir / DOMAINS_FILE
-        print(f"域名文件路径: {self.domains_file}")
+        if self.matcher.match(name):
+            self.stats['blocked'] += 1
+            return self.build_blocked_response(query, question_end, qtype)
         
-        # 如果是打包后的应用，检查是否需要从打包资源复制文件
-        if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
-            # 检查打包资源中是否有 domains.txt
-            bundled_file = Path(sys._MEIPASS) / DOMAINS_FILE
-            if bundled_file.exists() and not self.domains_file.exists():
-                try:
-                    # 从打包资源复制到 .app 目录
-                    import shutil
-                    shutil.copy2(bundled_file, self.domains_file)
-                    print(f"从打包资源复制 domains.txt 到: {self.domains_file}")
-                except Exception as e:
-                    print(f"复制打包资源失败: {e}")
+        key = (name, qtype, qclass)
+        entry = self._cache_get(key)
+        if entry is not None:
+            self.stats['cache_hits'] += 1
+            return self.render_cached(entry, query, question_end)
         
-        # 如果文件不存在，创建空文件（在 .app 目录中）
-        if not self.domains_file.exists():
+        # 合并并发查询：同一名称同时只向上游查询一次（TCP 需要完整应答，单独合并）
+        inflight_key = key + (tcp,)
+        future = self._inflight.get(inflight_key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+            entry = await asyncio.shield(future)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[inflight_key] = future
+            entry = None
             try:
-                self.domains_file.parent.mkdir(parents=True, exist_ok=True)
-                # 创建带注释的空文件
-                with open(self.domains_file, 'w', encoding='utf-8') as f:
-                    f.write("# 本地域名列表，每行一个域名\n")
-                print(f"创建空的域名文件: {self.domains_file}")
+                response = await self._forward(query, tcp)
+                if response is not None:
+                    entry = self._make_entry(response)
+                    if entry[3] is not None:
+                        self._cache_put(key, entry)
             except Exception as e:
-                print(f"创建域名文件失败: {e}")
-        self.window = None
-        self.password = None
-        self.sudo_password = None  # 缓存 sudo 密码（仅在内存中）
-        self.use_pfctl = True  # 使用 pfctl 实现实时拦截
-        self.api_domains = set()  # API 同步的域名列表（当前正在屏蔽的）
-        self.proxy_server = None  # 代理服务器实例
-        self.proxy_thread = None  # 代理服务器线程
-        self.use_proxy = True  # 使用代理服务器拦截（对 Safari 更有效）
+                print(f"⚠️ DNS 转发 {name} 失败: {e}")
+            finally:
+                del self._inflight[inflight_key]
+                future.set_result(entry)
         
-    def fetch_domains_from_api(self):
-        """从 API 获取域名列表和密码"""
+        if entry is None:
+            self.stats['failed'] += 1
+            return self.build_response(query, question_end, self.RCODE_SERVFAIL)
+        return self.render_cached(entry, query, question_end)
+    
+    async def _forward(self, query, tcp):
+        """依次尝试上游服务器，返回上游应答（全部失败返回 None）"""
+        self.stats['forwarded'] += 1
+        for server in self.upstream_servers:
+            try:
+                if tcp:
+                    return await asyncio.wait_for(self._forward_tcp(query, server), DNS_UPSTREAM_TIMEOUT)
+                return await self._forward_udp(query, server)
+            except (asyncio.TimeoutError, OSError, asyncio.IncompleteReadError):
+                continue
+        return None
+    
+    async def _forward_udp(self, query, server):
+        loop = asyncio.get_running_loop()
+        query_id = random.randrange(0x10000)
+        while query_id in self._pending:
+            query_id = random.randrange(0x10000)
+        future = loop.create_future()
+        self._pending[query_id] = (future, server)
         try:
-            print(f"正在连接 API: {API_URL}")
-            response = requests.get(API_URL, timeout=15)
-            response.raise_for_status()
-            data = response.json()
-            
-            if data.get("code") == 200 and "data" in data:
-                raw_domains = data["data"].get("domains", [])
-                password = data.get("password", None)
-                
-                # 清理域名：去除协议前缀（http://, https://）和尾部斜杠
-                cleaned_domains = []
-                for domain in raw_domains:
-                    # 去除首尾空白
-                    domain = domain.strip()
-                    if not domain:
-                        continue
-                    
-                    # 去除协议前缀
-                    if domain.startswith("http://"):
-                        domain = domain[7:]
-                    elif domain.startswith("https://"):
-                        domain = domain[8:]
-                    
-                    # 去除尾部斜杠和路径
-                    if "/" in domain:
-                        domain = domain.split("/")[0]
-                    
-                    # 去除尾部空白和斜杠
-                    domain = domain.rstrip("/").strip()
-                    
-                    if domain:
-                        cleaned_domains.append(domain)
-                
-                print(f"✅ API 返回: {len(raw_domains)} 个原始域名，清理后 {len(cleaned_domains)} 个有效域名")
-                return (cleaned_domains, password)
-            else:
-                print(f"⚠️ API 返回错误: {data.get('code', 'unknown')}")
-                return None
-        except requests.exceptions.Timeout:
-            print(f"⚠️ API 请求超时（超过 15 秒）")
+            self._upstream_transport.sendto(query_id.to_bytes(2, 'big') + query[2:], server)
+            return await asyncio.wait_for(future, DNS_UPSTREAM_TIMEOUT)
+        finally:
+            self._pending.pop(query_id, None)
+    
+    def _on_upstream_datagram(self, data, addr):
+        if len(data) < 12:
+            return
+        pending = self._pending.get(int.from_bytes(data[:2], 'big'))
+        # 只接受来自对应上游服务器的应答
+        if pending and not pending[0].done() and addr[:2] == tuple(pending[1]):
+            pending[0].set_result(data)
+    
+    async def _forward_tcp(self, query, server):
+        reader, writer = await asyncio.open_connection(server[0], server[1])
+        try:
+            writer.write(len(query).to_bytes(2, 'big') + query)
+            await writer.drain()
+            length = int.from_bytes(await reader.readexactly(2), 'big')
+            return await reader.readexactly(length)
+        finally:
+            writer.close()
+    
+    def _cache_get(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
             return None
-        except requests.exceptions.RequestException as e:
-            print(f"⚠️ API 请求失败: {e}")
+        if entry[3] <= time.monotonic():
+            del self._cache[key]
             return None
+        self._cache.move_to_end(key)
+        return entry
+    
+    def _cache_put(self, key, entry):
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+    
+    def _make_entry(self, response):
+        """解析上游应答中所有记录的 TTL 位置，计算缓存过期时间（不可缓存时过期时间为 None）"""
+        now = time.monotonic()
+        ttl_fields = self.scan_ttls(response)
+        rcode = response[3] & 0x0F
+        truncated = response[2] & 0x02
+        expires = None
+        if not truncated and rcode in (0, self.RCODE_NXDOMAIN):
+            ttls = [ttl for _, ttl in ttl_fields]
+            if ttls:
+                ttl = min(ttls)
+                if rcode == self.RCODE_NXDOMAIN or not self.answer_count(response):
+                    ttl = min(ttl, DNS_NEGATIVE_TTL)
+            else:
+                ttl = DNS_NEGATIVE_TTL
+            if ttl > 0:
+                expires = now + ttl
+        return (bytes(response), ttl_fields, now, expires)
+    
+    def render_cached(self, entry, query, question_end):
+        """根据缓存的应答生成发给客户端的报文：替换 ID 和问题部分，TTL 扣除已缓存时间并封顶"""
+        response, ttl_fields, stored_at, _ = entry
+        packet = bytearray(response)
+        packet[0:2] = query[0:2]
+        # 保持客户端问题部分的大小写（部分客户端会校验）
+        if len(packet) >= question_end and packet[12:question_end].lower() == query[12:question_end].lower():
+            packet[12:question_end] = query[12:question_end]
+        elapsed = int(time.monotonic() - stored_at)
+        for offset, ttl in ttl_fields:
+            struct.pack_into('!I', packet, offset, max(0, min(ttl - elapsed, DNS_MAX_CLIENT_TTL)))
+        return bytes(packet)
+    
+    def build_response(self, query, question_end, rcode, answers=b'', answer_count=0):
+        """构造只包含原问题的应答报文"""
+        flags = bytes([0x80 | (query[2] & 0x79), 0x80 | rcode])  # QR + 原 opcode/RD，RA
+        header = query[0:2] + flags + struct.pack('!HHHH', 1, answer_count, 0, 0)
+        return header + query[12:question_end] + answers
+    
+    def build_blocked_response(self, query, question_end, qtype):
+        """被屏蔽域名的应答：A/AAAA 返回全零地址，其他类型返回空应答；或统一返回 NXDOMAIN"""
+        if DNS_BLOCK_RESPONSE == 'nxdomain':
+            return self.build_response(query, question_end, self.RCODE_NXDOMAIN)
+        if qtype == self.QTYPE_A:
+            rdata = b'\x00' * 4
+        elif qtype == self.QTYPE_AAAA:
+            rdata = b'\x00' * 16
+        else:
+            return self.build_response(query, question_end, 0)
+        # 名称使用指向问题部分的压缩指针
+        answer = struct.pack('!HHHIH', 0xC00C, qtype, 1, DNS_MAX_CLIENT_TTL, len(rdata)) + rdata
+        return self.build_response(query, question_end, 0, answer, 1)
+    
+    @staticmethod
+    def parse_question(packet):
+        """解析查询报文的问题部分，返回 (小写名称, 类型, 类, 问题结束偏移)"""
+        if len(packet) < 12 or packet[2] & 0x80 or int.from_bytes(packet[4:6], 'big') != 1:
+            raise ValueError("不是单问题的查询报文")
+        offset = 12
+        labels = []
+        while True:
+            length = packet[offset]
+            offset += 1
+            if length == 0:
+                break
+            if length & 0xC0:
+                raise ValueError("问题部分不应使用压缩指针")
+            labels.append(packet[offset:offset + length])
+            offset += length
+        qtype, qclass = struct.unpack_from('!HH', packet, offset)
+        name = b'.'.join(labels).decode('ascii', 'replace').lower()
+        return name, qtype, qclass, offset + 4
+    
+    @staticmethod
+    def build_query(name, qtype):
+        """构造一条递归查询报文（随机 ID），名称不合法时抛出 ValueError"""
+        question = b''
+        for label in name.rstrip('.').split('.'):
+            label = label.encode('idna')
+            if not 0 < len(label) < 64:
+                raise ValueError(f"域名不合法: {name}")
+            question += bytes([len(label)]) + label
+        header = struct.pack('!HHHHHH', random.randrange(0x10000), 0x0100, 1, 0, 0, 0)
+        return header + question + struct.pack('!BHH', 0, qtype, 1)
+    
+    @classmethod
+    def parse_addresses(cls, packet):
+        """返回应答部分所有 A/AAAA 记录的 {地址: TTL}（CNAME 链上的记录一并返回）"""
+        qdcount, ancount = struct.unpack_from('!HH', packet, 4)
+        offset = 12
+        for _ in range(qdcount):
+            offset = cls.skip_name(packet, offset) + 4
+        addresses = {}
+        for _ in range(ancount):
+            offset = cls.skip_name(packet, offset)
+            rtype, _, ttl, rdlength = struct.unpack_from('!HHIH', packet, offset)
+            offset += 10
+            rdata = packet[offset:offset + rdlength]
+            if rtype == cls.QTYPE_A and rdlength == 4:
+                addresses[socket.inet_ntop(socket.AF_INET, rdata)] = ttl
+            elif rtype == cls.QTYPE_AAAA and rdlength == 16:
+                addresses[socket.inet_ntop(socket.AF_INET6, rdata)] = ttl
+            offset += rdlength
+        return addresses
+    
+    @staticmethod
+    def answer_count(packet):
+        return int.from_bytes(packet[6:8], 'big')
+    
+    @classmethod
+    def scan_ttls(cls, packet):
+        """返回报文中所有资源记录 TTL 字段的 (偏移, 值)（跳过 EDNS OPT 伪记录）"""
+        qdcount, ancount, nscount, arcount = struct.unpack_from('!HHHH', packet, 4)
+        offset = 12
+        for _ in range(qdcount):
+            offset = cls.skip_name(packet, offset) + 4
+        fields = []
+        for _ in range(ancount + nscount + arcount):
+            offset = cls.skip_name(packet, offset)
+            rtype, _, ttl, rdlength = struct.unpack_from('!HHIH', packet, offset)
+            if rtype != cls.QTYPE_OPT:
+                fields.append((offset + 4, ttl))
+            offset += 10 + rdlength
+        return fields
+    
+    @staticmethod
+    def skip_name(packet, offset):
+        """跳过报文中的一个域名，返回其后的偏移"""
+        while True:
+            length = packet[offset]
+            if length == 0:
+                return offset + 1
+            if length & 0xC0 == 0xC0:
+                return offset + 2
+            offset += 1 + length
+
+
+class DnsDatagramProtocol(asyncio.DatagramProtocol):
+    """把收到的 UDP 报文交给回调处理"""
+    
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+    
+    def datagram_received(self, data, addr):
+        self.on_datagram(data, addr)
+    
+    def error_received(self, exc):
+        pass
+
+
+class DomainResolver:
+    """并发 DNS 解析 - 直接向系统配置的 DNS 服务器发送查询，取得 pfctl 需要拦截的真实 IPv4 和 IPv6 地址
+    
+    不经过系统解析器（hosts 文件已把被屏蔽的域名指向 127.0.0.1），也不再为每个域名运行 dig/nslookup。
+    查询发往系统当前使用的 DNS 服务器（企业网络、VPN 或过滤 DNS 下得到的地址与浏览器一致），
+    只有读不到系统配置时才使用 DNS_UPSTREAM_SERVERS。
+    每个名称同时查询 A 和 AAAA 记录，双栈网络上浏览器改走 IPv6 时同样会被拦截。
+    所有查询在一个事件循环中并发进行，同时进行的查询数不超过 concurrency，整个解析不超过 deadline 秒。
+    """
+    
+    QUERY_TYPES = (DnsSinkhole.QTYPE_A, DnsSinkhole.QTYPE_AAAA)
+    UNROUTABLE = frozenset(['0.0.0.0', '::', '::1'])  # 屏蔽服务器或 hosts 返回的地址，不是真实地址
+    
+    def __init__(self, servers=None, concurrency=RESOLVE_CONCURRENCY,
+                 timeout=DNS_UPSTREAM_TIMEOUT, deadline=RESOLVE_DEADLINE):
+        self.configured_servers = list(servers) if servers else None  # 为空时每次解析前读取系统 DNS 配置（网络可能已切换）
+        self.servers = self.configured_servers or []
+        self.concurrency = concurrency
+        self.timeout = timeout  # 单个上游服务器的查询超时
+        self.deadline = deadline
+    
+    def resolve(self, names):
+        """解析全部名称，返回 {名称: {IP: TTL}}（IPv4 和 IPv6 混合）；解析失败或在时限内未完成的名称不在结果中"""
+        names = sorted(set(names))
+        if not names:
+            return {}
+        self.servers = self.configured_servers or self.system_servers() or list(DNS_UPSTREAM_SERVERS)
+        started = time.perf_counter()
+        results, timed_out = asyncio.run(self.resolve_all(names))
+        print(f"解析 {len(names)} 个域名用时 {time.perf_counter() - started:.2f} 秒"
+              f"（成功 {len(results)}，超时 {timed_out}，失败 {len(names) - len(results) - timed_out}）")
+        return results
+    
+    @classmethod
+    def system_servers(cls, resolv_conf=RESOLV_CONF_PATH):
+        """读取系统当前使用的 DNS 服务器 [(地址, 53), ...]：先读 resolv.conf，没有时解析 scutil --dns 的输出
+        跳过回环和全零地址（系统 DNS 可能指向本地 DNS 屏蔽服务器，它会把被屏蔽的域名解析到 0.0.0.0）
+        """
+        addresses = []
+        try:
+            with open(resolv_conf, 'r', encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) >= 2 and parts[0] == 'nameserver':
+                        addresses.append(parts[1])
+        except OSError:
+            pass
+        if not addresses:
+            try:
+                process = subprocess.run(['scutil', '--dns'], capture_output=True, text=True, timeout=5)
+                if process.returncode == 0:
+                    addresses = cls.parse_scutil_dns(process.stdout)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        servers = []
+        for address in addresses:
+            try:
+                ip = ipaddress.ip_address(address.split('%', 1)[0])
+            except ValueError:
+                continue
+            if ip.is_loopback or ip.is_unspecified or (address, 53) in servers:
+                continue
+            servers.append((address, 53))
+        return servers
+    
+    @staticmethod
+    def parse_scutil_dns(output):
+        """从 scutil --dns 的输出中取出通用解析器的 DNS 服务器地址
+        带 domain 的解析器只用于特定域名（如 local 或 VPN 的内部域名），不使用
+        """
+        addresses = []
+        for resolver in output.split('resolver #'):
+            fields = [line.strip().split(':', 1) for line in resolver.splitlines() if ':' in line]
+            if any(key.strip() == 'domain' for key, _ in fields):
+                continue
+            addresses.extend(value.strip() for key, value in fields if key.strip().startswith('nameserver['))
+        return addresses
+    
+    async def resolve_all(self, names):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = {}
+        
+        async def worker(name, qtype):
+            async with semaphore:
+                ips = await self.query(name, qtype)
+            if ips:
+                results.setdefault(name, {}).update(ips)
+        
+        tasks = {asyncio.ensure_future(worker(name, qtype)): name
+                 for name in names for qtype in self.QUERY_TYPES}
+        _, pending = await asyncio.wait(tasks, timeout=self.deadline)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        # 只完成了部分查询（如只有 A 记录）的名称结果不完整，不返回，下次重新解析
+        timed_out = {tasks[task] for task in pending}
+        for name in timed_out:
+            results.pop(name, None)
+        return results, len(timed_out)
+    
+    async def query(self, name, qtype):
+        """按顺序尝试上游服务器，返回解析到的 {地址: TTL}（排除回环和全零地址）；没有该类型记录时返回空字典"""
+        try:
+            packet = DnsSinkhole.build_query(name, qtype)
+        except ValueError:
+            return {}
+        for server in self.servers:
+            try:
+                response = await self.exchange(packet, server)
+                rcode = response[3] & 0x0F
+                if rcode == DnsSinkhole.RCODE_NXDOMAIN:
+                    return {}
+                if rcode != 0 or response[2] & 0x02:
+                    continue
+                return {ip: ttl for ip, ttl in DnsSinkhole.parse_addresses(response).items()
+                        if not ip.startswith('127.') and ip not in self.UNROUTABLE}
+            except (OSError, asyncio.TimeoutError, ValueError, struct.error):
+                continue
+        return {}
+    
+    async def exchange(self, packet, server):
+        """向一个服务器发送查询，等待 ID 和问题部分都匹配的应答"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        
+        def on_datagram(data, addr):
+            if data[:2] == packet[:2] and data[12:len(packet)].lower() == packet[12:].lower() and not future.done():
+                future.set_result(data)
+        
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: DnsDatagramProtocol(on_datagram), remote_addr=server)
+        try:
+            transport.sendto(packet)
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            transport.close()
+
+
+class ResolutionCache:
+    """域名解析结果缓存 - 保存每个名称的 IP、过期时间，以及每个 IP 首次和最近出现的时间
+    
+    TTL 未过期的名称不再重新解析；名称不再解析到的 IP（CDN 轮换）在 grace_period 内仍保留在拦截列表中。
+    缓存文件在第一次使用时才读取，重启后第一次应用规则只需解析缓存中没有或已过期的名称。
+    """
+    
+    def __init__(self, path, grace_period=RESOLVE_GRACE_PERIOD):
+        self.path = path
+        self.grace_period = grace_period
+        self.entries = None  # 名称 -> {'expires': 过期时间, 'ips': {IP: [首次出现, 最近出现]}}，None 表示尚未读取
+        self.dirty = False
+    
+    def load(self):
+        """第一次调用时读取缓存文件，文件不存在或损坏时从空缓存开始"""
+        if self.entries is not None:
+            return self.entries
+        self.entries = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self.entries = {name: entry for name, entry in data.items()
+                                if isinstance(entry, dict) and isinstance(entry.get('ips'), dict)}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"读取解析缓存失败: {e}")
+        return self.entries
+    
+    def expired(self, names, now=None):
+        """返回需要重新解析的名称（不在缓存中或 TTL 已过期）"""
+        now = time.time() if now is None else now
+        entries = self.load()
+        return {name for name in names if name not in entries or entries[name].get('expires', 0) <= now}
+    
+    def update(self, resolved, now=None):
+        """记录解析结果 {名称: {IP: TTL}}：按最短 TTL 设置过期时间，刷新 IP 的最近出现时间，丢弃超过宽限期的 IP"""
+        now = time.time() if now is None else now
+        entries = self.load()
+        for name, addresses in resolved.items():
+            if not addresses:
+                continue
+            entry = entries.setdefault(name, {'expires': 0, 'ips': {}})
+            entry['expires'] = now + min(max(min(addresses.values()), RESOLVE_MIN_TTL), RESOLVE_MAX_TTL)
+            for ip in addresses:
+                entry['ips'].setdefault(ip, [now, now])[1] = now
+            entry['ips'] = {ip: seen for ip, seen in entry['ips'].items() if seen[1] + self.grace_period >= now}
+            self.dirty = True
+    
+    def ips(self, name, now=None):
+        """名称当前需要拦截的 IP：最近出现时间在宽限期内的全部 IP"""
+        now = time.time() if now is None else now
+        entry = self.load().get(name)
+        if not entry:
+            return set()
+        return {ip for ip, (_, last_seen) in entry['ips'].items() if last_seen + self.grace_period >= now}
+    
+    def retain(self, names):
+        """只保留 names 中的名称（域名从屏蔽列表中移除后丢弃它的解析结果）"""
+        entries = self.load()
+        for name in set(entries) - set(names):
+            del entries[name]
+            self.dirty = True
+    
+    def save(self):
+        """有变化时保存缓存（先写临时文件再替换，避免写到一半）"""
+        if not self.dirty:
+            return
+        try:
+            temp_file = self.path.with_name(self.path.name + '.tmp')
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f)
+            os.replace(temp_file, self.path)
+            self.dirty = False
+        except Exception as e:
+            print(f"保存解析缓存失败: {e}")
+
+
+class HostsDocument:
+    """hosts 文件的结构化表示 - 一次扫描得到同步所需的全部信息，各步骤共用，不再重复解析
+    
+    按字节处理：只查找起止标记的位置并解码屏蔽区块，屏蔽区块之外的原有内容不解码，写回时按字节原样复制，
+    读取几十 MB 的 hosts 文件时内存占用也只与屏蔽区块的大小有关。
+    
+    source         原文（bytes 或只读 mmap）
+    foreign_spans  屏蔽区块之外的内容在原文中的字节范围列表 [(start, end), ...]
+    block_span     第一个屏蔽区块（含起止标记行）在原文中的字节范围 (start, end)，没有屏蔽区块时为 None
+    block_text     屏蔽区块的原文（有多个屏蔽区块时依次拼接）
+    entries        屏蔽区块中被屏蔽的域名集合
+    encoding       屏蔽区块使用的编码，写回时沿用
+    newline        原文使用的换行符（\\n 或 \\r\\n），写回时沿用
+    """
+    
+    __slots__ = ('source', 'foreign_spans', 'block_span', 'block_text', 'entries', 'encoding', 'newline')
+    
+    CHUNK_LINES = 4096  # 生成屏蔽区块时每块包含的行数
+    CHUNK_BYTES = 1024 * 1024  # 复制原有内容时每块的字节数
+    TRAILING_WHITESPACE = b' \t\r\n\x0b\x0c'
+    _sort_cache = (frozenset(), [])  # (上次排序的条目, 排序结果)，各次同步之间复用
+    
+    def __init__(self, source=b'', foreign_spans=(), block_span=None, block_text='', entries=(),
+                 encoding='utf-8', newline='\n'):
+        self.source = source
+        self.foreign_spans = list(foreign_spans)
+        self.block_span = block_span
+        self.block_text = block_text
+        self.entries = set(entries)
+        self.encoding = encoding
+        self.newline = newline
+    
+    @classmethod
+    def from_file(cls, path, encodings=('utf-8',)):
+        """以只读内存映射方式打开并解析 hosts 文件（不把整个文件读入内存）"""
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls.parse_bytes(b'', encodings)
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.parse_bytes(data, encodings)
+    
+    @classmethod
+    def parse(cls, content, encoding='utf-8'):
+        """解析已经读成字符串的 hosts 文件内容"""
+        return cls.parse_bytes(content.encode(encoding), (encoding,))
+    
+    @classmethod
+    def parse_bytes(cls, data, encodings=('utf-8',)):
+        """解析 hosts 文件的原始字节
+        包含标记的整行都算标记行；没有结束标记时，开始标记之后的内容都属于屏蔽区块；
+        屏蔽区块的内容依次尝试 encodings 中的编码解码
+        """
+        start_marker = MARKER_START.encode('ascii')
+        end_marker = MARKER_END.encode('ascii')
+        size = len(data)
+        first_newline = data.find(b'\n')
+        newline = '\r\n' if first_newline > 0 and data[first_newline - 1] == 0x0D else '\n'
+        foreign_spans = []
+        block_parts = []
+        block_span = None
+        position = 0
+        
+        while True:
+            start = data.find(start_marker, position)
+            stray = data.find(end_marker, position, size if start == -1 else start)
+            if stray != -1:
+                # 屏蔽区块之外残留的结束标记行也一并移除
+                line_start, line_end = cls.line_bounds(data, stray, position)
+                foreign_spans.append((position, line_start))
+                position = line_end
+                continue
+            if start == -1:
+                foreign_spans.append((position, size))
+                break
+            
+            line_start, line_end = cls.line_bounds(data, start, position)
+            end = data.find(end_marker, start)
+            if end == -1:
+                line_end = size
+            else:
+                line_end = cls.line_bounds(data, end, position)[1]
+            foreign_spans.append((position, line_start))
+            block_parts.append(data[line_start:line_end])
+            if block_span is None:
+                block_span = (line_start, line_end)
+            position = line_end
+        
+        block = b''.join(block_parts)
+        encoding = encodings[0]
+        for candidate in encodings:
+            try:
+                block_text = block.decode(candidate)
+                encoding = candidate
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            block_text = block.decode(encoding, errors='replace')
+        
+        # 解析格式: 127.0.0.1 domain.com（紧凑格式一行有多个域名: 127.0.0.1 a.com b.com ...）
+        entries = set()
+        for line in block_text.split('\n'):
+            parts = line.split()
+            if len(parts) >= 2 and parts[0] == LOCALHOST_IP:
+                for name in parts[1:]:
+                    if name.startswith('#'):
+                        break
+                    entries.add(name)
+        
+        foreign_spans = [(start, end) for start, end in foreign_spans if end > start]
+        return cls(data, foreign_spans, block_span, block_text, entries, encoding, newline)
+    
+    @staticmethod
+    def line_bounds(data, index, lower):
+        """返回 index 所在行的字节范围 (行首, 下一行行首)，行首不小于 lower"""
+        line_start = data.rfind(b'\n', lower, index) + 1 or lower
+        line_end = data.find(b'\n', index)
+        return line_start, len(data) if line_end == -1 else line_end + 1
+    
+    @property
+    def has_block(self):
+        return self.block_span is not None
+    
+    def close(self):
+        """释放原文（关闭内存映射）；Windows 上映射存在期间不能截断 hosts 文件"""
+        source, self.source = self.source, b''
+        if isinstance(source, mmap.mmap):
+            source.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    @classmethod
+    def sorted_entries(cls, entries):
+        """返回排序后的屏蔽条目；与上次同步的条目相同时直接复用上次的排序结果"""
+        entries = frozenset(entries)
+        cached_entries, cached_order = cls._sort_cache
+        if entries != cached_entries:
+            cached_order = sorted(entries)
+            cls._sort_cache = (entries, cached_order)
+        return cached_order
+    
+    def iter_foreign(self):
+        """逐块返回屏蔽区块之外的原有内容（原样字节，去掉末尾的空白）"""
+        spans = list(self.foreign_spans)
+        while spans:
+            start, end = spans[-1]
+            while end > start and self.source[end - 1] in self.TRAILING_WHITESPACE:
+                end -= 1
+            if end > start:
+                spans[-1] = (start, end)
+                break
+            spans.pop()
+        
+        for start, end in spans:
+            for offset in range(start, end, self.CHUNK_BYTES):
+                yield self.source[offset:min(end, offset + self.CHUNK_BYTES)]
+    
+    def iter_block(self, entries, names_per_line=1):
+        """逐块生成屏蔽区块（含起止标记行，字节）
+        names_per_line 大于 1 时为紧凑格式，每行写入多个域名；每块最多 CHUNK_LINES 行，总耗时与条目数成线性关系
+        """
+        newline = self.newline
+        encoding = self.encoding
+        yield f"{MARKER_START}{newline}".encode(encoding)
+        ordered = self.sorted_entries(entries)
+        prefix = f"{LOCALHOST_IP} "
+        if names_per_line <= 1:
+            separator = newline + prefix
+            for index in range(0, len(ordered), self.CHUNK_LINES):
+                yield (prefix + separator.join(ordered[index:index + self.CHUNK_LINES]) + newline).encode(encoding)
+        else:
+            chunk_names = self.CHUNK_LINES * names_per_line
+            for index in range(0, len(ordered), chunk_names):
+                stop = min(len(ordered), index + chunk_names)
+                lines = [prefix + ' '.join(ordered[start:start + names_per_line])
+                         for start in range(index, stop, names_per_line)]
+                yield (newline.join(lines) + newline).encode(encoding)
+        yield f"{MARKER_END}{newline}".encode(encoding)
+    
+    def iter_chunks(self, entries=None, names_per_line=1):
+        """逐块生成完整的 hosts 内容（字节）：原有内容 + 新的屏蔽区块（entries 为空时只保留原有内容）
+        写文件时不需要先拼出整个内容
+        """
+        yield from self.iter_foreign()
+        if entries:
+            yield (self.newline * 2).encode(self.encoding)
+            yield from self.iter_block(entries, names_per_line)
+    
+    def render_block(self, entries, names_per_line=1):
+        """生成屏蔽区块字符串，可与 block_text 直接比较"""
+        return b''.join(self.iter_block(entries, names_per_line)).decode(self.encoding)
+    
+    def render(self, entries=None, names_per_line=1):
+        """生成完整的 hosts 内容字符串"""
+        return b''.join(self.iter_chunks(entries, names_per_line)).decode(self.encoding, errors='replace')
+    
+    def write_to(self, file, entries=None, names_per_line=1):
+        """把完整的 hosts 内容分块写入以二进制方式打开的文件，返回写入的字节数"""
+        written = 0
+        for chunk in self.iter_chunks(entries, names_per_line):
+            file.write(chunk)
+            written += len(chunk)
+        return written
+
+
+class HostsWatcher:
+    """hosts 文件监视器 - 文件被修改后立即回调，用于发现屏蔽区块被删除等篡改
+    
+    Linux 使用 inotify（监视所在目录，原地写入和替换文件都能收到），macOS 使用 kqueue（同时监视目录和文件本身），
+    都不可用时定时检查文件状态。一连串事件在 debounce 秒内只回调一次；
+    本程序自己的写入放在 pause() / resume() 之间，resume 时记录写入后的文件状态，之后不会因此回调。
+    """
+    
+    IN_MODIFY = 0x002
+    IN_ATTRIB = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len，后面跟着 len 字节的文件名
+    
+    def __init__(self, path, on_change, debounce=HOSTS_WATCH_DEBOUNCE, poll_interval=HOSTS_WATCH_POLL_INTERVAL):
+        self.path = os.path.realpath(path)  # macOS 上 /etc 是指向 /private/etc 的链接
+        self.on_change = on_change
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.backend = None
+        self.running = False
+        self._paused = 0
+        self._lock = threading.Lock()
+        self._baseline = self.signature()
+        self._thread = None
+    
+    def signature(self):
+        """文件状态：(inode, 大小, 修改时间)，文件不存在时为 None"""
+        try:
+            stat = os.stat(self.path)
+            return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            return None
+    
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._baseline = self.signature()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self.running = False
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2)
+        self._thread = None
+    
+    def pause(self):
+        """开始本程序自己的写入，期间的修改事件全部忽略"""
+        with self._lock:
+            self._paused += 1
+    
+    def resume(self):
+        """本程序的写入结束，以写入后的文件状态作为新的基准"""
+        with self._lock:
+            self._paused = max(0, self._paused - 1)
+            self._baseline = self.signature()
+    
+    def _check(self):
+        """去抖结束后调用：文件状态与基准不同（且不是本程序在写入）时回调"""
+        with self._lock:
+            if self._paused:
+                return
+            current = self.signature()
+            if current == self._baseline:
+                return
+            self._baseline = current
+        try:
+            self.on_change()
+        except Exception as e:
+            print(f"处理 hosts 文件变化失败: {e}")
+    
+    def _run(self):
+        for watch in (self._watch_inotify, self._watch_kqueue):
+            try:
+                if watch():
+                    return
+            except Exception as e:
+                print(f"⚠️ hosts 文件事件监视不可用，改为每 {self.poll_interval} 秒检查一次: {e}")
+                break
+        self._watch_polling()
+    
+    def _watch_polling(self):
+        self.backend = 'poll'
+        while self.running:
+            time.sleep(self.poll_interval)
+            self._check()
+    
+    def _watch_inotify(self):
+        """Linux: 用 inotify 监视 hosts 文件所在目录；不是 Linux 时返回 False"""
+        if not sys.platform.startswith('linux'):
+            return False
+        import ctypes
+        import ctypes.util
+        import select
+        
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        try:
+            directory, name = os.path.split(self.path)
+            mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM
+                    | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+            if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+                raise OSError(ctypes.get_errno(), f"无法监视 {directory}")
+            
+            self.backend = 'inotify'
+            name = os.fsencode(name)
+            while self.running:
+                if not select.select([fd], [], [], 1)[0] or not self._drain_inotify(fd, name):
+                    continue
+                # 去抖：直到 debounce 秒内没有新事件
+                while select.select([fd], [], [], self.debounce)[0]:
+                    self._drain_inotify(fd, name)
+                self._check()
+        finally:
+            os.close(fd)
+        return True
+    
+    def _drain_inotify(self, fd, name):
+        """读出所有待处理的 inotify 事件，返回其中是否有 hosts 文件的事件"""
+        matched = False
+        while True:
+            try:
+                data = os.read(fd, 64 * 1024)
+            except BlockingIOError:
+                return matched
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = self.INOTIFY_EVENT.unpack_from(data, offset)
+                offset += self.INOTIFY_EVENT.size
+                if data[offset:offset + length].rstrip(b'\0') == name:
+                    matched = True
+                offset += length
+    
+    def _watch_kqueue(self):
+        """macOS: 用 kqueue 同时监视目录（文件被替换）和文件本身（原地写入）；不支持 kqueue 时返回 False"""
+        import select
+        if not hasattr(select, 'kqueue'):
+            return False
+        
+        open_flags = getattr(os, 'O_EVTONLY', os.O_RDONLY)
+        add_flags = select.KQ_EV_ADD | select.KQ_EV_CLEAR
+        file_events = (select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND | select.KQ_NOTE_ATTRIB
+                       | select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME)
+        queue = select.kqueue()
+        directory_fd = os.open(os.path.dirname(self.path), open_flags)
+        file_fd = None
+        try:
+            queue.control([select.kevent(directory_fd, select.KQ_FILTER_VNODE, add_flags, select.KQ_NOTE_WRITE)], 0)
+            self.backend = 'kqueue'
+            while self.running:
+                if file_fd is None:
+                    try:
+                        file_fd = os.open(self.path, open_flags)
+                        queue.control([select.kevent(file_fd, select.KQ_FILTER_VNODE, add_flags, file_events)], 0)
+                    except OSError:
+                        file_fd = None
+                if not queue.control(None, 8, 1):
+                    continue
+                # 去抖：直到 debounce 秒内没有新事件
+                while queue.control(None, 8, self.debounce):
+                    pass
+                # 文件可能已被替换（sudo mv、编辑器保存），重新打开以监视新的文件
+                if file_fd is not None:
+                    os.close(file_fd)
+                    file_fd = None
+                self._check()
+        finally:
+            if file_fd is not None:
+                os.close(file_fd)
+            os.close(directory_fd)
+            queue.close()
+        return True
+
+
+class PrivilegedBackend:
+    """特权操作的实际执行者 - 在以 root 运行的辅助进程中执行，只提供少量固定的操作
+    
+    write_hosts_block  读取 hosts 文件，只替换屏蔽区块（原有内容按字节保留），写临时文件后原子替换
+    replace_pf_table   把屏蔽 IP 放入 pf 地址表；规则只在第一次加载，之后只替换表中的地址
+    update_pf_table    屏蔽列表变化时只在地址表中增删变化的地址
+                       规则和地址都通过标准输入交给 pfctl，不在 /tmp 等公共目录中写文件（避免符号链接攻击）
+    flush_resolver     刷新系统 DNS 缓存并重启 mDNSResponder
+    """
+    
+    FLUSH_COMMANDS = [
+        ['dscacheutil', '-flushcache'],
+        ['killall', '-HUP', 'mDNSResponder'],
+        ['killall', 'mDNSResponderHelper'],
+        ['killall', 'mDNSResponder'],
+        ['launchctl', 'kickstart', '-k', 'system/com.apple.mDNSResponder'],
+    ]
+    NETWORK_SERVICES = ['Wi-Fi', 'Ethernet']
+    
+    def __init__(self, hosts_path=HOSTS_PATH, table=PFCTL_TABLE):
+        self.hosts_path = hosts_path
+        self.table = table
+        self.pf_loaded = False  # 引用地址表的规则是否已加载
+    
+    def run(self, args, timeout=10, input=None):
+        """执行一条命令（input 为写入标准输入的文本），返回 (退出码, 标准输出, 标准错误)
+        命令不继承本进程的标准输入（sudo 未读取的密码行可能还留在那里）
+        """
+        process = subprocess.run(args, input=input or '', capture_output=True, text=True, timeout=timeout)
+        return process.returncode, process.stdout, process.stderr
+    
+    @staticmethod
+    def pf_ruleset(table, ips):
+        """生成引用地址表的 pf 规则（通过 pfctl -f - 加载）"""
+        # 表中同时包含 IPv4 和 IPv6 地址，两个地址族分别拦截
+        return (
+            "# DomainKiller pfctl Rules - Auto Generated\n"
+            f"table <{table}> persist {{ {' '.join(ips)} }}\n"
+            f"block out quick inet to <{table}>\n"
+            f"block out quick inet6 to <{table}>\n"
+        )
+    
+    def ping(self):
+        return {'pid': os.getpid()}
+    
+    def write_hosts_block(self, entries, names_per_line=1):
+        """把 hosts 文件的屏蔽区块替换为 entries（为空时移除屏蔽区块），返回写入的字节数"""
+        directory = os.path.dirname(self.hosts_path) or '.'
+        temp_fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.hosts.')
+        try:
+            try:
+                document = HostsDocument.from_file(self.hosts_path)
+                mode = os.stat(self.hosts_path).st_mode & 0o7777
+            except FileNotFoundError:
+                document = HostsDocument()
+                mode = 0o644
+            with document, os.fdopen(temp_fd, 'wb') as temp_file:
+                written = document.write_to(temp_file, set(entries or ()), names_per_line)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.chmod(temp_path, mode)
+            os.replace(temp_path, self.hosts_path)
+            return {'bytes': written}
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+    
+    def replace_pf_table(self, ips):
+        """用 ips 替换 pf 地址表的内容，ips 为空时清除规则，返回表中的地址数"""
+        if not ips:
+            self.run(['pfctl', '-f', '/dev/null'])
+            self.pf_loaded = False
+            return {'count': 0}
+        
+        code, _, _ = self.run(['pfctl', '-s', 'info'])
+        if code != 0:
+            self.run(['pfctl', '-e'])
+        
+        if self.pf_loaded:
+            # 规则已加载：只替换表中的地址，已有规则和状态不受影响
+            code, _, stderr = self.run(['pfctl', '-t', self.table, '-T', 'replace', '-f', '-'],
+                                       input='\n'.join(ips) + '\n')
+        else:
+            code, _, stderr = self.run(['pfctl', '-f', '-'], input=self.pf_ruleset(self.table, ips))
+        if code != 0:
+            self.pf_loaded = False
+            raise RuntimeError(f"pfctl 规则应用失败: {stderr.strip()}")
+        self.pf_loaded = True
+        
+        code, stdout, stderr = self.run(['pfctl', '-t', self.table, '-T', 'show'])
+        if code != 0:
+            raise RuntimeError(f"pfctl 验证失败: {stderr.strip()}")
+        return {'count': sum(1 for line in stdout.splitlines() if line.strip())}
+    
+    def update_pf_table(self, add=(), delete=()):
+        """在已加载的 pf 地址表中只增删变化的地址，返回增删的地址数"""
+        if not self.pf_loaded:
+            raise RuntimeError("pf 规则尚未加载")
+        for action, ips in (('delete', delete), ('add', add)):
+            if ips:
+                code, _, stderr = self.run(['pfctl', '-t', self.table, '-T', action, '-f', '-'],
+                                           input='\n'.join(ips) + '\n')
+                if code != 0:
+                    raise RuntimeError(f"pfctl 地址表更新失败: {stderr.strip()}")
+        return {'added': len(add), 'deleted': len(delete)}
+    
+    @classmethod
+    def flush_commands(cls, reset_network_dns=True):
+        """刷新 DNS 缓存需要执行的命令列表"""
+        commands = [list(command) for command in cls.FLUSH_COMMANDS]
+        if reset_network_dns:
+            # 重新设置网络服务的 DNS 会触发系统刷新网络配置缓存（某些 macOS 版本的 Safari 需要）
+            commands += [['networksetup', '-setdnsservers', service, 'Empty'] for service in cls.NETWORK_SERVICES]
+        return commands
+    
+    def flush_resolver(self, reset_network_dns=True):
+        """刷新 DNS 缓存，返回执行失败的命令（killall 找不到进程时返回非零，不算失败）"""
+        failed = []
+        for command in self.flush_commands(reset_network_dns):
+            try:
+                code, _, _ = self.run(command, timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                code = -1
+            if code != 0 and command[0] != 'killall':
+                failed.append(' '.join(command))
+        return {'failed': failed}
+
+
+class FakePrivilegedBackend(PrivilegedBackend):
+    """不执行系统命令的特权后端，用于在 Linux 等系统上测试辅助进程和通信协议
+    
+    hosts 文件照常写入（可指向临时文件），系统命令只记录在 commands 中，pf 地址表保存在内存中。
+    """
+    
+    def __init__(self, hosts_path, table=PFCTL_TABLE):
+        super().__init__(hosts_path, table)
+        self.commands = []
+        self.addresses = []
+    
+    def run(self, args, timeout=10, input=None):
+        self.commands.append(list(args))
+        if args[0] == 'pfctl' and '-T' in args:
+            action = args[args.index('-T') + 1]
+            if action == 'replace':
+                self.addresses = input.split()
+            elif action == 'add':
+                self.addresses += [address for address in input.split() if address not in self.addresses]
+            elif action == 'delete':
+                self.addresses = [address for address in self.addresses if address not in input.split()]
+            elif action == 'show':
+                return 0, ''.join(f"   {address}\n" for address in self.addresses), ''
+        elif args[:2] == ['pfctl', '-f']:
+            self.addresses = []
+            for line in (input or '').splitlines() if args[2] == '-' else ():
+                if line.startswith('table '):
+                    self.addresses = line.split('{', 1)[1].split('}', 1)[0].split()
+        return 0, '', ''
+
+
+class PrivilegedHelper:
+    """特权辅助进程 - 启动一次，以 root 身份通过 Unix 域套接字为界面进程执行 PrivilegedBackend 的操作
+    
+    协议：每行一个 JSON 请求 {"token": ..., "op": ..., "args": {...}}，
+    每行一个 JSON 应答 {"ok": true, "result": ...} 或 {"ok": false, "error": ...}。
+    套接字只允许界面进程的用户访问，请求还必须带上启动时通过令牌文件传入的随机令牌。
+    只接受一个连接：连接断开（界面进程退出或崩溃）后辅助进程随即退出，不会残留。
+    """
+    
+    OPERATIONS = frozenset(['ping', 'write_hosts_block', 'replace_pf_table', 'update_pf_table', 'flush_resolver'])
+    
+    def __init__(self, socket_path, token, backend, owner_uid=None):
+        self.socket_path = socket_path
+        self.token = token
+        self.backend = backend
+        self.owner_uid = owner_uid
+    
+    def serve(self, accept_timeout=PRIVILEGED_HELPER_START_TIMEOUT):
+        """监听套接字，服务一个连接直到断开"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(self.socket_path)
+            os.chmod(self.socket_path, 0o600)
+            if self.owner_uid is not None:
+                os.chown(self.socket_path, self.owner_uid, -1)
+            listener.listen(1)
+            listener.settimeout(accept_timeout)
+            # 通知启动者：可以连接了
+            print("READY", flush=True)
+            connection, _ = listener.accept()
+        finally:
+            listener.close()
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+        
+        with connection, connection.makefile('rwb') as stream:
+            for line in stream:
+                stream.write(json.dumps(self.handle(line), ensure_ascii=False).encode('utf-8') + b'\n')
+                stream.flush()
+    
+    def handle(self, line):
+        """处理一条请求，返回应答字典"""
+        try:
+            request = json.loads(line)
+            if not secrets.compare_digest(str(request.get('token', '')), self.token):
+                return {'ok': False, 'error': "令牌错误"}
+            op = request.get('op')
+            if op not in self.OPERATIONS:
+                return {'ok': False, 'error': f"不支持的操作: {op}"}
+            return {'ok': True, 'result': getattr(self.backend, op)(**(request.get('args') or {}))}
+        except Exception as e:
+            return {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+
+
+class PrivilegedHelperClient:
+    """界面进程一侧的特权辅助进程客户端 - 一个长连接，请求依次发送（线程安全）"""
+    
+    def __init__(self, socket_path, token, process=None):
+        self.socket_path = socket_path
+        self.token = token
+        self.process = process  # 启动的 sudo 进程（辅助进程退出后随之结束）
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(PRIVILEGED_HELPER_CALL_TIMEOUT)
+        self.sock.connect(socket_path)
+        self.stream = self.sock.makefile('rwb')
+    
+    @staticmethod
+    def helper_command():
+        """运行本程序的命令行（打包后的应用直接运行自身的可执行文件）"""
+        if getattr(sys, 'frozen', False):
+            return [sys.executable]
+        return [sys.executable, os.path.abspath(__file__)]
+    
+    @classmethod
+    def launch(cls, password=None, command=None, options=(), timeout=PRIVILEGED_HELPER_START_TIMEOUT):
+        """启动辅助进程并连接，返回客户端实例
+        
+        默认通过 sudo 启动：sudo -S 从标准输入读取密码（-k 保证需要密码时总是读取）。
+        令牌写在只有当前用户可访问的临时目录中，由辅助进程读取，不与密码共用标准输入：
+        sudoers 配置了 NOPASSWD 时 sudo 不读取密码，密码行不会被当作令牌。
+        测试时可以用 command 直接启动（不经过 sudo），options 传给辅助进程（如 --fake-backend <hosts 路径>）。
+        """
+        directory = tempfile.mkdtemp(prefix='domainkiller-')  # 只有当前用户可访问
+        socket_path = os.path.join(directory, 'helper.sock')
+        token_path = os.path.join(directory, 'token')
+        token = secrets.token_hex(16)
+        with open(os.open(token_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+            f.write(token)
+        helper_args = ['--privileged-helper', socket_path, str(os.getuid()), token_path, *options]
+        if command is None:
+            command = ['sudo', '-k', '-S', '-p', ''] + cls.helper_command()
+        command = list(command) + helper_args
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL)
+        try:
+            if password is not None:
+                process.stdin.write((password + '\n').encode('utf-8'))
+            process.stdin.close()
+            
+            ready, _, _ = select.select([process.stdout], [], [], timeout)
+            if not ready or process.stdout.readline().strip() != b'READY':
+                raise RuntimeError("特权辅助进程启动失败（密码错误或超时）")
+            return cls(socket_path, token, process)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            # 辅助进程在 READY 之前已读取令牌，接受连接后已删除套接字文件
+            shutil.rmtree(directory, ignore_errors=True)
+    
+    def call(self, op, **args):
+        """执行一个特权操作，返回结果；辅助进程报告失败时抛出 RuntimeError，连接断开时抛出 OSError"""
+        request = json.dumps({'token': self.token, 'op': op, 'args': args}, ensure_ascii=False)
+        with self.lock:
+            self.stream.write(request.encode('utf-8') + b'\n')
+            self.stream.flush()
+            line = self.stream.readline()
+        if not line:
+            raise ConnectionError("特权辅助进程已退出")
+        response = json.loads(line)
+        if not response.get('ok'):
+            raise RuntimeError(response.get('error', "未知错误"))
+        return response.get('result')
+    
+    def close(self):
+        """断开连接，辅助进程随之退出"""
+        try:
+            self.stream.close()
+            self.sock.close()
+        except OSError:
+            pass
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                pass
+
+
+def run_privileged_helper(argv):
+    """辅助进程入口：--privileged-helper <套接字路径> <界面进程用户 uid> <令牌文件> [--fake-backend <hosts 路径>]"""
+    socket_path, owner_uid = argv[0], int(argv[1])
+    with open(argv[2], 'r', encoding='utf-8') as f:
+        token = f.read().strip()
+    if '--fake-backend' in argv:
+        backend = FakePrivilegedBackend(argv[argv.index('--fake-backend') + 1])
+    else:
+        backend = PrivilegedBackend()
+    try:
+        PrivilegedHelper(socket_path, token, backend, owner_uid).serve()
+    except socket.timeout:
+        pass
+
+
+class PrivilegedBatch:
+    """特权命令批处理 - 把多条需要 root 权限的命令收集起来，只用一次 sudo 全部执行
+    
+    通过 sudo 运行本程序的 --privileged-batch 入口，命令列表以 JSON 写在只有当前用户可访问的临时目录中，
+    由该入口读取并依次执行，每条命令的退出码、输出和耗时以 JSON 返回。单条命令失败不影响后面的命令，由调用方按结果判断。
+    """
+    
+    def __init__(self):
+        self.steps = []
+    
+    def __len__(self):
+        return len(self.steps)
+    
+    def add(self, args, timeout=5, input=None):
+        """添加一条命令（input 为写入该命令标准输入的文本），返回它在结果列表中的下标"""
+        self.steps.append({'args': [str(arg) for arg in args], 'timeout': timeout, 'input': input})
+        return len(self.steps) - 1
+    
+    def run(self, password=None, command=None):
+        """执行全部命令，返回结果列表 [{'args', 'returncode', 'stdout', 'stderr', 'elapsed'}, ...]
+        
+        sudo 失败（如密码错误）时没有结果，抛出 RuntimeError。command 用于测试时直接运行（不经过 sudo）。
+        """
+        if not self.steps:
+            return []
+        if command is None:
+            # -k 保证需要密码时 sudo 总是从标准输入读取；标准输入只传密码，
+            # sudoers 配置了 NOPASSWD 时 sudo 不读取它，命令列表不能与密码共用标准输入
+            command = ['sudo', '-k', '-S', '-p', ''] + PrivilegedHelperClient.helper_command()
+        directory = tempfile.mkdtemp(prefix='domainkiller-')  # 只有当前用户可访问
+        try:
+            steps_path = os.path.join(directory, 'steps.json')
+            with open(os.open(steps_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w', encoding='utf-8') as f:
+                json.dump(self.steps, f)
+            timeout = sum(step['timeout'] for step in self.steps) + 10
+            process = subprocess.run(list(command) + ['--privileged-batch', steps_path],
+                                     input=password + '\n' if password is not None else '',
+                                     capture_output=True, text=True, timeout=timeout)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        lines = process.stdout.strip().splitlines()
+        try:
+            results = json.loads(lines[-1])
+        except (IndexError, ValueError):
+            raise RuntimeError(f"特权命令执行失败: {process.stderr.strip() or process.returncode}")
+        if len(results) != len(self.steps):
+            raise RuntimeError("特权命令结果不完整")
+        return results
+    
+    @staticmethod
+    def summary(results):
+        """一行文字总结：命令数、总耗时和最慢的命令"""
+        total = sum(result['elapsed'] for result in results)
+        slowest = max(results, key=lambda result: result['elapsed'])
+        return (f"{len(results)} 条命令，1 次提权，共 {total:.2f} 秒"
+                f"（最慢: {' '.join(slowest['args'][:2])} {slowest['elapsed']:.2f} 秒）")
+
+
+def run_privileged_batch(argv):
+    """批处理入口：--privileged-batch <命令列表文件>，依次执行，把结果以 JSON 写到标准输出"""
+    with open(argv[0], 'r', encoding='utf-8') as f:
+        steps = json.load(f)
+    results = []
+    for step in steps:
+        started = time.perf_counter()
+        try:
+            # 命令不继承本进程的标准输入（sudo 未读取的密码行可能还留在那里）
+            process = subprocess.run(step['args'], input=step.get('input') or '', capture_output=True, text=True,
+                                     timeout=step.get('timeout', 5))
+            returncode, stdout, stderr = process.returncode, process.stdout, process.stderr
+        except subprocess.TimeoutExpired:
+            returncode, stdout, stderr = -1, '', "执行超时"
+        except OSError as e:
+            returncode, stdout, stderr = -1, '', str(e)
+        results.append({
+            'args': step['args'],
+            'returncode': returncode,
+            'stdout': stdout,
+            'stderr': stderr,
+            'elapsed': round(time.perf_counter() - started, 4),
+        })
+    print(json.dumps(results, ensure_ascii=False), flush=True)
+
+
+class SudoCredential:
+    """sudo 密码缓存 - 记录密码最近一次被确认有效的时间，信任期内直接使用，不再每次运行 sudo -v
+    
+    验证通过或 sudo 命令执行成功都算一次确认，之后 SUDO_TRUST_INTERVAL 秒内 get() 直接返回密码；
+    超过信任期才重新验证。sudo 命令失败时调用 recheck()，只有密码确实失效时才清除缓存。
+    """
+    
+    def __init__(self, trust_interval=SUDO_TRUST_INTERVAL):
+        self.password = None  # 仅在内存中
+        self.trust_interval = trust_interval
+        self.confirmed_at = None  # 最近一次确认有效的时间（time.monotonic），None 表示尚未确认
+        self.lock = threading.Lock()
+        self.stats = {'verified': 0, 'saved': 0, 'invalidated': 0}
+    
+    def set(self, password):
+        """缓存新输入的密码（尚未确认有效，第一次使用前会验证）"""
+        with self.lock:
+            self.password = password or None
+            self.confirmed_at = None
+    
+    def confirm(self):
+        """记录密码刚被一次成功的 sudo 操作确认有效"""
+        with self.lock:
+            if self.password:
+                self.confirmed_at = time.monotonic()
+    
+    def get(self):
+        """返回可用的密码：信任期内直接返回，否则运行 sudo -v 验证；没有密码或密码已失效时返回 None"""
+        with self.lock:
+            if not self.password:
+                return None
+            if self.confirmed_at is not None and time.monotonic() - self.confirmed_at < self.trust_interval:
+                self.stats['saved'] += 1
+                return self.password
+            return self._verify()
+    
+    def recheck(self):
+        """sudo 命令失败后调用：重新验证密码，确实失效时清除缓存，返回密码是否仍然有效"""
+        with self.lock:
+            if not self.password:
+                return False
+            return self._verify() is not None
+    
+    def _verify(self):
+        self.stats['verified'] += 1
+        if self.verify(self.password):
+            self.confirmed_at = time.monotonic()
+            return self.password
+        print("⚠️ sudo 密码已失效，清除缓存")
+        self.stats['invalidated'] += 1
+        self.password = None
+        self.confirmed_at = None
+        return None
+    
+    @staticmethod
+    def verify(password):
+        """运行 sudo -v 验证密码是否有效"""
+        try:
+            # -k 忽略已有的 sudo 时间戳，确保真正检查密码
+            process = subprocess.Popen(
+                ['sudo', '-k', '-S', '-v'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+            process.communicate(input=password + '\n', timeout=5)
+            return process.returncode == 0
+        except:
+            return False
+
+
+class ApiClient:
+    """API 客户端 - 同步和密码验证共用一个带连接池的会话
+    
+    连接保持 keep-alive，之后的请求不再重新进行 TCP 和 TLS 握手；响应使用 gzip 压缩传输。
+    多个线程同时发出相同的请求时只有第一个真正发送，其余线程等待并共用它的响应（single-flight）。
+    """
+    
+    def __init__(self, url=API_URL, timeout=(API_CONNECT_TIMEOUT, API_READ_TIMEOUT)):
+        self.url = url
+        self.timeout = timeout  # (连接超时, 读取超时)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+        self.lock = threading.Lock()
+        self.in_flight = {}  # 请求键 -> [完成事件, 响应, 异常]
+    
+    def get(self, params=None, headers=None):
+        """发送 GET 请求；相同参数和请求头的请求正在进行时等待并返回它的响应（或抛出它的异常）"""
+        key = (tuple(sorted((params or {}).items())), tuple(sorted((headers or {}).items())))
+        with self.lock:
+            call = self.in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self.in_flight[key] = [threading.Event(), None, None]
+        
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        
+        try:
+            response = self.session.get(self.url, params=params, headers=headers, timeout=self.timeout)
+            response.content  # 读完响应体，连接立即归还连接池，等待的线程也可以直接使用
+            call[1] = response
+            return response
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            call[0].set()
+    
+    def close(self):
+        self.session.close()
+
+
+class ApiDomainIndex:
+    """API 域名列表的本地索引 - 按 id 记录每个条目，根据 updated_at 计算增量
+    
+    API 返回的 data.list 中每个条目带有 id、domain、status（1 屏蔽，0 停用）和 updated_at。
+    合并响应时 updated_at 未变化的条目直接跳过，只有变化过的条目才清理域名、比较状态，
+    得到本次新增和移除的域名；屏蔽中的域名按引用计数维护（多个 id 可能对应同一个域名）。
+    
+    服务器支持 since= 参数时只返回该时间之后变化过的条目，并在 data.since 中回显该参数、
+    在 data.deleted 中列出已删除的 id；没有回显时视为完整列表，不在列表中的 id 即已删除。
+    
+    entries  id -> {'domain', 'status', 'updated_at'}
+    active   屏蔽中的域名 -> 对应的 id 数
+    since    服务器最近一次响应的 timestamp，下次请求时作为 since 参数
+    """
+    
+    __slots__ = ('entries', 'active', 'since')
+    
+    def __init__(self, entries=None, since=None):
+        self.entries = dict(entries or {})
+        self.active = {}
+        self.since = since
+        for entry in self.entries.values():
+            self._acquire(entry, set(), set())
+    
+    @classmethod
+    def from_cache(cls, cache):
+        """从 API 缓存中恢复索引，缓存中没有索引时返回空索引"""
+        index = cache.get('index') if isinstance(cache, dict) else None
+        if not isinstance(index, dict) or not isinstance(index.get('entries'), dict):
+            return cls()
+        return cls(index['entries'], index.get('since'))
+    
+    def to_cache(self):
+        return {'entries': self.entries, 'since': self.since}
+    
+    @staticmethod
+    def clean_domain(domain):
+        """清理域名：去除首尾空白、协议前缀（http://, https://）、路径和尾部斜杠，无效时返回空字符串"""
+        domain = str(domain or '').strip()
+        if domain.startswith("http://"):
+            domain = domain[7:]
+        elif domain.startswith("https://"):
+            domain = domain[8:]
+        if "/" in domain:
+            domain = domain.split("/")[0]
+        return domain.rstrip("/").strip()
+    
+    def domains(self):
+        """当前屏蔽中的域名列表"""
+        return list(self.active)
+    
+    def apply(self, items, partial=False, deleted=()):
+        """合并一次 API 响应的 data.list，返回 (新增的域名集合, 移除的域名集合)
+        
+        partial 为 True 时 items 只包含变化过的条目，deleted 为已删除的 id 列表；
+        否则 items 是完整列表。条目缺少 id 时抛出 ValueError，由调用方改用 data.domains。
+        """
+        added = set()
+        removed = set()
+        seen = set()
+        for item in items:
+            if not isinstance(item, dict) or item.get('id') is None:
+                raise ValueError("列表条目缺少 id")
+            key = str(item['id'])  # 与 JSON 缓存中的键保持一致
+            seen.add(key)
+            updated_at = item.get('updated_at')
+            old = self.entries.get(key)
+            if old is not None and updated_at is not None and old['updated_at'] == updated_at:
+                continue
+            entry = {
+                'domain': self.clean_domain(item.get('domain')),
+                'status': 1 if str(item.get('status', 1)) == '1' else 0,
+                'updated_at': updated_at,
+            }
+            if old is not None:
+                self._release(old, added, removed)
+            self.entries[key] = entry
+            self._acquire(entry, added, removed)
+        
+        if partial:
+            gone = [str(key) for key in deleted]
+        else:
+            gone = [key for key in self.entries if key not in seen]
+        for key in gone:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self._release(old, added, removed)
+        return added, removed
+    
+    def _acquire(self, entry, added, removed):
+        domain = entry['domain']
+        if entry['status'] != 1 or not domain:
+            return
+        count = self.active.get(domain, 0)
+        if count == 0:
+            # 同一次合并中先移除又加回的域名不算变化
+            if domain in removed:
+                removed.discard(domain)
+            else:
+                added.add(domain)
+        self.active[domain] = count + 1
+    
+    def _release(self, entry, added, removed):
+        domain = entry['domain']
+        if entry['status'] != 1 or not domain:
+            return
+        count = self.active.get(domain, 0) - 1
+        if count > 0:
+            self.active[domain] = count
+            return
+        self.active.pop(domain, None)
+        if domain in added:
+            added.discard(domain)
+        else:
+            removed.add(domain)
+
+
+class SyncScheduler:
+    """同步调度器 - 根据上次同步的结果决定下次同步前等待多久
+    
+    updated       列表有变化：恢复为基础间隔 CHECK_INTERVAL
+    not_modified  列表未变化：间隔逐次加倍，最长 SYNC_MAX_INTERVAL
+    failed        请求失败：从 SYNC_RETRY_INTERVAL 开始指数退避，最长 SYNC_BACKOFF_MAX；
+                  连续失败 SYNC_BREAKER_THRESHOLD 次后熔断，之后每 SYNC_BREAKER_COOLDOWN 秒才试探一次
+    每次等待时间随机浮动 SYNC_JITTER，启动后的首次等待在 0 到 SYNC_STARTUP_JITTER 秒之间随机，
+    避免大量客户端开机后同时请求 API。wake() 立即结束等待（手动同步，熔断时也会请求）。
+    """
+    
+    def __init__(self):
+        self.failures = 0  # 连续失败次数
+        self.unchanged = 0  # 连续未变化次数
+        self.delay = random.uniform(0, SYNC_STARTUP_JITTER)  # 下次同步前等待的秒数
+        self.wake_event = threading.Event()
+    
+    @property
+    def breaker_open(self):
+        return self.failures >= SYNC_BREAKER_THRESHOLD
+    
+    def record(self, outcome):
+        """记录一次同步的结果，返回下次同步前等待的秒数"""
+        if outcome in ('updated', 'not_modified'):
+            if self.breaker_open:
+                print("✅ API 已恢复，恢复定时同步")
+            self.failures = 0
+            if outcome == 'updated':
+                self.unchanged = 0
+                delay = CHECK_INTERVAL
+            else:
+                self.unchanged += 1
+                delay = min(SYNC_MAX_INTERVAL, CHECK_INTERVAL * 2 ** min(self.unchanged - 1, 16))
+        else:
+            self.failures += 1
+            self.unchanged = 0  # 恢复后先按基础间隔同步，尽快拿到故障期间的变化
+            if self.breaker_open:
+                if self.failures == SYNC_BREAKER_THRESHOLD:
+                    print(f"⚠️ API 连续 {self.failures} 次请求失败，暂停请求 {SYNC_BREAKER_COOLDOWN} 秒")
+                delay = SYNC_BREAKER_COOLDOWN
+            else:
+                delay = min(SYNC_BACKOFF_MAX, SYNC_RETRY_INTERVAL * 2 ** (self.failures - 1))
+        self.delay = delay * random.uniform(1 - SYNC_JITTER, 1 + SYNC_JITTER)
+        return self.delay
+    
+    def wait(self, running):
+        """等待到下次同步的时间；running() 返回 False 或被 wake() 唤醒时提前返回"""
+        deadline = time.monotonic() + self.delay
+        while running():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if self.wake_event.wait(min(1, remaining)):
+                self.wake_event.clear()
+                return
+    
+    def wake(self):
+        """立即开始下一次同步"""
+        self.wake_event.set()
+
+
+class DomainKiller:
+    def __init__(self):
+        self.running = False
+        self.current_domains = set()
+        
+        # 确定文件目录：打包后使用 .app 所在目录，开发模式使用脚本目录
+        if getattr(sys, 'frozen', False):
+            # 打包后的应用：使用 .app 所在目录
+            # sys.executable 指向 .app/Contents/MacOS/DomainKiller
+            # 所以 .app 目录是 parent.parent.parent
+            app_path = Path(sys.executable)
+            if '.app' in str(app_path):
+                # .app/Contents/MacOS/DomainKiller -> .app 目录
+                app_dir = app_path.parent.parent.parent
+                # 使用 .app 目录（与 .app 文件同级）
+                self.script_dir = app_dir
+            else:
+                # 如果不是 .app，使用可执行文件所在目录
+                self.script_dir = app_path.parent
+        else:
+            # 开发模式：使用脚本所在目录
+            if '__file__' in globals():
+                self.script_dir = Path(os.path.dirname(os.path.abspath(__file__)))
+            else:
+                self.script_dir = Path.cwd()
+        
+        self.domains_file = self.script_dir / DOMAINS_FILE
+        self.state_file = self.script_dir / STATE_FILE
+        self.api_cache_file = self.script_dir / API_CACHE_FILE
+        self.dns_backup_file = self.script_dir / DNS_BACKUP_FILE
+        self.hosts_names_per_line = HOSTS_NAMES_PER_LINE if HOSTS_COMPACT else 1  # 屏蔽区块每行写入的域名数
+        self.applied_state = self.load_applied_state()
+        self.sync_scheduler = SyncScheduler()  # 定时同步的调度器
+        self.api_client = ApiClient()  # 同步和密码验证共用的 API 会话
+        self.api_cache = self.load_api_cache()
+        self.api_index = ApiDomainIndex.from_cache(self.api_cache)  # API 条目索引，用于增量同步
+        self.api_fetch_status = None  # 最近一次获取域名列表的结果：updated / not_modified / cached
+        self.api_delta = (set(), set())  # 最近一次获取相对上一次新增和移除的 API 域名
+        print(f"域名文件路径: {self.domains_file}")
+        
+        # 如果是打包后的应用，检查是否需要从打包资源复制文件
+        if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
+            # 检查打包资源中是否有 domains.txt
+            bundled_file = Path(sys._MEIPASS) / DOMAINS_FILE
+            if bundled_file.exists() and not self.domains_file.exists():
+                try:
+                    # 从打包资源复制到 .app 目录
+                    import shutil
+                    shutil.copy2(bundled_file, self.domains_file)
+                    print(f"从打包资源复制 domains.txt 到: {self.domains_file}")
+                except Exception as e:
+                    print(f"复制打包资源失败: {e}")
+        
+        # 如果文件不存在，创建空文件（在 .app 目录中）
+        if not self.domains_file.exists():
+            try:
+                self.domains_file.parent.mkdir(parents=True, exist_ok=True)
+                # 创建带注释的空文件
+                with open(self.domains_file, 'w', encoding='utf-8') as f:
+                    f.write("# 本地域名列表，每行一个域名\n")
+                print(f"创建空的域名文件: {self.domains_file}")
+            except Exception as e:
+                print(f"创建域名文件失败: {e}")
+        self.window = None
+        self.password = None
+        self.sudo_credential = SudoCredential()  # 缓存 sudo 密码（仅在内存中）和最近一次确认有效的时间
+        self.use_pfctl = True  # 使用 pfctl 实现实时拦截
+        self.resolve_cache = ResolutionCache(self.script_dir / RESOLVE_CACHE_FILE)  # 域名解析结果，TTL 过期前不重新解析
+        self.pfctl_ips = None  # 当前已加载到 pfctl 的 IP 集合
+        self.domain_resolver = DomainResolver()  # 并发解析 pfctl 需要拦截的 IP
+        self.resolve_lock = threading.Lock()  # 保护下面三个后台解析状态
+        self.resolve_pending = set()  # 等待后台解析的名称
+        self.resolve_added = set()  # 等待报告解析结果的新增域名
+        self.resolve_running = False  # 后台解析线程是否在运行
+        self.privileged_helper = None  # 特权辅助进程客户端（未启动时各操作单独运行 sudo）
+        self.api_domains = set()  # API 同步的域名列表（当前正在屏蔽的）
+        self.proxy_server = None  # 代理服务器实例
+        self.proxy_thread = None  # 代理服务器线程
+        self.use_proxy = True  # 使用代理服务器拦截（对 Safari 更有效）
+        self.applied_domains = set()  # 屏蔽规则（匹配器、PAC、hosts 条目）当前对应的域名，屏蔽列表变化时只处理差异
+        self.domain_matcher = BlockingProxyHandler.matcher  # 代理和 DNS 屏蔽服务器共用的匹配器
+        self.block_entry_counts = {}  # hosts 屏蔽区块条目 -> 产生该条目的域名数（a.com 和 www.a.com 产生相同的变体）
+        self.hosts_document = None  # 最近一次写入后验证时解析的 hosts 文件
+        self.hosts_watcher = None  # hosts 文件监视器
+        self.hosts_lock = threading.RLock()  # 串行化同步线程、监视线程和界面对 hosts 的修改
+        self.hosts_missing = set()  # 最近一次写入验证发现缺少的条目
+        self.hosts_extra = set()  # 最近一次写入验证发现多出的条目
+        self.session_blocklist_hash = None  # 本次运行中已完整应用过的屏蔽列表哈希（pfctl/代理只在本进程内有效）
+        self.system_proxy_enabled = False  # 系统代理是否已指向本地代理
+        self.system_proxy_pac_version = None  # 系统自动代理当前使用的 PAC 版本
+        self.dns_sinkhole = None  # 本地 DNS 屏蔽服务器（ENFORCEMENT_BACKEND 为 dns 时使用）
+        self.system_dns_enabled = False  # 系统 DNS 是否已指向本地屏蔽服务器
+        self.saved_dns_servers = None  # 切换前各网络服务的 DNS 设置 {服务: [服务器, ...]}，['Empty'] 表示自动获取
+        
+    def fetch_domains_from_api(self, offline_fallback=True):
+        """从 API 获取域名列表和密码
+        
+        带上次响应的 ETag/Last-Modified 发送条件请求：服务器返回 304 或响应内容哈希与上次相同时，
+        直接返回缓存的域名列表，不再解析和清理；网络故障时（offline_fallback 为 True）回退到缓存的域名列表。
+        响应按 data.list 增量合并到本地索引，并带上 since= 参数让服务器只返回变化过的条目。
+        结果来源记录在 self.api_fetch_status 中，相对上次新增和移除的域名记录在 self.api_delta 中。
+        """
+        cache = self.api_cache
+        headers = self.conditional_headers()
+        conditional = headers is not None
+        since = self.api_index.since if conditional and self.api_index.entries else None
+        try:
+            print(f"正在连接 API: {API_URL}")
+            response = self.api_client.get(params={'since': since} if since else None, headers=headers)
+            if conditional and response.status_code == 304:
+                print(f"✓ API 返回 304，域名列表未变化（{len(cache['domains'])} 个域名）")
+                self.api_fetch_status = 'not_modified'
+                self.api_delta = (set(), set())
+                return (list(cache['domains']), self.password)
+            response.raise_for_status()
+            
+            # 服务器不支持条件请求时按内容哈希判断是否变化
+            content_hash = hashlib.sha256(response.content).hexdigest()
+            if conditional and content_hash == cache.get('content_hash'):
+                print(f"✓ API 返回内容与上次相同，域名列表未变化（{len(cache['domains'])} 个域名）")
+                self.api_fetch_status = 'not_modified'
+                self.api_delta = (set(), set())
+                return (list(cache['domains']), self.password)
+            
+            data = response.json()
+            
+            if data.get("code") == 200 and "data" in data:
+                payload = data["data"]
+                password = data.get("password", None)
+                domains, added, removed = self.merge_api_payload(payload, since)
+                self.api_index.since = data.get("timestamp") or self.api_index.since
+                if added or removed:
+                    print(f"✅ API 返回: {len(domains)} 个有效域名，新增 {len(added)} 个，移除 {len(removed)} 个")
+                else:
+                    print(f"✅ API 返回: {len(domains)} 个有效域名，与上次相同")
+                
+                self.save_api_cache(response, content_hash, domains, password)
+                self.api_delta = (added, removed)
+                # 条目和密码都没有变化（响应只是时间戳不同）：与 304 一样处理
+                if conditional and not added and not removed and password == self.password:
+                    self.api_fetch_status = 'not_modified'
+                else:
+                    self.api_fetch_status = 'updated'
+                return (domains, password)
+            else:
+                print(f"⚠️ API 返回错误: {data.get('code', 'unknown')}")
+                return None
+        except requests.exceptions.Timeout:
+            print(f"⚠️ API 请求超时（超过 {API_READ_TIMEOUT} 秒）")
+            return self.cached_api_result() if offline_fallback else None
+        except requests.exceptions.RequestException as e:
+            print(f"⚠️ API 请求失败: {e}")
+            return self.cached_api_result() if offline_fallback else None
+        except Exception as e:
+            print(f"⚠️ 获取域名列表失败: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+    
+    def cached_api_result(self):
+        """网络故障时返回上次 API 响应中的域名列表，没有缓存时返回 None"""
+        if 'domains' not in self.api_cache:
+            return None
+        print(f"使用上次缓存的 API 域名列表（{len(self.api_cache['domains'])} 个域名）")
+        self.api_fetch_status = 'cached'
+        self.api_delta = (set(), set())
+        return (list(self.api_cache['domains']), self.password)
+    
+    def merge_api_payload(self, payload, since):
+        """把 API 响应的 data 合并到本地索引，返回 (当前 API 域名列表, 新增域名集合, 移除域名集合)
+        
+        有 data.list 时按条目增量合并；没有时（或条目缺少 id）用 data.domains 整体替换，与上次的列表比较得到增量。
+        """
+        items = payload.get("list")
+        if isinstance(items, list):
+            # 服务器回显了 since 参数：列表中只有变化过的条目
+            partial = since is not None and payload.get("since") == since
+            try:
+                added, removed = self.api_index.apply(items, partial, payload.get("deleted") or ())
+                return self.api_index.domains(), added, removed
+            except ValueError as e:
+                print(f"⚠️ API 列表无法增量合并（{e}），使用完整域名列表")
+                self.api_index = ApiDomainIndex()
+        
+        previous = set(self.api_cache.get('domains', ()))
+        cleaned = (ApiDomainIndex.clean_domain(domain) for domain in payload.get("domains", []))
+        domains = list(dict.fromkeys(domain for domain in cleaned if domain))
+        current = set(domains)
+        return domains, current - previous, previous - current
+    
+    def conditional_headers(self):
+        """根据上次 API 响应的缓存生成条件请求头（If-None-Match / If-Modified-Since），不能发送条件请求时返回 None"""
+        cache = self.api_cache
+        # 缓存中不保存密码：本进程还没拿到过密码时必须完整请求一次
+        if 'domains' not in cache or (self.password is None and cache.get('has_password')):
+            return None
+        headers = {}
+        if cache.get('etag'):
+            headers['If-None-Match'] = cache['etag']
+        if cache.get('last_modified'):
+            headers['If-Modified-Since'] = cache['last_modified']
+        return headers
+    
+    def load_api_cache(self):
+        """读取上次 API 响应的缓存，文件不存在或损坏时返回空字典"""
+        try:
+            with open(self.api_cache_file, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            if isinstance(cache, dict) and isinstance(cache.get('domains'), list):
+                return cache
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"读取 API 缓存失败: {e}")
+        return {}
+    
+    def save_api_cache(self, response, content_hash, domains, password):
+        """保存 API 响应的验证头、内容哈希、清理后的域名列表和条目索引（不保存密码，先写临时文件再替换）"""
+        self.api_cache = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'content_hash': content_hash,
+            'domains': domains,
+            'has_password': bool(password),
+            'index': self.api_index.to_cache(),
+            'fetched_at': int(time.time()),
+        }
+        try:
+            temp_file = self.api_cache_file.with_name(self.api_cache_file.name + '.tmp')
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.api_cache, f)
+            os.replace(temp_file, self.api_cache_file)
         except Exception as e:
-            print(f"⚠️ 获取域名列表失败: {e}")
-            import traceback
-            traceback.print_exc()
-            return None
+            print(f"保存 API 缓存失败: {e}")
     
     def update_domains_file(self, domains):
         """更新 domains.txt 文件"""
@@ -408,6 +2765,15 @@ class DomainKiller:
             print(f"读取 domains.txt 失败: {e}")
         return domains
     
+    @property
+    def sudo_password(self):
+        """缓存的 sudo 密码（不验证，只用于判断是否已经输入过）"""
+        return self.sudo_credential.password
+    
+    @sudo_password.setter
+    def sudo_password(self, password):
+        self.sudo_credential.set(password)
+    
     def read_hosts_file(self, silent=False):
         """读取 hosts 文件内容
         silent: 如果为 True，不会弹出密码对话框，直接返回空字符串
@@ -431,11 +2797,12 @@ class DomainKiller:
                         )
                         stdout, stderr = process.communicate(input=self.sudo_password + '\n', timeout=10)
                         if process.returncode == 0:
+                            self.sudo_credential.confirm()
                             return stdout
-                        # 密码失效，清除缓存
-                        self.sudo_password = None
+                        # 读取失败，重新验证密码，失效时清除缓存
+                        self.sudo_credential.recheck()
                     except:
-                        self.sudo_password = None
+                        self.sudo_credential.recheck()
                 return ""
             
             # 非静默模式：获取密码（使用缓存）
@@ -453,26 +2820,42 @@ class DomainKiller:
                 )
                 stdout, stderr = process.communicate(input=password + '\n', timeout=10)
                 if process.returncode == 0:
+                    self.sudo_credential.confirm()
                     return stdout
-                # 如果失败，清除缓存的密码
-                self.sudo_password = None
+                # 如果失败，重新验证密码，失效时清除缓存
+                self.sudo_credential.recheck()
                 return ""
             except:
-                self.sudo_password = None
+                self.sudo_credential.recheck()
                 return ""
         except Exception as e:
             print(f"读取 hosts 文件失败: {e}")
             return ""
     
+    def read_hosts_document(self, silent=False):
+        """读取并解析 hosts 文件，返回 HostsDocument，读取失败时返回 None
+        能直接读取时使用内存映射，只解码屏蔽区块；需要 sudo 读取时退回到 read_hosts_file
+        """
+        try:
+            return HostsDocument.from_file(HOSTS_PATH)
+        except PermissionError:
+            pass
+        except Exception as e:
+            print(f"读取 hosts 文件失败: {e}")
+            return None
+        
+        hosts_content = self.read_hosts_file(silent=silent)
+        if not hosts_content:
+            return None
+        return HostsDocument.parse(hosts_content)
+    
     def get_sudo_password(self, message="需要管理员权限", use_cache=True):
         """使用 osascript 获取 sudo 密码（支持缓存）"""
-        # 如果已有缓存的密码，先验证是否仍然有效
-        if use_cache and self.sudo_password:
-            if self.verify_sudo_password(self.sudo_password):
-                return self.sudo_password
-            else:
-                # 密码已失效，清除缓存
-                self.sudo_password = None
+        # 如果已有缓存的密码，信任期内直接使用，超过信任期才验证是否仍然有效（失效时自动清除缓存）
+        if use_cache:
+            password = self.sudo_credential.get()
+            if password:
+                return password
         
         # 获取新密码
         try:
@@ -504,82 +2887,92 @@ class DomainKiller:
         except:
             return None
     
-    def verify_sudo_password(self, password):
-        """验证 sudo 密码是否仍然有效"""
+    def start_privileged_helper(self):
+        """用缓存的 sudo 密码启动特权辅助进程，之后写 hosts、更新 pf 和刷新 DNS 都通过它完成"""
+        if not PRIVILEGED_HELPER_ENABLED or self.privileged_helper or not self.sudo_password:
+            return self.privileged_helper is not None
         try:
-            # 使用 sudo -v 验证密码
-            process = subprocess.Popen(
-                ['sudo', '-S', '-v'],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            process.communicate(input=password + '\n', timeout=5)
-            return process.returncode == 0
-        except:
+            self.privileged_helper = PrivilegedHelperClient.launch(self.sudo_password)
+            self.sudo_credential.confirm()
+            print("✅ 特权辅助进程已启动")
+            return True
+        except Exception as e:
+            print(f"⚠️ 特权辅助进程启动失败，改为每个操作单独运行 sudo: {e}")
             return False
     
-    def resolve_domain_to_ips(self, domain):
-        """解析域名到IP地址列表（强制解析真实IP，用于pfctl拦截）"""
-        ips = set()
-        
-        # 方法1: 使用 dig 命令（更可靠）
+    def stop_privileged_helper(self):
+        """断开与特权辅助进程的连接（辅助进程随之退出）"""
+        helper, self.privileged_helper = self.privileged_helper, None
+        if helper:
+            helper.close()
+    
+    def privileged_call(self, op, **args):
+        """通过特权辅助进程执行操作，返回结果；辅助进程不可用或操作失败时返回 None，调用方改用 sudo"""
+        helper = self.privileged_helper
+        if helper is None:
+            return None
         try:
-            process = subprocess.Popen(
-                ['dig', '+short', domain],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            stdout, stderr = process.communicate(timeout=5)
-            
-            for line in stdout.strip().split('\n'):
-                ip = line.strip()
-                if ip and ip != '127.0.0.1' and not ip.startswith(';'):
-                    # 验证是否是有效的IP地址
-                    parts = ip.split('.')
-                    if len(parts) == 4 and all(p.isdigit() and 0 <= int(p) <= 255 for p in parts):
-                        ips.add(ip)
-        except:
-            pass
-        
-        # 方法2: 如果 dig 失败，使用 nslookup
-        if not ips:
-            try:
-                process = subprocess.Popen(
-                    ['nslookup', domain],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                stdout, stderr = process.communicate(timeout=5)
-                
-                # 提取IP地址
-                for line in stdout.split('\n'):
-                    if 'Address:' in line and '127.0.0.1' not in line:
-                        ip = line.split('Address:')[-1].strip()
-                        if ip and ip != '127.0.0.1':
-                            # 验证是否是有效的IP地址
-                            parts = ip.split('.')
-                            if len(parts) == 4 and all(p.isdigit() and 0 <= int(p) <= 255 for p in parts):
-                                ips.add(ip)
-            except:
-                pass
-        
-        # 方法3: 如果都失败，尝试使用 hosts 文件（但这不是我们想要的，因为我们需要真实IP）
-        # 注意：即使 hosts 文件已写入，我们仍然需要解析真实IP来创建pfctl规则
-        # 这样才能实时拦截已建立的连接
-        
-        if not ips:
-            print(f"⚠️ 无法解析域名 {domain} 的真实IP地址")
+            return helper.call(op, **args)
+        except RuntimeError as e:
+            print(f"⚠️ 特权操作 {op} 失败: {e}")
+            return None
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 特权辅助进程连接中断，改为每个操作单独运行 sudo: {e}")
+            if self.privileged_helper is helper:
+                self.privileged_helper = None
+            return None
+    
+    def run_privileged_batch(self, batch):
+        """用缓存的 sudo 密码一次执行整批特权命令，返回每条命令的结果列表；sudo 失败时返回 None"""
+        try:
+            results = batch.run(self.sudo_password)
+            self.sudo_credential.confirm()
+            print(f"特权命令: {PrivilegedBatch.summary(results)}")
+            return results
+        except Exception as e:
+            print(f"⚠️ {e}")
+            # sudo 没有执行命令（多半是密码失效），重新验证，失效时清除缓存
+            self.sudo_credential.recheck()
+            return None
+    
+    def run_prepared(self, *prepares):
+        """依次准备各操作，把它们需要的特权命令收集到同一批中一次 sudo 执行，返回各操作的结果
         
-        return ips
+        每个 prepare(batch) 先完成不需要 root 的部分（或通过特权辅助进程直接执行），把其余命令加入 batch，
+        返回 finish(results)；整批执行后按顺序调用 finish，由它根据自己那几条命令的结果报告并返回该操作的结果。
+        sudo 失败时 results 为 None。
+        """
+        batch = PrivilegedBatch()
+        finishers = [prepare(batch) for prepare in prepares]
+        results = self.run_privileged_batch(batch) if batch else []
+        return [finish(results) for finish in finishers]
     
-    def setup_pfctl_rules(self, domains):
-        """设置 pfctl 防火墙规则（实时拦截）"""
+    def report_failed_steps(self, results, steps, ignore=()):
+        """报告批处理中 steps 这几条命令里执行失败的命令，全部成功时返回 True
+        ignore: 非零退出码属于正常情况的命令名（如找不到进程时的 killall）
+        """
+        if results is None:
+            return False
+        success = True
+        for step in steps:
+            result = results[step]
+            if result['returncode'] != 0 and result['args'][0] not in ignore:
+                print(f"⚠️ 特权命令失败: {' '.join(result['args'][:3])} - {result['stderr'].strip() or result['returncode']}")
+                success = False
+        return success
+    
+    def setup_pfctl_rules(self, added=()):
+        """设置 pfctl 防火墙规则（实时拦截），单独执行一次 sudo"""
+        return self.run_prepared(lambda batch: self.prepare_pfctl_rules(added, batch))[0]
+    
+    def prepare_pfctl_rules(self, added, batch):
+        """准备 pfctl 防火墙规则（实时拦截），返回 finish(results)（见 run_prepared）
+        要拦截的名称就是 hosts 屏蔽区块条目（全部域名及其变体）。立即应用缓存中未过期和仍在宽限期内的 IP，
+        不等待 DNS；缓存中没有或已过期的名称在后台重新解析，完成后只把变化的地址推送到 pf 地址表
+        added: 本次新增的域名，后台解析完成后报告其中无法解析的域名
+        """
         if not self.use_pfctl:
-            return True
+            return lambda results: True
         
         try:
             if not self.sudo_password:
@@ -587,126 +2980,188 @@ class DomainKiller:
                 password = self.get_sudo_password("需要管理员权限设置防火墙规则", use_cache=True)
                 if not password:
                     print("⚠️ 无法获取密码，跳过 pfctl 设置")
-                    return False
-            
-            # 收集所有域名的IP地址（强制解析真实IP）
-            all_ips = set()
-            failed_domains = []
-            
-            for domain in domains:
-                variants = self.expand_domain_variants(domain)
-                domain_ips = set()
-                for variant in variants:
-                    ips = self.resolve_domain_to_ips(variant)
-                    domain_ips.update(ips)
-                    all_ips.update(ips)
-                    if ips:
-                        print(f"域名 {variant} 解析到: {', '.join(ips)}")
-                
-                # 如果某个域名的所有变体都解析失败，记录
-                if not domain_ips:
-                    failed_domains.append(domain)
-            
-            if not all_ips:
-                if failed_domains:
-                    print(f"⚠️ 以下域名无法解析IP地址，将仅使用 hosts 文件屏蔽: {', '.join(failed_domains)}")
-                else:
-                    print("⚠️ 所有域名无法解析IP地址，将仅使用 hosts 文件屏蔽")
-                # 即使无法解析IP，也返回True，因为hosts文件屏蔽仍然有效
-                return True
-            
-            # 生成 pfctl 规则文件
-            rules_content = "# DomainKiller pfctl Rules - Auto Generated\n"
-            rules_content += "# Block outbound connections to blocked domains\n\n"
-            
-            for ip in sorted(all_ips):
-                # 阻止所有到这些IP的出站连接
-                rules_content += f"block out quick to {ip}\n"
-            
-            # 写入规则文件
-            with open(PFCTL_RULES_FILE, 'w') as f:
-                f.write(rules_content)
+                    return lambda results: False
             
-            # 应用 pfctl 规则
-            # 首先检查 pfctl 是否已启用
-            check_process = subprocess.Popen(
-                ['sudo', '-S', 'pfctl', '-s', 'info'],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            check_process.communicate(input=self.sudo_password + '\n', timeout=5)
-            
-            # 如果 pfctl 未启用，先启用它
-            if check_process.returncode != 0:
-                enable_process = subprocess.Popen(
-                    ['sudo', '-S', 'pfctl', '-e'],
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                enable_process.communicate(input=self.sudo_password + '\n', timeout=5)
+            # 已移除的域名丢弃解析结果，其余名称直接使用缓存的 IP
+            names = set(self.block_entry_counts)
+            self.resolve_cache.retain(names)
+            self.resolve_cache.save()
+            all_ips = self.cached_block_ips(names)
+            self.refresh_resolutions(self.resolve_cache.expired(names), added)
             
-            # 清除旧规则（如果存在）
+            if not all_ips and self.pfctl_ips is None:
+                # 还没有可拦截的地址（如缓存为空）：后台解析完成后再加载规则
+                if names:
+                    print("pfctl 规则将在域名解析完成后加载")
+                return lambda results: True
+            return self.prepare_pfctl_ips(all_ips, batch)
+        except Exception as e:
+            print(f"⚠️ 设置 pfctl 规则失败: {e}")
+            # 即使失败，也不影响 hosts 文件屏蔽
+            return lambda results: False
+    
+    def cached_block_ips(self, names):
+        """names 当前需要拦截的全部 IP（解析缓存中未过期和仍在宽限期内的地址）"""
+        all_ips = set()
+        for name in names:
+            all_ips.update(self.resolve_cache.ips(name))
+        return all_ips
+    
+    def refresh_resolutions(self, names, added=()):
+        """在后台线程中重新解析 names（已在解析时合并到下一轮），不阻塞屏蔽流程"""
+        if not names:
+            return
+        with self.resolve_lock:
+            self.resolve_pending |= set(names)
+            self.resolve_added |= set(added)
+            if self.resolve_running:
+                return
+            self.resolve_running = True
+        threading.Thread(target=self.run_resolve_refresh, daemon=True).start()
+    
+    def refresh_expired_resolutions(self):
+        """屏蔽列表未变化时调用：后台重新解析 TTL 已过期的名称，跟上 CDN 的地址轮换"""
+        if not self.use_pfctl or self.pfctl_ips is None:
+            return
+        with self.hosts_lock:
+            self.refresh_resolutions(self.resolve_cache.expired(self.block_entry_counts))
+    
+    def run_resolve_refresh(self):
+        """后台解析线程：并发解析待解析的名称，把结果写入缓存，并只把变化的地址推送到 pf 地址表"""
+        while True:
+            with self.resolve_lock:
+                names, self.resolve_pending = self.resolve_pending, set()
+                added, self.resolve_added = self.resolve_added, set()
+                if not names:
+                    self.resolve_running = False
+                    return
             try:
-                clear_process = subprocess.Popen(
-                    ['sudo', '-S', 'pfctl', '-f', '/dev/null'],
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                clear_process.communicate(input=self.sudo_password + '\n', timeout=5)
-            except:
-                pass
-            
-            # 加载新规则
-            load_process = subprocess.Popen(
-                ['sudo', '-S', 'pfctl', '-f', PFCTL_RULES_FILE],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            stdout, stderr = load_process.communicate(input=self.sudo_password + '\n', timeout=10)
+                resolved = self.domain_resolver.resolve(names)
+                with self.hosts_lock:
+                    # 解析期间屏蔽列表可能已变化：只记录仍在屏蔽的名称
+                    current = set(self.block_entry_counts)
+                    self.resolve_cache.update({name: ips for name, ips in resolved.items() if name in current})
+                    self.resolve_cache.retain(current)
+                    self.resolve_cache.save()
+                    
+                    # 新增域名的所有变体都解析失败或超时时记录（下次同步时重新解析）
+                    failed_domains = [domain for domain in added if domain in self.applied_domains
+                                      and not any(self.resolve_cache.ips(variant)
+                                                  for variant in self.expand_domain_variants(domain))]
+                    if failed_domains:
+                        print(f"⚠️ 以下域名无法解析IP地址，将仅使用 hosts 文件屏蔽: {', '.join(sorted(failed_domains)[:20])}")
+                    
+                    all_ips = self.cached_block_ips(current)
+                    if not all_ips and current:
+                        print("⚠️ 所有域名无法解析IP地址，将仅使用 hosts 文件屏蔽")
+                    if not self.use_pfctl or all_ips == (self.pfctl_ips or set()) or not self.sudo_password:
+                        continue
+                    self.run_prepared(lambda batch: self.prepare_pfctl_ips(all_ips, batch))
+            except Exception as e:
+                print(f"⚠️ 后台解析域名失败: {e}")
+    
+    def prepare_pfctl_ips(self, all_ips, batch):
+        """把 pf 地址表更新为 all_ips，返回 finish(results)（见 run_prepared）
+        地址表已加载时只增删变化的地址，否则整体加载规则
+        """
+        if not all_ips:
+            # 已加载的地址全部失效（如屏蔽的域名都已移除）：清除规则
+            finish_removal = self.prepare_pfctl_removal(batch) if self.pfctl_ips else None
             
-            if load_process.returncode == 0:
+            def finish(results):
+                if finish_removal:
+                    finish_removal(results)
+                # 即使无法解析IP，也返回True，因为hosts文件屏蔽仍然有效
+                return True
+            return finish
+        
+        # IP 集合与已加载的规则相同（例如只增删了无法解析的域名）：不重新加载
+        if all_ips == self.pfctl_ips:
+            print(f"pfctl 规则未变化，继续拦截 {len(all_ips)} 个IP地址")
+            return lambda results: True
+        
+        # 地址表已加载：只增删变化的地址
+        if self.pfctl_ips is not None:
+            return self.prepare_pfctl_table_update(all_ips, batch)
+        
+        # 特权辅助进程：只替换 pf 地址表中的地址
+        result = self.privileged_call('replace_pf_table', ips=sorted(all_ips))
+        if result is not None:
+            self.pfctl_ips = all_ips
+            print(f"✅ pfctl 规则已应用，实时拦截 {result['count']} 个IP地址")
+            return lambda results: True
+        
+        # 应用 pfctl 规则：启用、加载和验证与本批其他特权命令在同一次 sudo 中完成
+        # 规则通过标准输入交给 pfctl，不写入 /tmp 中的文件（其他用户可以预先放置符号链接或改写内容）
+        # pfctl 已启用时 -e 返回非零，可以忽略；加载规则会整体替换原有规则
+        batch.add(['pfctl', '-e'])
+        load_step = batch.add(['pfctl', '-f', '-'], timeout=10,
+                              input=PrivilegedBackend.pf_ruleset(PFCTL_TABLE, sorted(all_ips)))
+        verify_step = batch.add(['pfctl', '-t', PFCTL_TABLE, '-T', 'show'])
+        
+        def finish(results):
+            if results is None:
+                print("⚠️ pfctl 规则应用失败: sudo 执行失败")
+                return False
+            load_result = results[load_step]
+            if load_result['returncode'] == 0:
                 print(f"✅ pfctl 规则已应用，实时拦截 {len(all_ips)} 个IP地址")
+                self.pfctl_ips = all_ips
                 
                 # 验证规则是否生效
-                self.verify_pfctl_rules()
+                self.verify_pfctl_rules(results[verify_step])
                 
                 return True
             else:
-                print(f"⚠️ pfctl 规则应用失败: {stderr}")
+                print(f"⚠️ pfctl 规则应用失败: {load_result['stderr']}")
                 return False
-        except Exception as e:
-            print(f"⚠️ 设置 pfctl 规则失败: {e}")
-            # 即使失败，也不影响 hosts 文件屏蔽
-            return False
+        return finish
+    
+    def prepare_pfctl_table_update(self, all_ips, batch):
+        """在已加载的 pf 地址表中只增删与 self.pfctl_ips 不同的地址，返回 finish(results)
+        增删失败时（例如规则已被外部清除）单独执行一次整体重新加载
+        """
+        add = sorted(all_ips - self.pfctl_ips)
+        delete = sorted(self.pfctl_ips - all_ips)
+        steps = []
+        if self.privileged_call('update_pf_table', add=add, delete=delete) is None:
+            for action, ips in (('delete', delete), ('add', add)):
+                if ips:
+                    steps.append(batch.add(['pfctl', '-t', PFCTL_TABLE, '-T', action, '-f', '-'],
+                                           input='\n'.join(ips) + '\n'))
+        
+        def finish(results):
+            if steps and not self.report_failed_steps(results, steps):
+                if results is None:
+                    return False
+                self.pfctl_ips = None
+                return self.setup_pfctl_rules()
+            self.pfctl_ips = all_ips
+            print(f"✅ pfctl 地址表已更新: 新增 {len(add)} 个，移除 {len(delete)} 个，实时拦截 {len(all_ips)} 个IP地址")
+            return True
+        return finish
     
-    def verify_pfctl_rules(self):
-        """验证 pfctl 规则是否生效"""
+    def verify_pfctl_rules(self, result=None):
+        """验证 pfctl 规则是否生效
+        result: 批处理中 pfctl -t <表> -T show 的结果，为空时单独执行一次
+        """
         try:
-            if not self.sudo_password:
-                return False
-            
-            process = subprocess.Popen(
-                ['sudo', '-S', 'pfctl', '-s', 'rules'],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            stdout, stderr = process.communicate(input=self.sudo_password + '\n', timeout=5)
+            if result is None:
+                if not self.sudo_password:
+                    return False
+                batch = PrivilegedBatch()
+                batch.add(['pfctl', '-t', PFCTL_TABLE, '-T', 'show'])
+                results = self.run_privileged_batch(batch)
+                if results is None:
+                    return False
+                result = results[0]
+            stdout, stderr = result['stdout'], result['stderr']
             
-            if process.returncode == 0:
-                # 统计 block 规则数量
-                block_count = stdout.count('block out quick')
+            if result['returncode'] == 0:
+                # 统计地址表中的地址数量
+                block_count = sum(1 for line in stdout.splitlines() if line.strip())
                 if block_count > 0:
-                    print(f"✅ pfctl 验证: 当前有 {block_count} 条拦截规则生效")
+                    print(f"✅ pfctl 验证: 当前拦截 {block_count} 个IP地址")
                     return True
                 else:
                     print("⚠️ pfctl 验证: 未找到拦截规则")
@@ -721,31 +3176,31 @@ class DomainKiller:
     def remove_pfctl_rules(self):
         """移除 pfctl 防火墙规则"""
         try:
-            if not self.sudo_password:
-                return True
-            
-            # 清除所有 pfctl 规则
-            process = subprocess.Popen(
-                ['sudo', '-S', 'pfctl', '-f', '/dev/null'],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            process.communicate(input=self.sudo_password + '\n', timeout=5)
-            
-            # 删除规则文件
-            try:
-                if os.path.exists(PFCTL_RULES_FILE):
-                    os.unlink(PFCTL_RULES_FILE)
-            except:
-                pass
-            
-            print("✅ pfctl 规则已清除")
-            return True
+            return self.run_prepared(self.prepare_pfctl_removal)[0]
         except:
             return False
     
+    def prepare_pfctl_removal(self, batch):
+        """准备移除 pfctl 防火墙规则，返回 finish(results)（见 run_prepared）"""
+        if self.privileged_call('replace_pf_table', ips=[]) is not None:
+            self.pfctl_ips = None
+            print("✅ pfctl 规则已清除")
+            return lambda results: True
+        
+        if not self.sudo_password:
+            return lambda results: True
+        
+        # 清除所有 pfctl 规则
+        step = batch.add(['pfctl', '-f', '/dev/null'])
+        
+        def finish(results):
+            self.pfctl_ips = None
+            if not self.report_failed_steps(results, [step]):
+                return False
+            print("✅ pfctl 规则已清除")
+            return True
+        return finish
+    
     def check_proxy_server_status(self):
         """检查代理服务器是否正在运行"""
         try:
@@ -789,28 +3244,68 @@ class DomainKiller:
         except Exception as e:
             print(f"更新代理状态失败: {e}")
     
-    def start_proxy_server(self, domains):
-        """启动本地 HTTP 代理服务器"""
+    def blocklist_delta(self, domains):
+        """返回 domains 相对当前已应用的屏蔽列表新增和移除的域名"""
+        domains = set(domains)
+        return domains - self.applied_domains, self.applied_domains - domains
+    
+    def update_blocklist_rules(self, added, removed):
+        """按新增和移除的域名更新屏蔽规则：生成新的匹配器并一次替换引用，PAC 脚本和 hosts 屏蔽区块条目只处理变化的域名"""
+        if not added and not removed:
+            return
+        # 先构建好新的匹配器，再一次替换代理和 DNS 屏蔽服务器使用的引用
+        matcher, changed = self.domain_matcher.updated(added, removed)
+        BlockingProxyHandler.matcher = matcher
+        self.domain_matcher = matcher
+        if self.dns_sinkhole:
+            self.dns_sinkhole.update(matcher)
+        BlockingProxyHandler.pac_generator.patch(matcher, changed)
+        counts = self.block_entry_counts
+        for domain in removed:
+            for variant in self.expand_domain_variants(domain):
+                counts[variant] -= 1
+                if not counts[variant]:
+                    del counts[variant]
+        for domain in added:
+            for variant in self.expand_domain_variants(domain):
+                counts[variant] = counts.get(variant, 0) + 1
+        self.applied_domains -= removed
+        self.applied_domains |= added
+        print(f"✅ 屏蔽规则已更新: 新增 {len(added)} 个，移除 {len(removed)} 个，共 {len(self.applied_domains)} 个域名")
+    
+    def start_proxy_server(self):
+        """启动本地 HTTP 代理服务器（已在运行时保持不变，屏蔽列表由 update_blocklist_rules 替换匹配器）"""
+        return self.run_prepared(self.prepare_proxy_server)[0]
+    
+    def prepare_proxy_server(self, batch):
+        """启动本地 HTTP 代理服务器，并把设置系统代理的命令加入 batch，返回 finish(results)（见 run_prepared）"""
         if not self.use_proxy:
             if self.window:
                 self.window.after(0, lambda: self.update_proxy_status_in_window())
-            return False
+            return lambda results: False
         
         try:
-            # 停止旧代理服务器（如果存在）
-            self.stop_proxy_server()
+            # 代理服务器已在运行：保持现有连接，只在系统代理未设置时重新设置
+            if self.proxy_server and self.proxy_thread and self.proxy_thread.is_alive():
+                if self.system_proxy_enabled and (
+                        PROXY_MODE != 'pac'
+                        or self.system_proxy_pac_version == BlockingProxyHandler.pac_generator.version):
+                    return lambda results: True
+                return self.prepare_system_proxy(batch)
             
-            # 更新被屏蔽的域名列表
-            BlockingProxyHandler.blocked_domains = set(domains)
-            # 添加域名变体
-            for domain in domains:
-                BlockingProxyHandler.blocked_domains.add(domain)
-                BlockingProxyHandler.blocked_domains.add('www.' + domain)
-                if domain.startswith('www.'):
-                    BlockingProxyHandler.blocked_domains.add(domain[4:])
+            # 旧服务器线程已异常退出，释放端口后重新创建
+            if self.proxy_server:
+                try:
+                    self.proxy_server.server_close()
+                except Exception:
+                    pass
+                self.proxy_server = None
             
-            # 创建代理服务器
-            self.proxy_server = HTTPServer(('127.0.0.1', PROXY_PORT), BlockingProxyHandler)
+            # 创建代理服务器（多线程，单个 HTTPS 隧道不会阻塞其他请求）
+            self.proxy_server = ConcurrentProxyServer(
+                ('127.0.0.1', PROXY_PORT), BlockingProxyHandler,
+                max_connections=PROXY_MAX_CONNECTIONS
+            )
             
             # 在后台线程中运行代理服务器
             def run_proxy():
@@ -835,133 +3330,119 @@ class DomainKiller:
                 self.window.after(0, lambda: self.update_proxy_status_in_window())
             
             # 设置系统代理
-            result = self.setup_system_proxy()
-            
-            # 再次更新状态（确保显示最新状态）
-            if self.window:
-                self.window.after(100, lambda: self.update_proxy_status_in_window())
-            
-            return result
+            finish_system_proxy = self.prepare_system_proxy(batch)
         except Exception as e:
             print(f"启动代理服务器失败: {e}")
             import traceback
             traceback.print_exc()
             if self.window:
                 self.window.after(0, lambda: self.update_proxy_status_in_window())
-            return False
+            return lambda results: False
+        
+        def finish(results):
+            result = finish_system_proxy(results)
+            
+            # 再次更新状态（确保显示最新状态）
+            if self.window:
+                self.window.after(100, lambda: self.update_proxy_status_in_window())
+            
+            return result
+        return finish
     
     def stop_proxy_server(self):
         """停止代理服务器"""
         try:
             if self.proxy_server:
                 self.proxy_server.shutdown()
+                self.proxy_server.server_close()
                 self.proxy_server = None
             # 清除系统代理设置
-            self.clear_system_proxy()
-            # 更新状态显示
-            if self.window:
-                self.window.after(0, lambda: self.update_proxy_status_in_window())
-        except:
-            pass
-    
-    def setup_system_proxy(self):
-        """设置系统代理（需要管理员权限）"""
-        try:
-            if not self.sudo_password:
-                password = self.get_sudo_password("需要管理员权限设置系统代理", use_cache=True)
-                if not password:
-                    return False
-            
-            # 获取当前网络服务名称
-            try:
-                process = subprocess.Popen(
-                    ['networksetup', '-listallnetworkservices'],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                stdout, stderr = process.communicate(timeout=5)
-                
-                if process.returncode == 0:
-                    # 查找第一个活动网络服务（通常是 Wi-Fi 或 Ethernet）
-                    lines = stdout.strip().split('\n')[1:]  # 跳过第一行标题
-                    active_service = None
-                    for line in lines:
-                        service = line.strip()
-                        if service and not service.startswith('*'):
-                            active_service = service
-                            break
-                    
-                    if active_service:
-                        # 设置 HTTP 代理
-                        http_proxy_cmd = [
-                            'sudo', '-S', 'networksetup', '-setwebproxy',
-                            active_service, '127.0.0.1', str(PROXY_PORT)
-                        ]
-                        process = subprocess.Popen(
-                            http_proxy_cmd,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            text=True
-                        )
-                        process.communicate(input=self.sudo_password + '\n', timeout=5)
-                        
-                        # 设置 HTTPS 代理
-                        https_proxy_cmd = [
-                            'sudo', '-S', 'networksetup', '-setsecurewebproxy',
-                            active_service, '127.0.0.1', str(PROXY_PORT)
-                        ]
-                        process = subprocess.Popen(
-                            https_proxy_cmd,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            text=True
-                        )
-                        process.communicate(input=self.sudo_password + '\n', timeout=5)
-                        
-                        # 启用代理
-                        enable_cmd = [
-                            'sudo', '-S', 'networksetup', '-setwebproxystate',
-                            active_service, 'on'
-                        ]
-                        process = subprocess.Popen(
-                            enable_cmd,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            text=True
-                        )
-                        process.communicate(input=self.sudo_password + '\n', timeout=5)
-                        
-                        enable_https_cmd = [
-                            'sudo', '-S', 'networksetup', '-setsecurewebproxystate',
-                            active_service, 'on'
-                        ]
-                        process = subprocess.Popen(
-                            enable_https_cmd,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            text=True
-                        )
-                        process.communicate(input=self.sudo_password + '\n', timeout=5)
-                        
-                        print(f"✅ 系统代理已设置: {active_service} -> 127.0.0.1:{PROXY_PORT}")
-                        return True
-            except Exception as e:
-                print(f"设置系统代理失败: {e}")
-                return False
+            self.clear_system_proxy()
+            # 更新状态显示
+            if self.window:
+                self.window.after(0, lambda: self.update_proxy_status_in_window())
+        except:
+            pass
+    
+    def setup_system_proxy(self):
+        """设置系统代理（需要管理员权限）"""
+        return self.run_prepared(self.prepare_system_proxy)[0]
+    
+    def prepare_system_proxy(self, batch):
+        """把设置系统代理的命令加入 batch，返回 finish(results)（见 run_prepared）"""
+        try:
+            if not self.sudo_password:
+                password = self.get_sudo_password("需要管理员权限设置系统代理", use_cache=True)
+                if not password:
+                    return lambda results: False
+            
+            # 获取当前网络服务名称
+            process = subprocess.Popen(
+                ['networksetup', '-listallnetworkservices'],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+            stdout, stderr = process.communicate(timeout=5)
+            
+            # 查找第一个活动网络服务（通常是 Wi-Fi 或 Ethernet）
+            active_service = None
+            if process.returncode == 0:
+                lines = stdout.strip().split('\n')[1:]  # 跳过第一行标题
+                for line in lines:
+                    service = line.strip()
+                    if service and not service.startswith('*'):
+                        active_service = service
+                        break
+            if not active_service:
+                print("设置系统代理失败: 未找到可用的网络服务")
+                return lambda results: False
+            
+            pac_version = BlockingProxyHandler.pac_generator.version
+            if PROXY_MODE == 'pac':
+                # PAC 模式：只有被屏蔽的域名走代理，其余直连
+                # URL 带上版本号，屏蔽列表变化后系统会重新下载 PAC 文件
+                pac_url = f"http://127.0.0.1:{PROXY_PORT}{PAC_PATH}?v={pac_version}"
+                commands = [
+                    ['networksetup', '-setautoproxyurl', active_service, pac_url],
+                    ['networksetup', '-setautoproxystate', active_service, 'on'],
+                ]
+            else:
+                # 全局模式：所有 HTTP/HTTPS 流量走代理
+                commands = [
+                    ['networksetup', '-setwebproxy', active_service, '127.0.0.1', str(PROXY_PORT)],
+                    ['networksetup', '-setsecurewebproxy', active_service, '127.0.0.1', str(PROXY_PORT)],
+                    ['networksetup', '-setwebproxystate', active_service, 'on'],
+                    ['networksetup', '-setsecurewebproxystate', active_service, 'on'],
+                ]
+            
+            # 设置命令与本批其他特权命令在同一次 sudo 中执行
+            steps = [batch.add(cmd) for cmd in commands]
         except Exception as e:
-            print(f"设置系统代理异常: {e}")
-            return False
+            print(f"设置系统代理失败: {e}")
+            return lambda results: False
+        
+        def finish(results):
+            if not self.report_failed_steps(results, steps):
+                print("设置系统代理失败")
+                return False
+            
+            if PROXY_MODE == 'pac':
+                print(f"✅ 系统自动代理已设置: {active_service} -> {pac_url}")
+                self.system_proxy_enabled = True
+                self.system_proxy_pac_version = pac_version
+                return True
+            print(f"✅ 系统代理已设置: {active_service} -> 127.0.0.1:{PROXY_PORT}")
+            self.system_proxy_enabled = True
+            return True
+        return finish
     
     def clear_system_proxy(self):
         """清除系统代理设置"""
         try:
             if not self.sudo_password:
                 return
+            self.system_proxy_enabled = False
             
             # 获取当前网络服务名称
             try:
@@ -974,39 +3455,18 @@ class DomainKiller:
                 stdout, stderr = process.communicate(timeout=5)
                 
                 if process.returncode == 0:
+                    # 所有网络服务的禁用命令在一次 sudo 中执行
+                    batch = PrivilegedBatch()
                     lines = stdout.strip().split('\n')[1:]
                     for line in lines:
                         service = line.strip()
                         if service and not service.startswith('*'):
                             # 禁用代理
-                            try:
-                                disable_cmd = [
-                                    'sudo', '-S', 'networksetup', '-setwebproxystate',
-                                    service, 'off'
-                                ]
-                                process = subprocess.Popen(
-                                    disable_cmd,
-                                    stdin=subprocess.PIPE,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    text=True
-                                )
-                                process.communicate(input=self.sudo_password + '\n', timeout=5)
-                                
-                                disable_https_cmd = [
-                                    'sudo', '-S', 'networksetup', '-setsecurewebproxystate',
-                                    service, 'off'
-                                ]
-                                process = subprocess.Popen(
-                                    disable_https_cmd,
-                                    stdin=subprocess.PIPE,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    text=True
-                                )
-                                process.communicate(input=self.sudo_password + '\n', timeout=5)
-                            except:
-                                pass
+                            batch.add(['networksetup', '-setwebproxystate', service, 'off'])
+                            batch.add(['networksetup', '-setsecurewebproxystate', service, 'off'])
+                            batch.add(['networksetup', '-setautoproxystate', service, 'off'])
+                    if batch:
+                        self.run_privileged_batch(batch)
             except:
                 pass
         except:
@@ -1014,222 +3474,181 @@ class DomainKiller:
     
     def flush_dns_cache(self):
         """刷新 DNS 缓存（macOS）- 强制刷新（增强版，支持 Safari）"""
+        self.run_prepared(self.prepare_dns_flush)
+    
+    def prepare_dns_flush(self, batch, reset_network_dns=None):
+        """把刷新 DNS 缓存的命令加入 batch，返回 finish(results)（见 run_prepared）
+        reset_network_dns: 是否重置网络服务的 DNS 设置，为空时在系统 DNS 未指向本地屏蔽服务器时重置
+        """
+        if not self.sudo_password:
+            return lambda results: None
+        if reset_network_dns is None:
+            # 系统 DNS 已指向本地屏蔽服务器时不重置网络服务的 DNS 设置，避免覆盖该设置
+            reset_network_dns = not self.system_dns_enabled
+        
+        print("🔄 正在强制刷新 DNS 缓存（包括 Safari）...")
+        failed = []
+        steps = []
         try:
-            if not self.sudo_password:
-                return
-            
-            print("🔄 正在强制刷新 DNS 缓存（包括 Safari）...")
-            
-            # macOS 不同版本使用不同的命令（按顺序执行，确保刷新）
-            # 增强版：添加更多刷新命令，确保 Safari 也能生效
-            commands = [
-                # 1. 刷新系统 DNS 缓存
-                ['sudo', '-S', 'dscacheutil', '-flushcache'],
-                
-                # 2. 重启 mDNSResponder（macOS 的 DNS 服务）
-                ['sudo', '-S', 'killall', '-HUP', 'mDNSResponder'],
-                
-                # 3. 重启 mDNSResponderHelper
-                ['sudo', '-S', 'killall', 'mDNSResponderHelper'],
-                
-                # 4. 完全重启 mDNSResponder（更彻底）
-                ['sudo', '-S', 'killall', 'mDNSResponder'],
-            ]
-            
-            # 执行基础刷新命令
-            for cmd in commands:
-                try:
-                    process = subprocess.Popen(
-                        cmd,
-                        stdin=subprocess.PIPE,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True
-                    )
-                    stdout, stderr = process.communicate(input=self.sudo_password + '\n', timeout=5)
-                    # killall 命令如果找不到进程会返回非零，这是正常的
-                    if process.returncode != 0 and 'killall' not in cmd[1]:
-                        print(f"⚠️ DNS 刷新命令执行警告: {cmd[1]} - {stderr}")
-                except Exception as e:
-                    # 某些命令可能在某些系统上不存在，忽略错误
-                    pass
-            
-            # 5. 使用 launchctl 重启 mDNSResponder（更可靠）
-            try:
-                process = subprocess.Popen(
-                    ['sudo', '-S', 'launchctl', 'kickstart', '-k', 'system/com.apple.mDNSResponder'],
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                process.communicate(input=self.sudo_password + '\n', timeout=5)
-            except:
-                pass
-            
-            # 6. 刷新网络配置缓存（某些 macOS 版本需要，特别是 Safari）
-            # 获取当前网络接口
-            try:
-                # 尝试刷新 Wi-Fi 和 Ethernet 的 DNS 设置（这会触发 DNS 刷新）
-                network_commands = [
-                    ['sudo', '-S', 'networksetup', '-setdnsservers', 'Wi-Fi', 'Empty'],
-                    ['sudo', '-S', 'networksetup', '-setdnsservers', 'Ethernet', 'Empty'],
-                ]
-                
-                for cmd in network_commands:
-                    try:
-                        process = subprocess.Popen(
-                            cmd,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            text=True
-                        )
-                        process.communicate(input=self.sudo_password + '\n', timeout=5)
-                    except:
-                        # 某些接口可能不存在，忽略错误
-                        pass
-            except:
-                pass
+            # 特权辅助进程：一次请求执行全部刷新命令
+            result = self.privileged_call('flush_resolver', reset_network_dns=reset_network_dns)
+            if result is not None:
+                failed = result['failed']
+            else:
+                # macOS 不同版本使用不同的命令，全部命令加入本批，按顺序执行
+                steps = [batch.add(command) for command in PrivilegedBackend.flush_commands(reset_network_dns)]
+        except Exception as e:
+            print(f"⚠️ DNS 刷新过程出错: {e}")
+            return lambda results: None
+        
+        def finish(results):
+            for command in failed:
+                print(f"⚠️ DNS 刷新命令执行警告: {command}")
+            if steps:
+                if results is None:
+                    print("⚠️ DNS 缓存刷新失败")
+                    return
+                # killall 命令如果找不到进程会返回非零，这是正常的
+                self.report_failed_steps(results, steps, ignore=('killall',))
             
             # 额外等待，确保 DNS 刷新完成（Safari 需要更长时间）
             time.sleep(1.0)
             
             print("✅ DNS 缓存已强制刷新（包括 Safari）")
-        except Exception as e:
-            print(f"⚠️ DNS 刷新过程出错: {e}")
+        return finish
     
-    def write_hosts_file(self, content):
-        """写入 hosts 文件（使用更稳定的方法）"""
+    def write_hosts_file(self, document, entries=None):
+        """写入 hosts 文件（使用更稳定的方法），单独执行一次 sudo"""
+        return self.run_prepared(lambda batch: self.prepare_hosts_write(document, entries, batch))[0]
+    
+    def prepare_hosts_write(self, document, entries, batch):
+        """准备写入 hosts 文件，返回 finish(results)（见 run_prepared）
+        保留 document 中的原有内容，屏蔽区块替换为 entries（为空时移除屏蔽区块），内容分块写入；
+        需要 sudo 时把 mv 和刷新 DNS 的命令加入 batch，finish 按 mv 的结果报告并验证写入
+        """
+        self.hosts_document = None
+        entries = entries or set()
+        import tempfile
+        temp_path = None
+        move_step = None
+        written = False
+        finish_flush = None
+        if self.hosts_watcher:
+            self.hosts_watcher.pause()
         try:
-            # 尝试直接写入
-            with open(HOSTS_PATH, 'w', encoding='utf-8', newline='\n') as f:
-                f.write(content)
-            # 刷新 DNS 缓存
-            self.flush_dns_cache()
-            return True
-        except PermissionError:
-            # 需要 sudo，使用缓存的密码
-            password = self.get_sudo_password("需要管理员权限写入 hosts 文件", use_cache=True)
-            if not password:
-                return False
+            # 特权辅助进程：只发送屏蔽区块的条目，由辅助进程读取 hosts 并原子替换
+            result = self.privileged_call('write_hosts_block', entries=sorted(entries),
+                                          names_per_line=self.hosts_names_per_line)
+            if result is not None:
+                document.close()
+                written = True
+            else:
+                # 先把完整内容分块写入临时文件（原有内容按字节从映射中复制），之后不再访问原 hosts 文件的映射
+                temp_fd, temp_path = tempfile.mkstemp()
+                with os.fdopen(temp_fd, 'wb') as temp_file:
+                    document.write_to(temp_file, entries, self.hosts_names_per_line)
+                document.close()
+                
+                try:
+                    # 尝试直接写入
+                    with open(temp_path, 'rb') as source, open(HOSTS_PATH, 'wb') as f:
+                        shutil.copyfileobj(source, f, HostsDocument.CHUNK_BYTES)
+                    written = True
+                except PermissionError:
+                    # 需要 sudo，使用缓存的密码
+                    # 使用 sudo mv 移动文件（原子操作，更可靠），与本批其他特权命令在同一次 sudo 中执行
+                    if self.get_sudo_password("需要管理员权限写入 hosts 文件", use_cache=True):
+                        move_step = batch.add(['mv', temp_path, HOSTS_PATH], timeout=10)
             
-            # 使用临时文件 + sudo mv（更稳定可靠）
-            import tempfile
-            temp_path = None
+            # 刷新 DNS 缓存（命令排在 mv 之后）
+            if written or move_step is not None:
+                finish_flush = self.prepare_dns_flush(batch)
+        except Exception as e:
+            print(f"写入 hosts 文件失败: {e}")
+        
+        def finish(results):
             try:
-                # 创建临时文件
-                temp_fd, temp_path = tempfile.mkstemp(text=True)
-                with os.fdopen(temp_fd, 'w', encoding='utf-8', newline='\n') as temp_file:
-                    temp_file.write(content)
-                
-                # 使用 sudo mv 移动文件（原子操作，更可靠）
-                process = subprocess.Popen(
-                    ['sudo', '-S', 'mv', temp_path, HOSTS_PATH],
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                stdout, stderr = process.communicate(input=password + '\n', timeout=10)
+                if move_step is not None:
+                    if results is None or results[move_step]['returncode'] != 0:
+                        # sudo 失败时 run_privileged_batch 已经重新验证过密码，这里只是命令本身失败
+                        print(f"写入失败: {results[move_step]['stderr'] if results else 'sudo 执行失败'}")
+                        return False
+                elif not written:
+                    return False
                 
-                if process.returncode == 0:
-                    # 等待文件系统同步
-                    time.sleep(0.2)
-                    
-                    # 刷新 DNS 缓存
-                    self.flush_dns_cache()
-                    
-                    # 严格验证写入是否成功
-                    try:
-                        verify_content = self.read_hosts_file(silent=True)
-                        if verify_content:
-                            # 检查标记是否存在
-                            if MARKER_START not in verify_content or MARKER_END not in verify_content:
-                                print("⚠️ 警告: hosts 文件中未找到标记")
-                                return False
-                            
-                            # 提取写入的域名行
-                            in_block = False
-                            written_domains = set()
-                            for line in verify_content.split('\n'):
-                                if MARKER_START in line:
-                                    in_block = True
-                                    continue
-                                if MARKER_END in line:
-                                    in_block = False
-                                    continue
-                                if in_block and LOCALHOST_IP in line:
-                                    # 提取域名（格式: 127.0.0.1 domain）
-                                    parts = line.strip().split()
-                                    if len(parts) >= 2 and parts[0] == LOCALHOST_IP:
-                                        written_domains.add(parts[1].strip())
-                            
-                            # 提取应该写入的域名
-                            expected_domains = set()
-                            in_block = False
-                            for line in content.split('\n'):
-                                if MARKER_START in line:
-                                    in_block = True
-                                    continue
-                                if MARKER_END in line:
-                                    in_block = False
-                                    continue
-                                if in_block and LOCALHOST_IP in line:
-                                    parts = line.strip().split()
-                                    if len(parts) >= 2 and parts[0] == LOCALHOST_IP:
-                                        expected_domains.add(parts[1].strip())
-                            
-                            # 检查所有域名是否都已写入
-                            missing = expected_domains - written_domains
-                            if missing:
-                                print(f"⚠️ 警告: 以下域名未成功写入 hosts 文件: {', '.join(missing)}")
-                                print(f"已写入的域名: {len(written_domains)}, 期望的域名: {len(expected_domains)}")
-                                return False
-                            
-                            print(f"✅ 成功写入 {len(written_domains)} 个域名到 hosts 文件")
-                            return True
-                    except Exception as e:
-                        print(f"⚠️ 验证写入时出错: {e}")
-                        # 即使验证失败，如果 mv 成功，也认为写入成功（但会记录警告）
-                        return True
+                # 等待文件系统同步和 DNS 刷新完成（Safari 需要更长时间）
+                if finish_flush:
+                    finish_flush(results)
                 
-                # 如果失败，清除缓存的密码
-                if process.returncode != 0:
-                    self.sudo_password = None
-                    print(f"写入失败: {stderr}")
-                return False
+                # 严格验证写入是否成功
+                return self.verify_hosts_file(entries)
             except Exception as e:
                 print(f"写入 hosts 文件异常: {e}")
-                # 清理临时文件
+                return False
+            finally:
+                # 清理临时文件（sudo mv 成功后临时文件已不存在）
                 if temp_path and os.path.exists(temp_path):
                     try:
                         os.unlink(temp_path)
                     except:
                         pass
-                self.sudo_password = None
+                if self.hosts_watcher:
+                    self.hosts_watcher.resume()
+        return finish
+    
+    def verify_hosts_file(self, expected_entries):
+        """重新读取 hosts 文件，用集合比较验证屏蔽区块中的域名与期望一致（耗时与条目数成线性关系）
+        解析结果保存在 self.hosts_document 中，缺少和多出的条目保存在 self.hosts_missing / self.hosts_extra 中
+        """
+        self.hosts_missing = set()
+        self.hosts_extra = set()
+        try:
+            document = self.read_hosts_document(silent=True)
+            if document is None:
+                return False
+            # 后续只用到屏蔽区块的解析结果，不需要保留对 hosts 文件的映射
+            document.close()
+            self.hosts_document = document
+            
+            if not expected_entries:
+                # 恢复 hosts 文件时不应再有屏蔽区块
+                if document.has_block:
+                    print("⚠️ 警告: hosts 文件中的屏蔽规则未能移除")
+                    return False
+                return True
+            
+            # 检查标记是否存在
+            if not document.has_block:
+                print("⚠️ 警告: hosts 文件中未找到标记")
                 return False
+            
+            # 检查所有域名是否都已写入（条目完全一致时一次集合比较即可）
+            if document.entries != expected_entries:
+                self.hosts_missing = expected_entries - document.entries
+                self.hosts_extra = document.entries - expected_entries
+                if self.hosts_extra:
+                    print(f"⚠️ 警告: hosts 屏蔽区块中有 {len(self.hosts_extra)} 个多余的域名: "
+                          f"{self.format_entries(self.hosts_extra)}")
+                if self.hosts_missing:
+                    print(f"⚠️ 警告: 以下 {len(self.hosts_missing)} 个域名未成功写入 hosts 文件: "
+                          f"{self.format_entries(self.hosts_missing)}")
+                    print(f"已写入的域名: {len(document.entries)}, 期望的域名: {len(expected_entries)}")
+                    return False
+            
+            print(f"✅ 成功写入 {len(expected_entries)} 个域名到 hosts 文件")
+            return True
         except Exception as e:
-            print(f"写入 hosts 文件失败: {e}")
-            return False
+            print(f"⚠️ 验证写入时出错: {e}")
+            # 即使验证失败，如果写入成功，也认为写入成功（但会记录警告）
+            return True
     
-    def remove_old_rules(self, hosts_content):
-        """移除旧的屏蔽规则"""
-        lines = hosts_content.split('\n')
-        new_lines = []
-        in_block = False
-        
-        for line in lines:
-            if MARKER_START in line:
-                in_block = True
-                continue
-            if MARKER_END in line:
-                in_block = False
-                continue
-            if not in_block:
-                new_lines.append(line)
-        
-        return '\n'.join(new_lines).rstrip()
+    def format_entries(self, entries, limit=20):
+        """把域名集合格式化为便于阅读的一行（最多显示 limit 个）"""
+        shown = sorted(entries)[:limit]
+        text = ', '.join(shown)
+        if len(entries) > limit:
+            text += f" 等共 {len(entries)} 个"
+        return text
     
     def expand_domain_variants(self, domain):
         """扩展域名变体（主域名和 www 子域名）"""
@@ -1251,29 +3670,6 @@ class DomainKiller:
         
         return variants
     
-    def add_block_rules(self, hosts_content, domains):
-        """添加屏蔽规则到 hosts 文件（增强版：包含域名变体）"""
-        content = self.remove_old_rules(hosts_content)
-        
-        if domains:
-            content += f"\n\n{MARKER_START}\n"
-            all_variants = set()
-            
-            # 为每个域名生成所有变体
-            for domain in domains:
-                variants = self.expand_domain_variants(domain)
-                all_variants.update(variants)
-                print(f"域名 {domain} 扩展为: {', '.join(variants)}")
-            
-            # 按字母顺序排序并写入
-            for domain in sorted(all_variants):
-                content += f"{LOCALHOST_IP} {domain}\n"
-            
-            content += f"{MARKER_END}\n"
-            print(f"准备写入 {len(all_variants)} 个域名变体到 hosts 文件")
-        
-        return content
-    
     def verify_domain_blocked(self, domain):
         """验证域名是否真的被屏蔽（通过 ping 测试）"""
         try:
@@ -1292,118 +3688,395 @@ class DomainKiller:
         except:
             return False
     
-    def block_domains(self, domains):
-        """屏蔽域名（三重保护：hosts文件 + pfctl实时拦截 + 代理服务器）"""
-        if not domains:
-            return self.restore_hosts()
-        
-        try:
-            # 1. 使用 hosts 文件屏蔽（基础屏蔽）
-            hosts_content = self.read_hosts_file(silent=True)
-            if not hosts_content and not self.sudo_password:
-                hosts_content = self.read_hosts_file(silent=False)
-            
-            new_content = self.add_block_rules(hosts_content, domains)
-            hosts_result = self.write_hosts_file(new_content)
+    def block_domains(self, domains, added=None, removed=None):
+        """屏蔽域名（三重保护：hosts文件 + pfctl实时拦截 + 代理服务器）
+        added/removed: 相对当前已应用屏蔽列表的差异（blocklist_delta），为空时在这里计算；
+        匹配器、PAC、hosts 条目和 pf 地址表都只处理差异，没有差异时跳过
+        """
+        with self.hosts_lock:
+            if not domains:
+                return self.restore_hosts()
             
-            # 2. 使用 pfctl 防火墙实时拦截（强制断开已建立的连接）
-            pfctl_result = self.setup_pfctl_rules(domains)
+            if added is None or removed is None:
+                added, removed = self.blocklist_delta(domains)
+            delta_empty = not added and not removed
+            blocklist_hash = self.hash_blocklist(domains)
             
-            # 3. 启动代理服务器（对 Safari 更有效）
-            proxy_result = self.start_proxy_server(domains)
+            if ENFORCEMENT_BACKEND == 'dns':
+                if delta_empty and self.session_blocklist_hash is not None and self.dns_sinkhole is not None:
+                    return self.skip_unchanged_blocklist(domains)
+                self.update_blocklist_rules(added, removed)
+                result = self.block_domains_with_dns(domains, added)
+                # 失败时下次同步即使没有差异也重新应用
+                self.session_blocklist_hash = blocklist_hash if result else None
+                return result
             
-            if hosts_result:
-                # 强制刷新 DNS 缓存
-                self.flush_dns_cache()
+            try:
+                # 1. 使用 hosts 文件屏蔽（基础屏蔽）
+                document = self.read_hosts_document(silent=True)
+                if document is None and not self.sudo_password:
+                    document = self.read_hosts_document(silent=False)
+                if document is None:
+                    # 读取失败时不能写入，否则会覆盖 hosts 文件原有内容
+                    print("无法读取 hosts 文件，跳过 hosts 屏蔽")
+                    return False
                 
-                # 验证写入是否成功（检查所有域名变体）
-                try:
-                    verify_content = self.read_hosts_file(silent=True)
-                    if verify_content:
-                        # 检查是否包含所有域名及其变体
-                        all_found = True
-                        missing_domains = []
-                        
-                        for domain in domains:
-                            variants = self.expand_domain_variants(domain)
-                            found_any = False
-                            for variant in variants:
-                                # 检查 hosts 文件中是否有这个域名
-                                if f"{LOCALHOST_IP} {variant}" in verify_content:
-                                    found_any = True
-                                    # 可选：通过 ping 验证（可能较慢，注释掉）
-                                    # if self.verify_domain_blocked(variant):
-                                    #     print(f"✓ {variant} 已成功屏蔽")
-                                    break
-                            if not found_any:
-                                all_found = False
-                                missing_domains.append(domain)
-                        
-                        if all_found:
-                            self.current_domains = set(domains)
-                            if self.window:
-                                self.update_window_domains()
-                            
-                            # 显示屏蔽方式
-                            methods = []
-                            if hosts_result:
-                                methods.append("hosts文件")
-                            if pfctl_result:
-                                methods.append("pfctl防火墙(实时拦截)")
-                            if proxy_result:
-                                methods.append("代理服务器(Safari专用)")
-                            
-                            print(f"✅ 成功屏蔽 {len(domains)} 个域名（方式: {', '.join(methods)}）")
-                            print("💡 提示: pfctl 防火墙可以实时拦截已打开的网站连接")
-                            print("💡 提示: 代理服务器可以拦截 Safari 浏览器的请求")
-                            if not proxy_result:
-                                print("💡 Safari 用户: 如果仍能访问，请重启 Safari 浏览器（完全退出并重新打开）")
-                            return True
-                        else:
-                            print(f"⚠️ 警告: 以下域名可能未成功屏蔽: {', '.join(missing_domains)}")
-                            print(f"当前 hosts 文件内容片段:\n{verify_content[-500:]}")
-                            # 即使部分失败，也更新当前域名列表
-                            self.current_domains = set(domains)
-                            if self.window:
-                                self.update_window_domains()
-                            return True
-                except Exception as e:
-                    print(f"验证写入失败: {e}")
+                # 屏蔽列表和 hosts 中的屏蔽区块都与上次应用时一致（区块未被手动修改）
+                block_hash = self.hash_managed_block(document)
+                hosts_unchanged = (block_hash is not None
+                                   and self.applied_state.get('blocklist_hash') == blocklist_hash
+                                   and self.applied_state.get('block_hash') == block_hash
+                                   and self.applied_state.get('names_per_line', 1) == self.hosts_names_per_line)
+                self.update_blocklist_rules(added, removed)
+                if hosts_unchanged:
+                    document.close()
+                    if delta_empty and self.session_blocklist_hash is not None:
+                        return self.skip_unchanged_blocklist(domains)
+                    # 本次运行第一次应用：hosts 无需重写和刷新 DNS，但 pfctl 和代理需要重新建立
+                    print("hosts 文件中的屏蔽规则与上次一致，跳过写入和 DNS 刷新")
+                    self.run_prepared(lambda batch: self.prepare_pfctl_rules(added, batch), self.prepare_proxy_server)
+                    self.session_blocklist_hash = blocklist_hash
+                    self.current_domains = set(domains)
+                    if self.window:
+                        self.update_window_domains()
+                    return True
                 
-                # 如果验证失败，但写入返回成功，仍然更新
-                self.current_domains = set(domains)
-                if self.window:
-                    self.update_window_domains()
-                return True
+                # 屏蔽区块条目已随差异增量更新；区块被外部改动或列表变化时整体写回
+                entries = set(self.block_entry_counts)
+                print(f"准备写入 {len(entries)} 个域名变体到 hosts 文件")
+                # 三个后端需要的特权命令（hosts 的 mv、刷新 DNS、加载 pf 规则、设置系统代理）收集到同一批中，
+                # 只执行一次 sudo，再按各自命令的结果报告
+                hosts_result, pfctl_result, proxy_result = self.run_prepared(
+                    lambda batch: self.prepare_hosts_write(document, entries, batch),
+                    # 2. 使用 pfctl 防火墙实时拦截（强制断开已建立的连接）
+                    lambda batch: self.prepare_pfctl_rules(added, batch),
+                    # 3. 启动代理服务器（对 Safari 更有效）
+                    self.prepare_proxy_server,
+                )
+                
+                if hosts_result:
+                    # 复用写入验证时读取的 hosts 文件，不再重新读取和解析
+                    verify_document = self.hosts_document or HostsDocument()
+                    self.save_applied_state(blocklist_hash, self.hash_managed_block(verify_document))
+                    self.session_blocklist_hash = blocklist_hash
+                    
+                    # 写入 hosts 文件时已经刷新过 DNS 缓存，这里不再重复刷新
+                    
+                    # 写入验证已经逐条比较过屏蔽区块（缺少条目时 hosts_result 为 False），这里不再重复扫描
+                    self.current_domains = set(domains)
+                    if self.window:
+                        self.update_window_domains()
+                    
+                    # 显示屏蔽方式
+                    methods = ["hosts文件"]
+                    if pfctl_result:
+                        methods.append("pfctl防火墙(实时拦截)")
+                    if proxy_result:
+                        methods.append("代理服务器(Safari专用)")
+                    
+                    print(f"✅ 成功屏蔽 {len(domains)} 个域名（方式: {', '.join(methods)}）")
+                    print("💡 提示: pfctl 防火墙可以实时拦截已打开的网站连接")
+                    print("💡 提示: 代理服务器可以拦截 Safari 浏览器的请求")
+                    if not proxy_result:
+                        print("💡 Safari 用户: 如果仍能访问，请重启 Safari 浏览器（完全退出并重新打开）")
+                    return True
+                
+                return False
+            except Exception as e:
+                print(f"屏蔽域名失败: {e}")
+                import traceback
+                traceback.print_exc()
+                return False
+    
+    def skip_unchanged_blocklist(self, domains):
+        """屏蔽列表与上次应用时完全一致：跳过写 hosts、刷新 DNS、pfctl 和代理的全部步骤（只在后台刷新过期的解析结果）"""
+        self.current_domains = set(domains)
+        self.refresh_expired_resolutions()
+        print(f"屏蔽列表未变化（{len(domains)} 个域名），跳过本次应用")
+        return True
+    
+    def hash_blocklist(self, domains):
+        """计算规范化后（去空白、小写、去重、排序）屏蔽列表的哈希"""
+        normalized = sorted({domain.strip().lower() for domain in domains if domain and domain.strip()})
+        return hashlib.sha256('\n'.join(normalized).encode('utf-8')).hexdigest()
+    
+    def hash_managed_block(self, document):
+        """计算 hosts 文件中屏蔽区块（含起止标记行）的哈希，没有屏蔽区块时返回 None"""
+        if document is None or not document.has_block:
+            return None
+        return hashlib.sha256(document.block_text.encode('utf-8')).hexdigest()
+    
+    def load_applied_state(self):
+        """读取上次应用的状态，文件不存在或损坏时返回空字典"""
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if isinstance(state, dict):
+                return state
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"读取状态文件失败: {e}")
+        return {}
+    
+    def save_applied_state(self, blocklist_hash, block_hash):
+        """保存本次应用的屏蔽列表哈希和屏蔽区块哈希（先写临时文件再替换，避免写到一半）"""
+        self.applied_state = {
+            'backend': ENFORCEMENT_BACKEND,
+            'blocklist_hash': blocklist_hash,
+            'block_hash': block_hash,
+            'names_per_line': self.hosts_names_per_line,
+            'applied_at': int(time.time()),
+        }
+        try:
+            temp_file = self.state_file.with_name(self.state_file.name + '.tmp')
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.applied_state, f)
+            os.replace(temp_file, self.state_file)
+        except Exception as e:
+            print(f"保存状态文件失败: {e}")
+    
+    def block_domains_with_dns(self, domains, added=()):
+        """屏蔽域名（本地 DNS 屏蔽服务器 + pfctl实时拦截 + 代理服务器，不改写 hosts 文件）"""
+        try:
+            # 切换系统 DNS、刷新缓存、加载 pf 规则和设置系统代理的命令在同一次 sudo 中执行
+            dns_result, pfctl_result, proxy_result = self.run_prepared(
+                self.prepare_dns_sinkhole,
+                lambda batch: self.prepare_pfctl_rules(added, batch),
+                self.prepare_proxy_server,
+            )
             
-            return False
+            if not dns_result:
+                return False
+            
+            self.current_domains = set(domains)
+            if self.window:
+                self.update_window_domains()
+            
+            methods = ["本地DNS屏蔽"]
+            if pfctl_result:
+                methods.append("pfctl防火墙(实时拦截)")
+            if proxy_result:
+                methods.append("代理服务器(Safari专用)")
+            print(f"✅ 成功屏蔽 {len(domains)} 个域名（方式: {', '.join(methods)}）")
+            return True
         except Exception as e:
             print(f"屏蔽域名失败: {e}")
             import traceback
             traceback.print_exc()
             return False
     
-    def restore_hosts(self):
-        """恢复 hosts 文件并清除所有规则"""
+    def start_dns_sinkhole(self):
+        """启动本地 DNS 屏蔽服务器（与代理共用匹配器，屏蔽列表变化时替换为新的匹配器，立即生效）"""
+        return self.run_prepared(self.prepare_dns_sinkhole)[0]
+    
+    def prepare_dns_sinkhole(self, batch):
+        """启动本地 DNS 屏蔽服务器，并把切换系统 DNS 和刷新缓存的命令加入 batch，返回 finish(results)（见 run_prepared）"""
         try:
-            # 1. 停止代理服务器
-            self.stop_proxy_server()
+            if self.dns_sinkhole is None:
+                sinkhole = DnsSinkhole()
+                sinkhole.start()
+                self.dns_sinkhole = sinkhole
+                print(f"✅ DNS 屏蔽服务器已启动在 {sinkhole.address[0]}:{sinkhole.address[1]}")
             
-            # 2. 清除 pfctl 规则
-            self.remove_pfctl_rules()
+            self.dns_sinkhole.update(self.domain_matcher)
             
-            # 3. 恢复 hosts 文件
-            hosts_content = self.read_hosts_file()
-            new_content = self.remove_old_rules(hosts_content)
-            result = self.write_hosts_file(new_content)
+            if self.system_dns_enabled:
+                return lambda results: True
             
-            if result:
-                self.flush_dns_cache()
+            # 先保存各网络服务原有的 DNS 设置，停止时原样恢复
+            saved = self.get_system_dns_servers()
+            backup = self.load_dns_backup()
+            for service, servers in saved.items():
+                if servers == [DNS_LISTEN_ADDRESS]:
+                    # 上次异常退出时没有恢复：使用上次保存的设置
+                    saved[service] = backup.get(service, ['Empty'])
+            self.saved_dns_servers = saved
+            self.save_dns_backup(saved)
+            finish_servers = self.prepare_system_dns_servers({service: [DNS_LISTEN_ADDRESS] for service in saved}, batch)
+            # 只在切换 DNS 服务器时刷新一次系统缓存，之后规则变化无需刷新
+            # 刷新命令排在切换之后，不能再把各网络服务的 DNS 重置为自动获取
+            finish_flush = self.prepare_dns_flush(batch, reset_network_dns=False)
+        except Exception as e:
+            print(f"⚠️ 启动 DNS 屏蔽服务器失败: {e}")
+            return lambda results: False
+        
+        def finish(results):
+            if not finish_servers(results):
+                return False
+            self.system_dns_enabled = True
+            finish_flush(results)
+            return True
+        return finish
+    
+    def stop_dns_sinkhole(self):
+        """停止本地 DNS 屏蔽服务器，并把各网络服务的 DNS 恢复为切换前的设置"""
+        try:
+            # 上次异常退出时留下的备份同样在这里恢复
+            saved = self.saved_dns_servers or self.load_dns_backup()
+            if self.system_dns_enabled or saved:
+                if not saved:
+                    saved = {service: ['Empty'] for service in self.get_system_dns_servers()}
+                if self.set_system_dns_servers(saved):
+                    self.saved_dns_servers = None
+                    try:
+                        os.unlink(self.dns_backup_file)
+                    except FileNotFoundError:
+                        pass
+                self.system_dns_enabled = False
+            if self.dns_sinkhole:
+                self.dns_sinkhole.stop()
+                self.dns_sinkhole = None
+        except Exception as e:
+            print(f"⚠️ 停止 DNS 屏蔽服务器失败: {e}")
+    
+    def get_system_dns_servers(self):
+        """读取每个网络服务手动设置的 DNS 服务器，返回 {服务: [服务器, ...]}，没有手动设置时为 ['Empty']（不需要 sudo）"""
+        servers = {}
+        try:
+            process = subprocess.Popen(
+                ['networksetup', '-listallnetworkservices'],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+            stdout, stderr = process.communicate(timeout=5)
+            if process.returncode != 0:
+                return servers
             
-            return result
+            for line in stdout.strip().split('\n')[1:]:
+                service = line.strip()
+                if not service or service.startswith('*'):
+                    continue
+                process = subprocess.run(['networksetup', '-getdnsservers', service],
+                                         capture_output=True, text=True, timeout=5)
+                if process.returncode != 0:
+                    continue
+                lines = [line.strip() for line in process.stdout.splitlines() if line.strip()]
+                # 没有手动设置时输出 "There aren't any DNS Servers set on <服务>."
+                if not lines or lines[0].startswith("There aren't any DNS Servers"):
+                    servers[service] = ['Empty']
+                else:
+                    servers[service] = lines
         except Exception as e:
-            print(f"恢复失败: {e}")
-            return False
+            print(f"读取系统 DNS 设置失败: {e}")
+        return servers
+    
+    def load_dns_backup(self):
+        """读取保存的 DNS 设置备份，文件不存在或损坏时返回空字典"""
+        try:
+            with open(self.dns_backup_file, 'r', encoding='utf-8') as f:
+                backup = json.load(f)
+            if isinstance(backup, dict):
+                return {service: servers for service, servers in backup.items()
+                        if isinstance(servers, list) and servers}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"读取 DNS 设置备份失败: {e}")
+        return {}
+    
+    def save_dns_backup(self, servers):
+        """保存 DNS 设置备份（先写临时文件再替换，避免写到一半）"""
+        try:
+            temp_file = self.dns_backup_file.with_name(self.dns_backup_file.name + '.tmp')
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(servers, f)
+            os.replace(temp_file, self.dns_backup_file)
+        except Exception as e:
+            print(f"保存 DNS 设置备份失败: {e}")
+    
+    def set_system_dns_servers(self, servers):
+        """按 {服务: [服务器, ...]} 设置各网络服务的 DNS 服务器（['Empty'] 表示恢复自动获取）"""
+        return self.run_prepared(lambda batch: self.prepare_system_dns_servers(servers, batch))[0]
+    
+    def prepare_system_dns_servers(self, servers, batch):
+        """把设置各网络服务 DNS 服务器的命令加入 batch，返回 finish(results)（见 run_prepared），有一个服务设置成功即为成功"""
+        if not servers:
+            return lambda results: False
+        if not self.sudo_password:
+            password = self.get_sudo_password("需要管理员权限设置系统 DNS", use_cache=True)
+            if not password:
+                return lambda results: False
+        steps = {service: batch.add(['networksetup', '-setdnsservers', service] + list(addresses))
+                 for service, addresses in servers.items()}
+        
+        def finish(results):
+            success = False
+            for service, step in steps.items():
+                if self.report_failed_steps(results, [step]):
+                    print(f"✅ {service} 的 DNS 已设置为: {' '.join(servers[service])}")
+                    success = True
+            if not success:
+                print("设置系统 DNS 失败")
+            return success
+        return finish
+    
+    def restore_hosts(self):
+        """恢复 hosts 文件并清除所有规则"""
+        with self.hosts_lock:
+            try:
+                # 1. 停止代理服务器
+                self.stop_proxy_server()
+                
+                # 2. 清除 pfctl 规则
+                self.remove_pfctl_rules()
+                
+                # 3. 停止本地 DNS 屏蔽服务器并恢复系统 DNS 设置
+                self.stop_dns_sinkhole()
+                
+                # 清空匹配器、PAC 和 hosts 条目，下次屏蔽时整个列表作为新增处理
+                self.update_blocklist_rules(set(), set(self.applied_domains))
+                self.session_blocklist_hash = None
+                
+                # 4. 恢复 hosts 文件
+                document = self.read_hosts_document()
+                if document is None:
+                    print("无法读取 hosts 文件，跳过恢复")
+                    return False
+                with document:
+                    if not document.has_block and self.applied_state.get('block_hash') is None:
+                        # hosts 中已经没有屏蔽区块，无需重写和刷新 DNS
+                        return True
+                    result = self.write_hosts_file(document)
+                
+                if result:
+                    self.save_applied_state(None, None)
+                
+                return result
+            except Exception as e:
+                print(f"恢复失败: {e}")
+                return False
+    
+    def start_hosts_watcher(self):
+        """启动 hosts 文件监视：文件被外部修改后立即重新应用屏蔽规则"""
+        if not HOSTS_WATCH_ENABLED or ENFORCEMENT_BACKEND != 'hosts' or self.hosts_watcher:
+            return
+        try:
+            self.hosts_watcher = HostsWatcher(HOSTS_PATH, self.on_hosts_changed)
+            self.hosts_watcher.start()
+            print("✅ 已启动 hosts 文件监视")
+        except Exception as e:
+            self.hosts_watcher = None
+            print(f"⚠️ 启动 hosts 文件监视失败: {e}")
+    
+    def stop_hosts_watcher(self):
+        if self.hosts_watcher:
+            self.hosts_watcher.stop()
+            self.hosts_watcher = None
+    
+    def on_hosts_changed(self):
+        """hosts 文件被外部修改（在监视线程中调用）：用缓存的屏蔽列表重新应用，不请求 API
+        屏蔽区块完好时 block_domains 比较哈希后直接跳过，只有区块被改动时才会重写
+        """
+        domains = set(self.current_domains)
+        if not domains or self.session_blocklist_hash is None:
+            return
+        print("检测到 hosts 文件被修改，检查屏蔽规则...")
+        state = self.applied_state
+        # 重新写入 hosts 后 applied_state 会被替换为新的字典
+        if self.block_domains(domains) and self.applied_state is not state and self.window:
+            self.window.after(0, lambda: self.update_status_in_window(f"🛡️ hosts 文件被修改，已重新屏蔽 {len(domains)} 个域名"))
     
     def sync_and_block(self):
         """同步域名并屏蔽（立即执行，不等待）"""
@@ -1416,14 +4089,26 @@ class DomainKiller:
             print("开始从 API 同步域名...")
             api_result = self.fetch_domains_from_api()
             
+            if api_result and self.api_fetch_status == 'not_modified' and self.blocklist_still_applied(api_result[0]):
+                # 域名列表未变化且已在本次运行中完整应用：跳过合并、屏蔽和界面刷新
+                print("域名列表未变化，跳过本次同步")
+                self.refresh_expired_resolutions()
+                if self.window:
+                    self.window.after(0, lambda: self.update_status_in_window(f"✅ 域名列表未变化，保持屏蔽 {len(self.current_domains)} 个域名"))
+                return
+            
             if api_result:
-                # API 调用成功
+                # API 调用成功（或网络故障时使用了上次缓存的 API 域名）
                 api_domains, api_password = api_result
                 if api_password:
                     self.password = api_password
                     print(f"✓ 从 API 获取到密码")
                 
-                print(f"✓ 从 API 获取到 {len(api_domains)} 个域名")
+                if self.api_fetch_status == 'cached':
+                    print(f"✓ API 不可用，使用缓存的 {len(api_domains)} 个 API 域名")
+                else:
+                    added, removed = self.api_delta
+                    print(f"✓ 从 API 获取到 {len(api_domains)} 个域名（新增 {len(added)} 个，移除 {len(removed)} 个）")
                 print(f"域名列表: {', '.join(sorted(api_domains)[:10])}{'...' if len(api_domains) > 10 else ''}")
                 
                 # 更新本地文件（API 域名会写入本地文件，但保留原有本地域名）
@@ -1464,7 +4149,9 @@ class DomainKiller:
                 print(f"开始屏蔽 {len(self.current_domains)} 个域名（API: {len(self.api_domains)}, 本地: {len(local_domains)}）...")
                 if self.window:
                     self.window.after(0, lambda: self.update_status_in_window(f"🛡️ 正在屏蔽 {len(self.current_domains)} 个域名（API+本地）..."))
-                success = self.block_domains(self.current_domains)
+                # 只把相对已应用屏蔽列表的差异（API 新增/移除和本地文件的变化）交给各屏蔽后端
+                added, removed = self.blocklist_delta(self.current_domains)
+                success = self.block_domains(self.current_domains, added, removed)
                 
                 if success:
                     print(f"✅ 成功屏蔽 {len(self.current_domains)} 个域名")
@@ -1495,18 +4182,38 @@ class DomainKiller:
             if self.window:
                 self.window.after(0, lambda: self.update_status_in_window(f"❌ {error_msg}", error=True))
     
+    def blocklist_still_applied(self, api_domains):
+        """API 域名未变化时判断是否可以跳过本次同步
+        
+        合并后的屏蔽列表必须与本次运行中已完整应用的一致；hosts 后端还需要监视器在运行，
+        否则定时同步是发现 hosts 被修改的唯一途径，不能跳过。
+        """
+        if self.session_blocklist_hash is None:
+            return False
+        if ENFORCEMENT_BACKEND != 'dns' and self.hosts_watcher is None:
+            return False
+        domains = set(api_domains) | self.read_domains_file()
+        return self.hash_blocklist(domains) == self.session_blocklist_hash
+    
+    def run_sync(self):
+        """执行一次同步，返回同步结果（updated / not_modified / failed），供调度器决定下次同步的时间"""
+        self.api_fetch_status = None
+        try:
+            self.sync_and_block()
+        except Exception as e:
+            print(f"检查更新失败: {e}")
+            return 'failed'
+        # 网络故障时使用缓存（cached）也算失败，按失败退避
+        status = self.api_fetch_status
+        return status if status in ('updated', 'not_modified') else 'failed'
+    
     def check_and_update(self):
-        """定时检查并更新"""
+        """定时检查并更新（同步间隔由调度器根据上次同步的结果调整，手动同步时立即唤醒）"""
         while self.running:
-            try:
-                self.sync_and_block()
-            except Exception as e:
-                print(f"检查更新失败: {e}")
-            
-            for _ in range(CHECK_INTERVAL):
-                if not self.running:
-                    break
-                time.sleep(1)
+            self.sync_scheduler.wait(lambda: self.running)
+            if not self.running:
+                break
+            self.sync_scheduler.record(self.run_sync())
     
     def create_window(self):
         """创建显示窗口（优化启动速度）"""
@@ -1537,7 +4244,7 @@ class DomainKiller:
             button_frame.pack(fill=tk.X, padx=5, pady=5)
             
             ttk.Button(button_frame, text="立即同步", 
-                      command=lambda: threading.Thread(target=self.sync_and_block, daemon=True).start()).pack(side=tk.LEFT, padx=5)
+                      command=self.sync_scheduler.wake).pack(side=tk.LEFT, padx=5)
             ttk.Button(button_frame, text="刷新列表", 
                       command=self.update_window_domains).pack(side=tk.LEFT, padx=5)
             
@@ -1674,7 +4381,8 @@ class DomainKiller:
     def verify_password(self, input_password):
         """验证密码"""
         try:
-            api_result = self.fetch_domains_from_api()
+            # 网络故障时不能用缓存验证密码
+            api_result = self.fetch_domains_from_api(offline_fallback=False)
             if api_result:
                 _, api_password = api_result
                 return api_password and input_password == api_password
@@ -1837,7 +4545,11 @@ class DomainKiller:
             return
         
         if self.verify_password(password):
+            self.stop_hosts_watcher()
             self.restore_hosts()
+            self.stop_privileged_helper()
+            print(f"sudo 密码验证: 实际验证 {self.sudo_credential.stats['verified']} 次，"
+                  f"信任期内省去 {self.sudo_credential.stats['saved']} 次")
             self.running = False
             if self.window:
                 self.window.quit()
@@ -1883,6 +4595,8 @@ class DomainKiller:
                     if password:
                         self.sudo_password = password
                         print("✓ 密码已获取并缓存")
+                        # 启动特权辅助进程，之后的特权操作不再每次运行 sudo
+                        self.start_privileged_helper()
                         if self.window:
                             self.window.after(0, lambda: self.update_status_in_window("✓ 权限获取成功，正在刷新 API 列表..."))
                     else:
@@ -1894,7 +4608,7 @@ class DomainKiller:
                     print("步骤 2/3: 从 API 刷新域名列表并屏蔽...")
                     if self.window:
                         self.window.after(0, lambda: self.update_status_in_window("🔄 正在从服务器获取最新域名列表..."))
-                    self.sync_and_block()
+                    self.sync_scheduler.record(self.run_sync())
                     
                     # 确保列表已刷新（同步完成后立即更新）
                     if self.window:
@@ -1903,9 +4617,10 @@ class DomainKiller:
                         # 延迟刷新一次（确保文件已写入，作为备份）
                         self.window.after(500, lambda: self.update_window_domains())
                     
-                    # 3. 启动定时检查（在单独的线程中）
+                    # 3. 启动定时检查（在单独的线程中）和 hosts 文件监视
                     print("步骤 3/3: 启动定时检查...")
                     threading.Thread(target=self.check_and_update, daemon=True).start()
+                    self.start_hosts_watcher()
                     print("✅ 初始化完成")
                     print("=" * 50)
                 except Exception as e:
@@ -1929,6 +4644,12 @@ class DomainKiller:
 
 def main():
     """主函数"""
+    if len(sys.argv) > 1 and sys.argv[1] == '--privileged-helper':
+        run_privileged_helper(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == '--privileged-batch':
+        run_privileged_batch(sys.argv[2:])
+        return
     try:
         if sys.platform != 'darwin':
             print("此程序仅支持 macOS 系统")